@@ -1,14 +1,73 @@
 from pathlib import Path
-from subprocess import call, check_output
-import shlex
+from subprocess import CalledProcessError
 import sys
+import json
 import argparse
 import textwrap
 import platform
 import tempfile
+import os
+import shutil
+
+from setuptools_conda import runner, server
 
 WINDOWS = platform.system() == 'Windows'
 
+# File within environments created by the provision command recording the requirements
+# they were created with:
+PROVISION_STAMP = ('conda-meta', 'setuptools-conda-provision.json')
+
+
+# Help for arguments overriding the requirements configuration of the projects given
+# to a command, shared by the commands that read it:
+REQUIREMENTS_ARGUMENTS_HELP = {
+    "--setup-requires": """\
+                        Build requirements override. 'See python setup.py dist_conda -h'
+    """,
+    "--install-requires": """\
+                        Install requirements override. 'See python setup.py dist_conda
+                        -h'
+    """,
+    "--conda-name-differences": """\
+                        PyPI:conda name differences override. 'See python setup.py
+                        dist_conda -h'
+    """,
+    "--conda-name-database": """\
+                        Path to a shared PyPI:conda name database. Defaults to the
+                        value of the SETUPTOOLS_CONDA_NAME_DATABASE environment
+                        variable, if set. 'See python setup.py dist_conda -h'
+    """,
+    "--channels": """\
+                        Channels to search for requirements. 'See python setup.py
+                        dist_conda -h'
+    """,
+}
+
+
+def add_requirements_arguments(parser, *names):
+    """Add the given arguments overriding projects' requirements configuration, from
+    those in REQUIREMENTS_ARGUMENTS_HELP, to the parser"""
+    for name in names:
+        parser.add_argument(
+            name,
+            action="store",
+            default=None,
+            help=textwrap.dedent(REQUIREMENTS_ARGUMENTS_HELP[name]),
+        )
+
+
+def add_pythons_argument(parser, purpose):
+    """Add the --pythons argument to the parser, with help describing the Python
+    versions as those to <purpose>, e.g. 'build for'"""
+    text = f"Comma-separated list of Python versions to {purpose}, e.g. '3.11,3.12'. "
+    text += "Defaults to the version of the current interpreter."
+    parser.add_argument(
+        "--pythons",
+        action="store",
+        default=None,
+        help=textwrap.fill(text, width=64) + '\n',
+    )
+
 
 def main():
     # Since setuptools_conda is self-hosting, it needs toml and distlib to read its own
@@ -26,9 +85,11 @@ def main():
         # required=True,
         help=textwrap.dedent(
             """\
-                        Action to perform, either "build" or "install-requirements". For
-                        help on arguments accepted by a given command, run
-                        'setuptools-conda <command> -h'
+                        Action to perform, either "build", "build-multi",
+                        "install-requirements", "requirements-matrix", "mirror",
+                        "provision", "check", "gc", "merge" or "serve". For help on
+                        arguments accepted by a given command, run 'setuptools-conda
+                        <command> -h'
             """
         ),
     )
@@ -94,6 +155,125 @@ def main():
         ),
     )
 
+    parser_build_multi = subparsers.add_parser(
+        "build-multi",
+        help=textwrap.dedent(
+            """\
+
+                        Build conda packages for several setuptools projects in a single
+                        conda-build run, using one multi-output recipe.
+
+                        Each project's sdist is unpacked into its own folder of a shared
+                        source, and all projects are pip installed into one host
+                        environment containing the union of their build requirements.
+                        The recipe has one output per project, containing the files that
+                        project installed, with its own run requirements and metadata,
+                        determined in the same way as by 'dist_conda'. Since the build
+                        and host environments are created once rather than once per
+                        project, this is much faster than building projects with many
+                        build requirements in common individually.
+
+                        Build requirements of all projects are installed first, as by
+                        'setuptools-conda build'. The packages built are copied to
+                        --output-dir.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    add_pythons_argument(parser_build_multi, "build for")
+
+    add_requirements_arguments(
+        parser_build_multi,
+        "--conda-name-differences",
+        "--conda-name-database",
+        "--channels",
+    )
+
+    parser_build_multi.add_argument(
+        "--build-number",
+        action="store",
+        default=None,
+        help=textwrap.dedent(
+            """\
+                        Conda build number. Defaults to zero
+            """
+        ),
+    )
+
+    parser_build_multi.add_argument(
+        "--noarch",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+                        Build platform-independent packages. 'See python setup.py
+                        dist_conda -h'
+            """
+        ),
+    )
+
+    parser_build_multi.add_argument(
+        "--name",
+        action="store",
+        default='setuptools-conda-outputs',
+        help=textwrap.dedent(
+            """\
+                        Name of the multi-output recipe. The recipe itself does not
+                        produce a package with this name, but it appears in
+                        conda-build's output. Defaults to 'setuptools-conda-outputs'.
+            """
+        ),
+    )
+
+    parser_build_multi.add_argument(
+        "--build-dir",
+        action="store",
+        default='conda_build_multi',
+        help=textwrap.dedent(
+            """\
+                        Directory for the recipe, sdists and conda-build's croot.
+                        Defaults to ./conda_build_multi
+            """
+        ),
+    )
+
+    parser_build_multi.add_argument(
+        "--output-dir",
+        action="store",
+        default='conda_packages',
+        help=textwrap.dedent(
+            """\
+                        Directory to copy the built packages to, in subdirectories by
+                        platform. Defaults to ./conda_packages
+            """
+        ),
+    )
+
+    parser_build_multi.add_argument(
+        "--shard",
+        action="store",
+        default=None,
+        help=textwrap.dedent(
+            """\
+                        Build only the Python versions assigned to this shard of the
+                        build, given as 'i/N', copying the packages to
+                        '<output-dir>_shard_<i>_of_<N>' instead of --output-dir. 'See
+                        python setup.py dist_conda -h'
+            """
+        ),
+    )
+
+    parser_build_multi.add_argument(
+        action="store",
+        dest="projects",
+        nargs="+",
+        help=textwrap.dedent(
+            """\
+                        Project directories to build
+            """
+        ),
+    )
+
     parser_install_requirements = subparsers.add_parser(
         "install-requirements",
         help=textwrap.dedent(
@@ -130,83 +310,481 @@ def main():
         formatter_class=argparse.RawTextHelpFormatter,
     )
 
-    parser_install_requirements.add_argument(
+    add_requirements_arguments(
+        parser_install_requirements,
         "--setup-requires",
+        "--install-requires",
+        "--conda-name-differences",
+        "--conda-name-database",
+        "--channels",
+    )
+
+    parser_install_requirements.add_argument(
+        action="store",
+        dest="projects",
+        nargs="+",
+        help=textwrap.dedent(
+            """\
+                        Project directories to install dependencies for
+            """
+        ),
+    )
+
+    parser_requirements_matrix = subparsers.add_parser(
+        "requirements-matrix",
+        help=textwrap.dedent(
+            """\
+
+                        Print the build and run requirements of the given project(s) for
+                        each combination of the given target platforms and Python
+                        versions, without installing anything.
+
+                        Requirements are obtained from the same sources as the
+                        'install-requirements' command, once per project, and then their
+                        environment markers are evaluated for every target, rather than
+                        only for the running interpreter. Requirements are converted to
+                        conda names and merged in the same way as by
+                        'install-requirements', so for each target the output is the
+                        list of packages that command would install on that target.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser_requirements_matrix.add_argument(
+        "--platforms",
         action="store",
         default=None,
         help=textwrap.dedent(
             """\
-                        Build requirements override. 'See python setup.py dist_conda -h'
+                        Comma-separated list of conda platforms to evaluate requirements
+                        for, e.g. 'linux-64,osx-arm64,win-64'. Defaults to the current
+                        platform.
             """
         ),
     )
 
-    parser_install_requirements.add_argument(
+    add_pythons_argument(parser_requirements_matrix, "evaluate requirements for")
+
+    add_requirements_arguments(
+        parser_requirements_matrix,
+        "--setup-requires",
         "--install-requires",
+        "--conda-name-differences",
+        "--conda-name-database",
+    )
+
+    parser_requirements_matrix.add_argument(
+        "--output",
         action="store",
         default=None,
         help=textwrap.dedent(
             """\
-                        Install requirements override. 'See python setup.py dist_conda
-                        -h'
+                        Path of a file to write the matrix to as JSON, in addition to
+                        printing it. The file contains a list with one object per
+                        target, with keys 'platform', 'python', 'build_requires' and
+                        'run_requires'.
             """
         ),
     )
 
-    parser_install_requirements.add_argument(
+    parser_requirements_matrix.add_argument(
+        action="store",
+        dest="projects",
+        nargs="+",
+        help=textwrap.dedent(
+            """\
+                        Project directories to evaluate requirements for
+            """
+        ),
+    )
+
+    parser_mirror = subparsers.add_parser(
+        "mirror",
+        help=textwrap.dedent(
+            """\
+
+                        Create or update a local conda channel containing everything
+                        needed to build the given project(s) and install their
+                        requirements without network access.
+
+                        The build and run requirements are obtained in the same way as
+                        for 'install-requirements', and resolved by conda into a
+                        complete environment along with Python, pip, setuptools and
+                        wheel, as used by conda-build. For projects with extension
+                        modules, the compilers conda-build installs in its separate
+                        build environment, and any --compiler-cache tool, are resolved
+                        as well. Any packages not already in the local conda package
+                        cache are downloaded, and then all packages in the environments
+                        are copied from the cache into the output directory, which is
+                        indexed as a conda channel.
+
+                        The channel can then be used on a machine with no network
+                        access, e.g. with 'setuptools-conda install-requirements
+                        --channels <output-dir>' or by passing '--channels
+                        <output-dir>' to 'setuptools-conda build', with conda
+                        configured to run offline (CONDA_OFFLINE=1).
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser_mirror.add_argument(
+        "--output",
+        action="store",
+        default='conda_mirror',
+        help=textwrap.dedent(
+            """\
+                        Directory of the local channel to write packages to. Packages
+                        and index entries already present are kept, so several
+                        projects' requirements can be mirrored into the same channel.
+                        Defaults to ./conda_mirror.
+            """
+        ),
+    )
+
+    add_pythons_argument(parser_mirror, "mirror packages for")
+
+    add_requirements_arguments(
+        parser_mirror,
+        "--setup-requires",
+        "--install-requires",
         "--conda-name-differences",
+        "--conda-name-database",
+        "--channels",
+    )
+
+    parser_mirror.add_argument(
         action="store",
-        default=None,
+        dest="projects",
+        nargs="+",
         help=textwrap.dedent(
             """\
-                        PyPI:conda name differences override. 'See python setup.py
-                        dist_conda -h'"
+                        Project directories to mirror requirements for
             """
         ),
     )
 
-    parser_install_requirements.add_argument(
+    parser_provision = subparsers.add_parser(
+        "provision",
+        help=textwrap.dedent(
+            """\
+
+                        Create a conda environment for each of several Python versions,
+                        containing the build and run requirements of the given
+                        project(s), for example as development environments in which to
+                        then run 'pip install --no-deps -e .'.
+
+                        Requirements are obtained in the same way as for
+                        'install-requirements', but evaluated for each Python version
+                        and the current platform at once. Any packages not already in
+                        the conda package cache are first downloaded, and the
+                        environments then created concurrently from the cache, into
+                        '<prefix-dir>/py<python>'. An environment that already exists
+                        and was created by this command with the same requirements is
+                        reused as is.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser_provision.add_argument(
+        "--prefix-dir",
+        action="store",
+        default='conda_envs',
+        help=textwrap.dedent(
+            """\
+                        Directory in which to create the environments. Defaults to
+                        ./conda_envs.
+            """
+        ),
+    )
+
+    add_pythons_argument(parser_provision, "create environments for")
+
+    add_requirements_arguments(
+        parser_provision,
+        "--setup-requires",
+        "--install-requires",
+        "--conda-name-differences",
+        "--conda-name-database",
         "--channels",
+    )
+
+    parser_provision.add_argument(
+        action="store",
+        dest="projects",
+        nargs="+",
+        help=textwrap.dedent(
+            """\
+                        Project directories to provision environments for
+            """
+        ),
+    )
+
+    parser_check = subparsers.add_parser(
+        "check",
+        help=textwrap.dedent(
+            """\
+
+                        Check the requirements of the given project(s) for problems that
+                        would prevent them being converted to conda requirements, such
+                        as invalid version specifiers or environment markers, markers
+                        with no conda selector equivalent, or names that don't map to
+                        valid conda package names, and print every problem found along
+                        with where the requirement came from.
+
+                        Every place requirements may be configured is checked, not only
+                        the one that takes precedence: --setup-requires and
+                        --install-requires if given, [dist_conda] and [options] in
+                        setup.cfg, and [build-system], [project] and
+                        [tool.setuptools_conda] in pyproject.toml. Only configuration
+                        files are read, so this is fast enough to run as a pre-commit
+                        hook, unless --egg-info is given. Exits with status 1 if any
+                        problems are found.
+
+                        The 'build', 'build-multi' and 'install-requirements' commands
+                        run the same check before doing anything else.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser_check.add_argument(
+        "--egg-info",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+                        Also check requirements given in setup.py, by running
+                        'setup.py egg_info'.
+            """
+        ),
+    )
+
+    add_requirements_arguments(
+        parser_check,
+        "--setup-requires",
+        "--install-requires",
+        "--conda-name-differences",
+        "--conda-name-database",
+    )
+
+    parser_check.add_argument(
+        action="store",
+        dest="projects",
+        nargs="+",
+        help=textwrap.dedent(
+            """\
+                        Project directories to check
+            """
+        ),
+    )
+
+    parser_gc = subparsers.add_parser(
+        "gc",
+        help=textwrap.dedent(
+            """\
+
+                        Remove old packages from the conda_packages output directories
+                        of the given project(s), and remove build directories and caches
+                        that are no longer needed.
+
+                        Packages are removed according to --keep-last and --max-size, or
+                        if not given, the dist_conda options of the same names in each
+                        project's configuration, and if neither is set, no packages are
+                        removed. Manifests written by --manifest are removed along with
+                        their packages, and the removed packages' records are deleted
+                        from the repodata.json of any subdir that has one, as written by
+                        'setuptools-conda mirror'.
+
+                        Job directories of parallel builds whose processes are no longer
+                        running are removed from each project's build directory, and
+                        from its croot if it has one configured, as are clones of test
+                        environments made by such builds. Test environments created by
+                        --test, the croot kept in the build directory by --fast, and the
+                        wheel cached by --from-wheel and --universal-wheel are removed
+                        if they have not been used for --max-age days. Compiler caches
+                        are left to ccache and sccache to limit in size. Builds may
+                        safely run concurrently with this command, but it must not be
+                        used on a build directory shared with other machines.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser_gc.add_argument(
+        "--keep-last",
         action="store",
+        type=int,
         default=None,
         help=textwrap.dedent(
             """\
-                        Channels to search for build requires. 'See python setup.py
+                        Number of the most recent builds of each package name, version
+                        and Python version to keep, at least 1. 'See python setup.py
                         dist_conda -h'
             """
         ),
     )
 
-    parser_install_requirements.add_argument(
+    parser_gc.add_argument(
+        "--max-size",
+        action="store",
+        default=None,
+        help=textwrap.dedent(
+            """\
+                        Total size of the packages to keep in each output directory,
+                        e.g. '20G', removing the oldest first. 'See python setup.py
+                        dist_conda -h'
+            """
+        ),
+    )
+
+    parser_gc.add_argument(
+        "--max-age",
+        action="store",
+        type=float,
+        default=None,
+        help=textwrap.dedent(
+            """\
+                        Number of days since a test environment, fast-mode croot or
+                        cached wheel was last used after which it is removed. Default:
+                        30.
+            """
+        ),
+    )
+
+    parser_gc.add_argument(
+        "--dry-run",
+        action="store_true",
+        help=textwrap.dedent(
+            """\
+                        Print what would be removed without removing anything.
+            """
+        ),
+    )
+
+    parser_gc.add_argument(
         action="store",
         dest="projects",
         nargs="+",
         help=textwrap.dedent(
             """\
-                        Project directories to install dependencies for
+                        Project directories to collect garbage for
+            """
+        ),
+    )
+
+    parser_merge = subparsers.add_parser(
+        "merge",
+        help=textwrap.dedent(
+            """\
+
+                        Combine the output directories of the shards of a build spread
+                        over several machines with 'dist_conda --shard' or 'build-multi
+                        --shard' into one output directory, indexed as a conda channel.
+
+                        Packages and any manifests written by --manifest are copied
+                        from each shard's output directory into the same subdirectory of
+                        the output directory, and each subdirectory copied to has its
+                        repodata.json brought up to date with the packages in it, so
+                        that the output directory can be used as a conda channel. Fails
+                        if two shards contain different packages with the same
+                        filename, which means they were not built from the same source
+                        and configuration.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser_merge.add_argument(
+        "--output",
+        action="store",
+        default='conda_packages',
+        help=textwrap.dedent(
+            """\
+                        Output directory to merge the shards into. Defaults to
+                        ./conda_packages
+            """
+        ),
+    )
+
+    parser_merge.add_argument(
+        action="store",
+        dest="shard_dirs",
+        nargs="+",
+        help=textwrap.dedent(
+            """\
+                        Output directories of the shards, e.g.
+                        conda_packages_shard_1_of_4
+            """
+        ),
+    )
+
+    parser_serve = subparsers.add_parser(
+        "serve",
+        help=textwrap.dedent(
+            """\
+
+                        Run a server that executes 'build' and 'install-requirements'
+                        commands on behalf of other setuptools-conda invocations in the
+                        same conda environment.
+
+                        The server imports setuptools, conda and conda-build once at
+                        startup and forks a process with these already imported for
+                        each job, avoiding several seconds of startup cost per command.
+                        While it is running, 'setuptools-conda build' and
+                        'setuptools-conda install-requirements' forward their arguments,
+                        working directory and environment to the server over a Unix
+                        socket and display the job's output. Set the environment
+                        variable SETUPTOOLS_CONDA_NO_SERVER=1 to run commands locally
+                        regardless. The server restarts itself if packages in the
+                        environment change. Not available on Windows.
+
+                        Only environment variables relevant to builds are forwarded:
+                        PATH, HOME, locale, proxy and compiler variables, and those
+                        starting with CONDA, SETUPTOOLS_CONDA_, PIP_ or CMAKE_. List
+                        the names of any others a build needs, separated by commas, in
+                        the environment variable SETUPTOOLS_CONDA_SERVER_ENV. The socket
+                        is kept in a directory private to the current user, and clients
+                        will not use a server running as another user.
+            """
+        ),
+        formatter_class=argparse.RawTextHelpFormatter,
+    )
+
+    parser_serve.add_argument(
+        "--socket",
+        action="store",
+        default=None,
+        help=textwrap.dedent(
+            """\
+                        Path of the Unix socket to listen on. Defaults to the value of
+                        the SETUPTOOLS_CONDA_SOCKET environment variable if set, or
+                        otherwise a path unique to the conda environment in
+                        $XDG_RUNTIME_DIR/setuptools-conda, or if XDG_RUNTIME_DIR is not
+                        set, in a directory unique to the current user in the temporary
+                        directory. Clients find the server using the same rule. The
+                        socket's directory is created if it doesn't exist, and must be
+                        owned by the current user and not accessible to others.
             """
         ),
     )
 
     def run_conda_cmd(cmd, **kwargs):
-        print('[running]:', *[shlex.quote(arg) for arg in cmd])
         # Shell=True is necessary on Windows for calls to conda, otherwise we get
         # mysterious breakage. But shell=True with a list of args totally changes this
         # function on unix so we avoid it:
-        rc = call(cmd, shell=WINDOWS, **kwargs)
-        if rc:
-            sys.exit(rc)
-        return rc
-
-    def get_output(cmd, **kwargs):
-        print('[running]:', *[shlex.quote(arg) for arg in cmd])
-        return check_output(cmd, shell=WINDOWS, **kwargs).decode('utf8').strip()
+        try:
+            return runner.run(cmd, shell=WINDOWS, **kwargs)
+        except CalledProcessError as e:
+            sys.exit(e.returncode)
 
     def getargvalue(argname, args):
         """if arglist is a list, manually look for an arg --argname return its value. If
-        args is a namespace object, simply return args.argname"""
-        if hasattr(args, argname.replace('-', '_')):
-            return getattr(args, argname.replace('-', '_'))
+        args is a namespace object, simply return args.argname, or None if the command
+        has no such argument"""
+        if not isinstance(args, list):
+            return getattr(args, argname.replace('-', '_'), None)
         try:
             return args[args.index(f'--{argname}') + 1]
         except IndexError:
@@ -219,159 +797,22 @@ def main():
             if arg.startswith(f'--{argname}='):
                 return arg.split(f'--{argname}=', 1)[1]
 
-    def get_project_name(proj):
-        return get_output([sys.executable, *setup_py(proj), '--name'], cwd=str(proj))
-
-    def get_build_requires(proj, args):
-        arg = 'setup-requires'
-        requires = getargvalue(arg, args)
-        if requires is not None:
-            print(f"Using build requirements from --{arg} command line argument")
-            return split(requires)
-        requires = get_setup_cfg_entry(proj, "dist_conda", "setup_requires")
-        if requires is not None:
-            print("Using build requirements from setup.cfg [dist_conda]/setup_requires")
-            return requires
-        requires = get_pyproject_toml_entry(proj, 'build-system', 'requires')
-        if requires is not None:
-            print("Using build requirements from pyproject.toml [build-system]/requires")
-            return requires
-        requires = get_setup_cfg_entry(proj, "options", "setup_requires")
-        if requires is not None:
-            print("Using build requirements from [options]/setup_requires")
-            return requires
-        print("No build requirements")
-        return []
-
-    def parse_egg_info_requires(egg_info_requires):
-        """Given the contents of an egg-info requires.txt, determine requirements with
-        environmnent markers, and return a list of all requirements with any environment
-        markers suffixed after a semicolon as per PEP 508. Ignore extras-require"""
-        all_requires = []
-
-        env_marker = None
-        extra = False
-        for line in egg_info_requires.splitlines():
-            line = line.strip()
-            if line.startswith('[:'):
-                env_marker = line[2:-1]
-                extra = False
-            elif line.startswith('['):
-                env_marker = None
-                extra = True
-            elif not line:
-                env_marker = None
-                extra = False
-            elif env_marker:
-                all_requires.append(line + '; ' + env_marker)
-            elif not extra:
-                all_requires.append(line) 
-        return all_requires
-
-
-    def get_run_requires(proj, args):
-        arg = 'install-requires'
-        requires = getargvalue(arg, args)
-        if requires is not None:
-            print(f"Using run requirements from --{arg} command line argument")
-            return split(requires)
-        requires = get_setup_cfg_entry(proj, "dist_conda", "setup_requires")
-        if requires is not None:
-            print("Using run requirements from [dist_conda]/setup_requires")
-            return requires
-        with tempfile.TemporaryDirectory(prefix='egg-info-tempdir-') as tempdir:
-            get_output(
-                [
-                    sys.executable,
-                    *setup_py(proj),
-                    'egg_info',
-                    '--egg-base',
-                    tempdir,
-                ],
-                cwd=str(proj),
-            )
-            egg_info = [
-                f
-                for f in Path(tempdir).iterdir()
-                if f.name.endswith('.egg-info') and f.is_dir()
-            ]
-            if not egg_info:
-                msg = "no .egg-info directory after running setup.py egg_info"
-                raise RuntimeError(msg)
-            if len(egg_info) > 1:
-                msg = "multiple .egg-info directories after running setup.py egg_info"
-                raise RuntimeError(msg)
-            requires_file = Path(egg_info[0], 'requires.txt')
-            if requires_file.exists():
-                requires = parse_egg_info_requires(requires_file.read_text())
-            else:
-                requires = []
-        # Ignore extras sections:
-        for i, item in enumerate(requires):
-            if not item.strip() or item.startswith('['):
-                requires = requires[:i]
-                break
-        if requires:
-            print("Using run requirements from egg_info")
-            return requires
-        print("No run requirements")
-        return []
-
-    def get_channels(proj, args):
-        arg = 'channels'
-        chans = getargvalue(arg, args)
-        if chans is not None:
-            print(f"Using extra channels from --{arg} command line argument")
-            return split(chans)
-        channels = get_pyproject_toml_entry(proj, "tool", "setuptools_conda", "channels")
-        if channels is not None:
-            print(
-                "Using extra channels from pyproject.toml [tool.setuptools_conda]/channels"
-            )
-            return channels
-        channels = get_setup_cfg_entry(proj, "dist_conda", "channels")
-        if channels is not None:
-            print("Using extra channels from setup.cfg [dist_conda]/channels")
-            return channels
-        print("No extra channels")
-        return []
-
-    def get_name_differences(proj, args):
-        arg = 'conda-name-differences'
-        name_differences = getargvalue(arg, args)
-        if name_differences is not None:
-            print(f"Using name differences from --{arg} command line argument")
-            return dict(split(item, ':') for item in split(name_differences))
-        name_differences = get_pyproject_toml_entry(
-            proj, "tool", "setuptools_conda", "conda_name_differences"
-        )
-        if name_differences is not None:
-            print(
-                "Using name differences from pyproject.toml [tool.setuptools_conda]/conda_name_differences"
-            )
-            return name_differences
-        name_differences = get_setup_cfg_entry(
-            proj, "dist_conda", "conda_name_differences"
-        )
-        if name_differences is not None:
-            print(
-                "Using name differences from setup.cfg [dist_conda]/conda_name_differences"
-            )
-            return dict(split(item, ':') for item in name_differences)
-        print("No name differences")
-        return {}
-
-    def remove_projects(requirements, projects):
-        """Remove any requirements on the given projects from the given requirements
-        list, modifying it in-place."""
-        splitchars = ' <>=!'
-        for requirement in requirements[:]:
-            name = requirement
-            for char in splitchars:
-                name = name.split(char, 1)[0]
-            if name in projects:
-                print(f'Ignoring requirement {requirement}')
-                requirements.remove(requirement)
+    def get_overrides(args):
+        """Return a dict of the overrides for requirements, channels and name
+        differences given on the command line, for passing to the functions in
+        setuptools_conda.api as options"""
+        overrides = {}
+        for argname in [
+            'setup-requires',
+            'install-requires',
+            'conda-name-differences',
+            'conda-name-database',
+            'channels',
+        ]:
+            value = getargvalue(argname, args)
+            if value is not None:
+                overrides[argname] = value
+        return overrides
 
     # For the build command we'll parse setup_args and project_path ourselves, in order
     # to workaround https://bugs.python.org/issue9334:
@@ -384,6 +825,12 @@ def main():
         # Otherwise we parse normally
         args = parser.parse_args()
 
+    # If a server is running, have it run the command instead:
+    if CMD in server.SERVER_COMMANDS:
+        rc = server.forward(sys.argv[1:])
+        if rc is not None:
+            sys.exit(rc)
+
     # Bootstrap up our own requirements just to run the functions for getting
     # requirements:
     need = ["setuptools", "toml", "distlib"]
@@ -396,48 +843,310 @@ def main():
     if need:
         run_conda_cmd(['conda', 'install', '-y'] + need)
 
+    if CMD == 'serve':
+        server.serve(args.socket)
+        return
+
     from setuptools_conda.setuptools_conda import (
-        get_pyproject_toml_entry,
-        get_setup_cfg_entry,
-        evaluate_requirements,
-        condify_requirement,
+        current_subdir,
+        merge_requirements,
         split,
         setup_py,
+        exec_setup_py,
+        publish_packages,
+        package_record,
+        update_repodata,
         run,
     )
+    from setuptools_conda import api
 
-    all_build_requires = []
-    project_names = []
+    def merge(requirements):
+        """Merge requirements with merge_requirements(), exiting with an error message
+        if they conflict"""
+        try:
+            return merge_requirements(requirements)
+        except ValueError as e:
+            raise SystemExit(str(e))
 
     additional_args = setup_args if CMD == 'build' else args
+    options = get_overrides(additional_args)
 
-    print("\nGetting build requirements...")
-    # Get all build requires:
-    channels = []
-    for project_path in args.projects:
-        proj = Path(project_path)
-        build_requires = get_build_requires(proj, additional_args)
-        name_differences = get_name_differences(proj, additional_args)
-        build_requires = [
-            condify_requirement(s, name_differences)
-            for s in evaluate_requirements(build_requires)
-        ]
-        all_build_requires.extend(build_requires)
-        channels += get_channels(proj, additional_args)
-    chan_args = []
-    for chan in set(channels):
-        chan_args += ['--channel', chan]
-
-    # Remove duplicates:
-    all_build_requires = list(set(all_build_requires))
-
-    # Install them:
-    if all_build_requires:
-        run_conda_cmd(['conda', 'install', '-y'] + chan_args + all_build_requires)
+    if CMD in ['check', 'build', 'build-multi', 'install-requirements']:
+        egg_info = CMD == 'check' and args.egg_info
+        problems = api.check_requirements(args.projects, options, egg_info=egg_info)
+        if problems:
+            print("\nProblems found with requirements:", file=sys.stderr)
+            for problem in problems:
+                print(f"    {problem}", file=sys.stderr)
+            sys.exit(1)
+        if CMD == 'check':
+            print("\nNo problems found")
+            return
+
+    if CMD == 'merge':
+        try:
+            copied = api.merge_shards(args.shard_dirs, args.output)
+        except (ValueError, RuntimeError) as e:
+            raise SystemExit(str(e))
+        print(f"\nMerged {len(copied)} packages into {args.output}")
+        return
+
+    if CMD == 'gc':
+        gc_options = {
+            'keep_last': args.keep_last,
+            'max_size': args.max_size,
+            'max_age': args.max_age,
+        }
+        try:
+            result = api.collect_garbage(
+                args.projects, gc_options, dry_run=args.dry_run
+            )
+        except ValueError as e:
+            raise SystemExit(str(e))
+        verb = "Would remove" if args.dry_run else "Removed"
+        print(
+            f"\n{verb} {len(result.packages)} packages and "
+            f"{len(result.directories)} directories"
+        )
+        return
+
+    if CMD == 'requirements-matrix':
+        if args.platforms is not None:
+            platforms = split(args.platforms)
+        else:
+            platforms = [current_subdir()]
+        if args.pythons is not None:
+            pythons = split(args.pythons)
+        else:
+            pythons = [f'{sys.version_info.major}.{sys.version_info.minor}']
+        targets = [(subdir, python) for subdir in platforms for python in pythons]
+        try:
+            results = api.requirements_matrix(args.projects, targets, options)
+        except ValueError as e:
+            raise SystemExit(str(e))
+
+        print()
+        for result in results:
+            print(f"{result['platform']} python {result['python']}:")
+            print("    build:", ', '.join(result['build_requires']) or '(none)')
+            print("    run:", ', '.join(result['run_requires']) or '(none)')
+        if args.output is not None:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=4)
+            print(f"\nWrote {args.output}")
+        return
+
+    if CMD == 'mirror':
+        if args.pythons is not None:
+            pythons = split(args.pythons)
+        else:
+            pythons = [f'{sys.version_info.major}.{sys.version_info.minor}']
+        subdir = current_subdir()
+        try:
+            results = api.requirements_matrix(
+                args.projects, [(subdir, python) for python in pythons], options
+            )
+        except ValueError as e:
+            raise SystemExit(str(e))
+        channels = []
+        for project_path in args.projects:
+            channels += api.get_channels(Path(project_path), options.get('channels'))
+        chan_args = []
+        for chan in dict.fromkeys(channels):
+            chan_args += ['--channel', chan]
+
+        try:
+            build_env_requires = api.get_build_env_requires(
+                args.projects, subdir, options
+            )
+        except (ValueError, RuntimeError) as e:
+            raise SystemExit(str(e))
+        # Specs for each environment conda-build creates: a host environment per Python
+        # version, and if compilers are needed, a build environment:
+        environments = {}
+        for result in results:
+            specs = [f"python={result['python']}", 'pip', 'setuptools', 'wheel']
+            specs += merge(result['build_requires'] + result['run_requires'])
+            environments[f"host-py{result['python']}"] = specs
+        if build_env_requires:
+            environments['build'] = build_env_requires
+
+        print("\nResolving packages...")
+        dist_names = set()
+        with tempfile.TemporaryDirectory(prefix='setuptools-conda-mirror-') as tempdir:
+            for env_name, specs in environments.items():
+                # conda-build creates the environment from scratch, so resolve for an
+                # empty prefix rather than the current environment:
+                cmd = ['conda', 'create', '--json', '-y', '-p']
+                cmd += [str(Path(tempdir, env_name))] + chan_args + specs
+                try:
+                    solution = json.loads(api.get_output(cmd + ['--dry-run']))
+                except CalledProcessError as e:
+                    # With --json, conda reports the solver's error on stdout:
+                    try:
+                        solution = json.loads(e.output or '')
+                    except ValueError:
+                        solution = {}
+                    msg = solution.get('message') or solution.get('error')
+                    raise SystemExit(msg or f"conda create failed for {env_name}")
+                if not solution.get('success', True):
+                    raise SystemExit(solution.get('message', 'conda create failed'))
+                actions = solution.get('actions', {})
+                if actions.get('FETCH'):
+                    run_conda_cmd(cmd + ['--download-only'])
+                dist_names.update(pkg['dist_name'] for pkg in actions.get('LINK', []))
+
+        info = json.loads(api.get_output(['conda', 'info', '--json']))
+        pkgs_dirs = info['pkgs_dirs']
+        by_subdir = {}
+        for dist_name in sorted(dist_names):
+            for pkgs_dir in pkgs_dirs:
+                index_json = Path(pkgs_dir, dist_name, 'info', 'index.json')
+                pkg_files = [
+                    Path(pkgs_dir, dist_name + ext) for ext in ['.conda', '.tar.bz2']
+                ]
+                pkg_files = [path for path in pkg_files if path.exists()]
+                if index_json.exists() and pkg_files:
+                    index = json.loads(index_json.read_text())
+                    by_subdir.setdefault(index['subdir'], []).append(
+                        (pkg_files[0], index)
+                    )
+                    break
+            else:
+                raise SystemExit(f"{dist_name} not found in package cache")
+
+        print(f"\nCopying packages to {args.output}...")
+        for pkg_subdir, pkgs in by_subdir.items():
+            records = {
+                pkg.name: package_record(str(pkg), index) for pkg, index in pkgs
+            }
+            publish_packages([str(pkg) for pkg, _ in pkgs], args.output, pkg_subdir)
+            update_repodata(args.output, pkg_subdir, records)
+        n_pkgs = sum(len(pkgs) for pkgs in by_subdir.values())
+        print(f"\nMirrored {n_pkgs} packages to {args.output}")
+        return
+
+    if CMD == 'provision':
+        if args.pythons is not None:
+            pythons = split(args.pythons)
+        else:
+            pythons = [f'{sys.version_info.major}.{sys.version_info.minor}']
+        try:
+            targets = [(current_subdir(), python) for python in pythons]
+            results = api.requirements_matrix(args.projects, targets, options)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        channels = []
+        for project_path in args.projects:
+            channels += api.get_channels(Path(project_path), options.get('channels'))
+        chan_args = []
+        for chan in dict.fromkeys(channels):
+            chan_args += ['--channel', chan]
+
+        def read_stamp(prefix):
+            try:
+                return json.loads(Path(prefix, *PROVISION_STAMP).read_text())
+            except (OSError, ValueError):
+                return None
+
+        to_create = []
+        stamps = {}
+        for result in results:
+            python = result['python']
+            prefix = os.path.join(args.prefix_dir, f'py{python}')
+            specs = [f'python={python}', 'pip']
+            specs += merge(result['build_requires'] + result['run_requires'])
+            stamp = {'specs': specs, 'channels': list(dict.fromkeys(channels))}
+            if read_stamp(prefix) == stamp:
+                print(f"Reusing existing environment {prefix}")
+                continue
+            shutil.rmtree(prefix, ignore_errors=True)
+            stamps[prefix] = stamp
+            to_create.append((prefix, specs))
+
+        # Download packages first, one environment at a time, so that concurrent conda
+        # processes are not writing to the package cache at the same time:
+        if to_create:
+            print("\nDownloading packages...")
+        for prefix, specs in to_create:
+            cmd = ['conda', 'create', '-y', '--download-only', '-p', prefix]
+            run_conda_cmd(cmd + chan_args + specs)
+
+        # Then create the environments concurrently, linking packages from the cache:
+        jobs = []
+        for prefix, specs in to_create:
+            cmd = ['conda', 'create', '-y', '--offline', '-p', prefix]
+            jobs.append(
+                runner.Job(
+                    cmd + chan_args + specs,
+                    name=os.path.basename(prefix),
+                    shell=WINDOWS,
+                )
+            )
+        if jobs:
+            print("\nCreating environments...")
+            try:
+                runner.run_jobs(jobs)
+            except CalledProcessError as e:
+                sys.exit(e.returncode)
+
+        for prefix, stamp in stamps.items():
+            Path(prefix, *PROVISION_STAMP).write_text(json.dumps(stamp, indent=4))
+        print("\nEnvironments:")
+        for result in results:
+            print(f"    {os.path.join(args.prefix_dir, 'py' + result['python'])}")
+        return
+
+    if CMD == 'build-multi':
+        build_options = {}
+        for name in [
+            'pythons',
+            'build_number',
+            'conda_name_differences',
+            'conda_name_database',
+            'channels',
+            'shard',
+        ]:
+            if getattr(args, name) is not None:
+                build_options[name] = getattr(args, name)
+        if args.noarch:
+            build_options['noarch'] = True
+        try:
+            api.install_build_requirements(args.projects, options)
+            results = api.build_multi(
+                args.projects,
+                build_options,
+                install_build_requires=False,
+                name=args.name,
+                build_dir=args.build_dir,
+                dist_dir=args.output_dir,
+            )
+        except CalledProcessError as e:
+            sys.exit(e.returncode)
+        except api.BuildError as e:
+            print(e, file=sys.stderr)
+            sys.exit(e.returncode)
+        except ValueError as e:
+            raise SystemExit(str(e))
+        print()
+        for result in results:
+            print(f"{result.project}:", ', '.join(result.artifacts) or '(no packages)')
+        return
 
     if CMD == 'build':
+        try:
+            api.install_build_requirements(args.projects, options)
+        except CalledProcessError as e:
+            sys.exit(e.returncode)
+        except ValueError as e:
+            raise SystemExit(str(e))
+
         print("\nBuilding...")
         proj = Path(args.projects[0])
+        if server.in_job() and not server.environment_changed():
+            # setuptools is already imported, run setup.py in this process:
+            exec_setup_py(proj, ['dist_conda'] + setup_args)
+            sys.exit(0)
         sys.exit(
             run(
                 [sys.executable, *setup_py(proj), 'dist_conda'] + setup_args,
@@ -445,31 +1154,12 @@ def main():
             )
         )
 
-    print("\nGetting run requirements...")
-    all_run_requires = []
-    project_names = []
-    for project_path in args.projects:
-        proj = Path(project_path)
-        project_name = get_project_name(proj)
-        project_names.append(project_name)
-        name_differences = get_name_differences(proj, additional_args)
-        run_requires = get_run_requires(proj, additional_args)
-        run_requires = [
-            condify_requirement(s, name_differences)
-            for s in evaluate_requirements(run_requires)
-        ]
-        all_run_requires.extend(run_requires)
-
-    # Remove exact duplicates:
-    all_run_requires = list(set(all_run_requires))
-
-    # Remove any projects we're installing requirements *for* from the list of
-    # requirements to install:
-    remove_projects(all_run_requires, project_names)
-
-    # Install them:
-    if all_run_requires:
-        run_conda_cmd(['conda', 'install', '-y'] + all_run_requires)
+    try:
+        api.install_requirements(args.projects, options)
+    except api.BuildError as e:
+        sys.exit(e.returncode)
+    except ValueError as e:
+        raise SystemExit(str(e))
 
 
 if __name__ == '__main__':
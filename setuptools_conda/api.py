@@ -0,0 +1,988 @@
+"""Python API for building conda packages and installing requirements, for use by
+programs that want to handle many projects from a single interpreter rather than
+running a setuptools-conda process for each operation.
+
+Functions here take options as a dict, using the same names as the command line
+arguments of the corresponding setuptools-conda commands and the options of the
+dist_conda command (with either hyphens or underscores), return structured results,
+and raise exceptions on failure rather than exiting. Builds run setup.py in the calling
+process, so the working directory is changed for their duration - they are not
+thread-safe."""
+
+import sys
+import os
+import time
+import shutil
+import hashlib
+import filecmp
+import tempfile
+import contextlib
+import configparser
+from dataclasses import dataclass, field
+from pathlib import Path
+from subprocess import CalledProcessError
+from typing import Dict, List, Optional
+
+from setuptools_conda import runner
+from setuptools_conda.setuptools_conda import (
+    WINDOWS,
+    _SETUP_PY_STUB,
+    dist_conda,
+    multi_output_details,
+    write_build_config,
+    resolve_compiler,
+    built_packages,
+    publish_packages,
+    index_subdir,
+    parse_shard,
+    shard_entries,
+    shard_dist_dir,
+    collect_package_garbage,
+    collect_build_garbage,
+    collect_test_env_garbage,
+    parse_size,
+    user_cache_dir,
+    split_package_filename,
+    current_subdir,
+    yaml_lines,
+    run_conda_build,
+    get_pyproject_toml_entry,
+    get_setup_cfg_entry,
+    evaluate_requirements,
+    evaluate_requirements_matrix,
+    target_environment,
+    condify_requirement,
+    condify_name,
+    name_mapping,
+    parse_name_differences,
+    NAME_DATABASE_ENV_VAR,
+    split_requirement,
+    requirement_errors,
+    merge_requirements,
+    split,
+    setup_py,
+)
+
+
+class BuildError(RuntimeError):
+    """Raised when building a package or installing requirements fails. returncode is
+    the exit status of the command that failed."""
+
+    def __init__(self, msg, returncode=1):
+        super().__init__(msg)
+        self.returncode = returncode
+
+
+@dataclass
+class BuildResult:
+    """Result of build()"""
+
+    project: str
+    # Paths of the conda packages built, in the output directory:
+    artifacts: List[str]
+    # Build requirements installed in the current environment before building:
+    build_requires: List[str]
+    # Time taken in seconds by each phase:
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class RequirementsResult:
+    """Result of install_requirements()"""
+
+    projects: List[str]
+    # conda specs installed:
+    build_requires: List[str]
+    run_requires: List[str]
+    # Time taken in seconds by each phase:
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+@dataclass
+class RequirementProblem:
+    """A problem found by check_requirements()"""
+
+    project: str
+    # Where the requirement was found, e.g. 'pyproject.toml [build-system]/requires':
+    source: str
+    # The requirement, or None if the problem is with the source as a whole:
+    requirement: Optional[str]
+    message: str
+
+    def __str__(self):
+        if self.requirement is None:
+            return f"{self.project}: {self.source}: {self.message}"
+        return f"{self.project}: {self.source}: {self.requirement!r}: {self.message}"
+
+
+@dataclass
+class GarbageCollectionResult:
+    """Result of collect_garbage()"""
+
+    projects: List[str]
+    # Paths of the packages removed from the projects' output directories:
+    packages: List[str]
+    # Paths of build job directories, croots, wheel caches and test environments
+    # removed:
+    directories: List[str]
+
+
+# Default age in days of the last use of a test environment, fast-mode croot or cached
+# wheel after which collect_garbage() removes it:
+DEFAULT_MAX_AGE = 30
+
+
+def _normalise_options(options):
+    return {key.replace('-', '_'): value for key, value in (options or {}).items()}
+
+
+@contextlib.contextmanager
+def _timed(timings, phase):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        timings[phase] = time.monotonic() - start
+
+
+def conda(cmd, **kwargs):
+    """Run a conda command with the runner, passing it any keyword arguments. Raises
+    subprocess.CalledProcessError on failure."""
+    # Shell=True is necessary on Windows for calls to conda, otherwise we get
+    # mysterious breakage. But shell=True with a list of args totally changes this
+    # function on unix so we avoid it:
+    return runner.run(cmd, shell=WINDOWS, **kwargs)
+
+
+def get_output(cmd, **kwargs):
+    return runner.run(cmd, shell=WINDOWS, capture=True, **kwargs).strip()
+
+
+def get_project_name(proj):
+    return get_output([sys.executable, *setup_py(proj), '--name'], cwd=str(proj))
+
+
+def get_build_requires(proj, setup_requires=None):
+    """Return the build requirements of the project, which are setup_requires if given,
+    as a list or comma-separated string, otherwise as found in the project's
+    configuration"""
+    if setup_requires is not None:
+        print("Using build requirements from --setup-requires override")
+        if isinstance(setup_requires, str):
+            return split(setup_requires)
+        return setup_requires
+    requires = get_setup_cfg_entry(proj, "dist_conda", "setup_requires")
+    if requires is not None:
+        print("Using build requirements from setup.cfg [dist_conda]/setup_requires")
+        return requires
+    requires = get_pyproject_toml_entry(proj, 'build-system', 'requires')
+    if requires is not None:
+        print("Using build requirements from pyproject.toml [build-system]/requires")
+        return requires
+    requires = get_setup_cfg_entry(proj, "options", "setup_requires")
+    if requires is not None:
+        print("Using build requirements from [options]/setup_requires")
+        return requires
+    print("No build requirements")
+    return []
+
+
+def parse_egg_info_requires(egg_info_requires):
+    """Given the contents of an egg-info requires.txt, determine requirements with
+    environmnent markers, and return a list of all requirements with any environment
+    markers suffixed after a semicolon as per PEP 508. Ignore extras-require"""
+    all_requires = []
+
+    env_marker = None
+    extra = False
+    for line in egg_info_requires.splitlines():
+        line = line.strip()
+        if line.startswith('[:'):
+            env_marker = line[2:-1]
+            extra = False
+        elif line.startswith('['):
+            env_marker = None
+            extra = True
+        elif not line:
+            env_marker = None
+            extra = False
+        elif env_marker:
+            all_requires.append(line + '; ' + env_marker)
+        elif not extra:
+            all_requires.append(line)
+    return all_requires
+
+
+def get_run_requires(proj, install_requires=None):
+    """Return the run requirements of the project, which are install_requires if given,
+    as a list or comma-separated string, otherwise as found in the project's
+    configuration or by running setup.py egg_info"""
+    if install_requires is not None:
+        print("Using run requirements from --install-requires override")
+        if isinstance(install_requires, str):
+            return split(install_requires)
+        return install_requires
+    requires = get_setup_cfg_entry(proj, "dist_conda", "setup_requires")
+    if requires is not None:
+        print("Using run requirements from [dist_conda]/setup_requires")
+        return requires
+    requires = get_egg_info_requires(proj)
+    # Ignore extras sections:
+    for i, item in enumerate(requires):
+        if not item.strip() or item.startswith('['):
+            requires = requires[:i]
+            break
+    if requires:
+        print("Using run requirements from egg_info")
+        return requires
+    print("No run requirements")
+    return []
+
+
+def get_egg_info_requires(proj):
+    """Return the run requirements of the project as listed in its egg-info
+    requires.txt, by running setup.py egg_info"""
+    with tempfile.TemporaryDirectory(prefix='egg-info-tempdir-') as tempdir:
+        get_output(
+            [
+                sys.executable,
+                *setup_py(proj),
+                'egg_info',
+                '--egg-base',
+                tempdir,
+            ],
+            cwd=str(proj),
+        )
+        egg_info = [
+            f
+            for f in Path(tempdir).iterdir()
+            if f.name.endswith('.egg-info') and f.is_dir()
+        ]
+        if not egg_info:
+            msg = "no .egg-info directory after running setup.py egg_info"
+            raise RuntimeError(msg)
+        if len(egg_info) > 1:
+            msg = "multiple .egg-info directories after running setup.py egg_info"
+            raise RuntimeError(msg)
+        requires_file = Path(egg_info[0], 'requires.txt')
+        if requires_file.exists():
+            return parse_egg_info_requires(requires_file.read_text())
+        return []
+
+
+def get_channels(proj, channels=None):
+    """Return the extra channels for the project, which are channels if given, as a list
+    or comma-separated string, otherwise as found in the project's configuration"""
+    if channels is not None:
+        print("Using extra channels from --channels override")
+        return split(channels) if isinstance(channels, str) else channels
+    channels = get_pyproject_toml_entry(proj, "tool", "setuptools_conda", "channels")
+    if channels is not None:
+        print(
+            "Using extra channels from pyproject.toml [tool.setuptools_conda]/channels"
+        )
+        return channels
+    channels = get_setup_cfg_entry(proj, "dist_conda", "channels")
+    if channels is not None:
+        print("Using extra channels from setup.cfg [dist_conda]/channels")
+        return channels
+    print("No extra channels")
+    return []
+
+
+def get_name_database(proj, name_database=None):
+    """Return the path of the PyPI:conda name database for the project, which is
+    name_database if given, otherwise as found in the project's configuration relative
+    to the project directory, otherwise the value of the SETUPTOOLS_CONDA_NAME_DATABASE
+    environment variable, or None if there is none."""
+    if name_database is not None:
+        print("Using name database from --conda-name-database override")
+        return name_database
+    name_database = get_pyproject_toml_entry(
+        proj, "tool", "setuptools_conda", "conda_name_database"
+    )
+    if name_database is not None:
+        print(
+            "Using name database from pyproject.toml "
+            "[tool.setuptools_conda]/conda_name_database"
+        )
+        return str(Path(proj, name_database))
+    name_database = get_setup_cfg_entry(
+        proj, "dist_conda", "conda_name_database", is_list=False
+    )
+    if name_database is not None:
+        print("Using name database from setup.cfg [dist_conda]/conda_name_database")
+        return str(Path(proj, name_database))
+    name_database = os.getenv(NAME_DATABASE_ENV_VAR) or None
+    if name_database is not None:
+        print(f"Using name database from {NAME_DATABASE_ENV_VAR}")
+    return name_database
+
+
+def get_name_differences(proj, name_differences=None, name_database=None):
+    """Return the PyPI:conda name differences for the project, as a dict mapping
+    normalised PyPI names to conda names. These are name_differences if given, as a dict
+    or string of comma-separated colon-separated names, otherwise as found in the
+    project's configuration, merged on top of the entries in the project's name
+    database as returned by get_name_database(proj, name_database)."""
+    database = get_name_database(proj, name_database)
+    return name_mapping(_get_name_differences(proj, name_differences), database)
+
+
+def _get_name_differences(proj, name_differences):
+    if name_differences is not None:
+        print("Using name differences from --conda-name-differences override")
+        if isinstance(name_differences, str):
+            return parse_name_differences(split(name_differences))
+        return name_differences
+    name_differences = get_pyproject_toml_entry(
+        proj, "tool", "setuptools_conda", "conda_name_differences"
+    )
+    if name_differences is not None:
+        print(
+            "Using name differences from pyproject.toml "
+            "[tool.setuptools_conda]/conda_name_differences"
+        )
+        return name_differences
+    name_differences = get_setup_cfg_entry(proj, "dist_conda", "conda_name_differences")
+    if name_differences is not None:
+        print(
+            "Using name differences from setup.cfg [dist_conda]/conda_name_differences"
+        )
+        return parse_name_differences(name_differences)
+    print("No name differences")
+    return {}
+
+
+def _setup_cfg_lines(proj, section, key):
+    # A newline-separated list in setup.cfg, as setuptools reads [options] lists:
+    value = get_setup_cfg_entry(proj, section, key, is_list=False)
+    if value is None:
+        return None
+    return [line.strip() for line in value.splitlines() if line.strip()]
+
+
+def _pyproject_list(proj, *keys):
+    value = get_pyproject_toml_entry(proj, *keys)
+    return split(value) if isinstance(value, str) else value
+
+
+def _requirement_sources(proj, options, egg_info):
+    # Return a list of (source, getter) for every place requirements for the project may
+    # be configured, where getter() returns a list of requirements, or None if there are
+    # none there. Getters are called one at a time so that errors reading one source
+    # can be reported without affecting the others.
+    sources = []
+    for key in ['setup_requires', 'install_requires']:
+        if options.get(key) is not None:
+            value = options[key]
+            if isinstance(value, str):
+                value = split(value)
+            sources.append(('--' + key.replace('_', '-'), lambda value=value: value))
+    sources += [
+        (
+            'setup.cfg [dist_conda]/setup_requires',
+            lambda: get_setup_cfg_entry(proj, 'dist_conda', 'setup_requires'),
+        ),
+        (
+            'setup.cfg [dist_conda]/install_requires',
+            lambda: get_setup_cfg_entry(proj, 'dist_conda', 'install_requires'),
+        ),
+        (
+            'setup.cfg [options]/setup_requires',
+            lambda: _setup_cfg_lines(proj, 'options', 'setup_requires'),
+        ),
+        (
+            'setup.cfg [options]/install_requires',
+            lambda: _setup_cfg_lines(proj, 'options', 'install_requires'),
+        ),
+        (
+            'pyproject.toml [build-system]/requires',
+            lambda: _pyproject_list(proj, 'build-system', 'requires'),
+        ),
+        (
+            'pyproject.toml [project]/dependencies',
+            lambda: _pyproject_list(proj, 'project', 'dependencies'),
+        ),
+        (
+            'pyproject.toml [tool.setuptools_conda]/setup_requires',
+            lambda: _pyproject_list(proj, 'tool', 'setuptools_conda', 'setup_requires'),
+        ),
+        (
+            'pyproject.toml [tool.setuptools_conda]/install_requires',
+            lambda: _pyproject_list(
+                proj, 'tool', 'setuptools_conda', 'install_requires'
+            ),
+        ),
+    ]
+    if egg_info:
+        sources.append(('egg_info requires.txt', lambda: get_egg_info_requires(proj)))
+    return sources
+
+
+def check_requirements(projects, options=None, egg_info=False):
+    """Check every requirement of the given projects, in every place they may be
+    configured and in any overrides in options, and return a list of
+    RequirementProblems for those that can't be converted to conda requirements,
+    empty if there are none. Only reads configuration files unless egg_info is True, in
+    which case requirements in setup.py are also checked by running setup.py egg_info.
+    options may contain overrides for setup_requires, install_requires,
+    conda_name_differences and conda_name_database."""
+    options = _normalise_options(options)
+    problems = []
+    for project_path in projects:
+        proj = Path(project_path)
+        try:
+            name_differences = get_name_differences(
+                proj,
+                options.get('conda_name_differences'),
+                options.get('conda_name_database'),
+            )
+        except (OSError, ValueError, TypeError, configparser.Error) as e:
+            problems.append(
+                RequirementProblem(str(proj), 'conda name differences', None, str(e))
+            )
+            name_differences = {}
+        for source, getter in _requirement_sources(proj, options, egg_info):
+            try:
+                requirements = getter()
+            except (OSError, ValueError, configparser.Error) as e:
+                problems.append(RequirementProblem(str(proj), source, None, str(e)))
+                continue
+            except CalledProcessError as e:
+                msg = f"Command failed: {e.cmd}"
+                problems.append(RequirementProblem(str(proj), source, None, msg))
+                continue
+            for requirement in requirements or []:
+                if not isinstance(requirement, str):
+                    msg = f"requirement must be a string, not {requirement!r}"
+                    problems.append(RequirementProblem(str(proj), source, None, msg))
+                    continue
+                for error in requirement_errors(requirement, name_differences):
+                    problems.append(
+                        RequirementProblem(str(proj), source, requirement, error)
+                    )
+    return problems
+
+
+def remove_projects(requirements, projects):
+    """Remove any requirements on the given projects (given by their conda names)
+    from the given requirements list, modifying it in-place."""
+    for requirement in requirements[:]:
+        name, _, _ = split_requirement(requirement)
+        if condify_name(name) in projects:
+            print(f'Ignoring requirement {requirement}')
+            requirements.remove(requirement)
+
+
+def requirements_matrix(projects, targets, options=None):
+    """Return a list of dicts with the merged build and run requirements of the given
+    projects for each of the given (platform, python) targets. options may contain
+    overrides for setup_requires, install_requires and conda_name_differences."""
+    options = _normalise_options(options)
+    environments = [target_environment(*target) for target in targets]
+    print("\nGetting requirements...")
+    build_matrix = [[] for _ in targets]
+    run_matrix = [[] for _ in targets]
+    project_names = []
+    for project_path in projects:
+        proj = Path(project_path)
+        name_differences = get_name_differences(
+            proj,
+            options.get('conda_name_differences'),
+            options.get('conda_name_database'),
+        )
+        project_names.append(condify_name(get_project_name(proj), name_differences))
+        for matrix, requires in [
+            (build_matrix, get_build_requires(proj, options.get('setup_requires'))),
+            (run_matrix, get_run_requires(proj, options.get('install_requires'))),
+        ]:
+            evaluated = evaluate_requirements_matrix(requires, environments)
+            for target_requires, requirements in zip(matrix, evaluated):
+                target_requires.extend(
+                    condify_requirement(s, name_differences) for s in requirements
+                )
+
+    results = []
+    for (subdir, python), build_requires, run_requires in zip(
+        targets, build_matrix, run_matrix
+    ):
+        remove_projects(run_requires, project_names)
+        results.append(
+            {
+                'platform': subdir,
+                'python': python,
+                'build_requires': merge_requirements(build_requires),
+                'run_requires': merge_requirements(run_requires),
+            }
+        )
+    return results
+
+
+def get_build_env_requires(projects, subdir, options=None):
+    """Return the requirements of conda-build's build environment, as opposed to its
+    host environment, when building the given projects for the given subdir, as conda
+    specs: the compilers for projects with extension modules, resolved to concrete
+    package names with resolve_compiler(), and any compiler cache tool. options are
+    dist_conda options as for build(). Runs each project's setup.py in this process as
+    far as reading its configuration."""
+    options = _normalise_options(options)
+    requires = []
+    for project in projects:
+        with _project_dir(project):
+            _, command = _get_command(project, options)
+            command.ensure_finalized()
+            requires += command.build_environment_requires()
+    requires = dict.fromkeys(requires)
+    return [resolve_compiler(requirement, subdir) for requirement in requires]
+
+
+def install_build_requirements(projects, options=None):
+    """Install the build requirements of the given projects into the current
+    environment, and return the list of conda specs installed. options may contain
+    overrides for setup_requires, conda_name_differences and channels. Raises
+    subprocess.CalledProcessError if conda fails and ValueError if the projects'
+    requirements conflict."""
+    options = _normalise_options(options)
+    all_build_requires = []
+    print("\nGetting build requirements...")
+    channels = []
+    for project_path in projects:
+        proj = Path(project_path)
+        build_requires = get_build_requires(proj, options.get('setup_requires'))
+        name_differences = get_name_differences(
+            proj,
+            options.get('conda_name_differences'),
+            options.get('conda_name_database'),
+        )
+        build_requires = [
+            condify_requirement(s, name_differences)
+            for s in evaluate_requirements(build_requires)
+        ]
+        all_build_requires.extend(build_requires)
+        channels += get_channels(proj, options.get('channels'))
+    chan_args = []
+    for chan in set(channels):
+        chan_args += ['--channel', chan]
+
+    # Combine requirements on the same package:
+    all_build_requires = merge_requirements(all_build_requires)
+
+    if all_build_requires:
+        conda(['conda', 'install', '-y'] + chan_args + all_build_requires)
+    return all_build_requires
+
+
+def install_requirements(projects, options=None):
+    """Install the build and run requirements of the given projects into the current
+    environment, excluding any requirements on the projects themselves. options may
+    contain overrides for setup_requires, install_requires, conda_name_differences and
+    channels. Returns a RequirementsResult. Raises BuildError if conda fails and
+    ValueError if the projects' requirements conflict."""
+    options = _normalise_options(options)
+    timings = {}
+    try:
+        with _timed(timings, 'build_requires'):
+            all_build_requires = install_build_requirements(projects, options)
+
+        with _timed(timings, 'run_requires'):
+            print("\nGetting run requirements...")
+            all_run_requires = []
+            project_names = []
+            for project_path in projects:
+                proj = Path(project_path)
+                project_name = get_project_name(proj)
+                name_differences = get_name_differences(
+                    proj,
+                    options.get('conda_name_differences'),
+                    options.get('conda_name_database'),
+                )
+                project_names.append(condify_name(project_name, name_differences))
+                run_requires = get_run_requires(proj, options.get('install_requires'))
+                run_requires = [
+                    condify_requirement(s, name_differences)
+                    for s in evaluate_requirements(run_requires)
+                ]
+                all_run_requires.extend(run_requires)
+
+            # Remove any projects we're installing requirements *for* from the list of
+            # requirements to install:
+            remove_projects(all_run_requires, project_names)
+
+            # Combine requirements on the same package:
+            all_run_requires = merge_requirements(all_run_requires)
+
+            if all_run_requires:
+                conda(['conda', 'install', '-y'] + all_run_requires)
+    except CalledProcessError as e:
+        raise BuildError(f"Command failed: {e.cmd}", e.returncode) from e
+
+    return RequirementsResult(
+        projects=[str(project) for project in projects],
+        build_requires=all_build_requires,
+        run_requires=all_run_requires,
+        timings=timings,
+    )
+
+
+@contextlib.contextmanager
+def _project_dir(project):
+    # Run setup.py-related code in the project directory, with it on sys.path, as it
+    # would be if setup.py were run as a script. Restore everything afterwards.
+    cwd = os.getcwd()
+    saved_argv = sys.argv.copy()
+    saved_path = sys.path.copy()
+    os.chdir(project)
+    sys.path.insert(0, os.getcwd())
+    sys.argv = ['setup.py']
+    try:
+        yield
+    finally:
+        os.chdir(cwd)
+        sys.argv = saved_argv
+        sys.path[:] = saved_path
+
+
+def load_distribution(project):
+    """Run the project's setup.py, or a stub equivalent if it has none, in this process
+    as far as reading its configuration, and return the resulting setuptools
+    Distribution without running any commands. Must be called with the project as the
+    working directory."""
+    import setuptools
+    import distutils.core
+
+    if setup_py('.') == _SETUP_PY_STUB:
+        code = _SETUP_PY_STUB[1]
+    else:
+        with open('setup.py') as f:
+            code = f.read()
+    distutils.core._setup_stop_after = 'config'
+    try:
+        exec(compile(code, 'setup.py', 'exec'), {'__name__': '__main__'})
+    finally:
+        distutils.core._setup_stop_after = None
+    dist = distutils.core._setup_distribution
+    if not isinstance(dist, setuptools.dist.Distribution):
+        raise RuntimeError(f"{project}/setup.py did not call setup()")
+    return dist
+
+
+def _get_command(project, options):
+    # Load the project's Distribution and return it along with its dist_conda command,
+    # with the given options applied but not yet finalized. Must be called with the
+    # project as the working directory.
+    dist = load_distribution(project)
+    dist.cmdclass.setdefault('dist_conda', dist_conda)
+    # Discover packages etc. as setuptools does before running any command:
+    set_defaults = getattr(dist, 'set_defaults', None)
+    if set_defaults is not None:
+        set_defaults()
+    command_options = dist.get_option_dict('dist_conda')
+    for name, value in options.items():
+        command_options[name] = (__name__, value)
+    return dist, dist.get_command_obj('dist_conda')
+
+
+@contextlib.contextmanager
+def _build_errors(description):
+    # Convert failures of commands and attempts to exit into BuildError
+    try:
+        yield
+    except CalledProcessError as e:
+        raise BuildError(f"Command failed: {e.cmd}", e.returncode) from e
+    except SystemExit as e:
+        if isinstance(e.code, int) or e.code is None:
+            raise BuildError(f"{description} failed", e.code or 1) from e
+        raise BuildError(str(e.code)) from e
+
+
+def build(project, options=None, install_build_requires=True):
+    """Build conda packages for the project in the given directory, running the
+    dist_conda command in this process with the given options, e.g. {'pythons':
+    ['3.11', '3.12'], 'noarch': False}. Values are given as they would be in the
+    project's pyproject.toml [tool.setuptools_conda] section. If
+    install_build_requires is True, the project's build requirements are first
+    installed into the current environment, as by 'setuptools-conda build'. Returns a
+    BuildResult. Raises BuildError if the build fails."""
+    options = _normalise_options(options)
+    timings = {}
+    build_requires = []
+    with _build_errors(f"Build of {project}"):
+        if install_build_requires:
+            with _timed(timings, 'build_requires'):
+                build_requires = install_build_requirements([project], options)
+        print("\nBuilding...")
+        with _timed(timings, 'build'), _project_dir(project):
+            dist, command = _get_command(project, options)
+            dist.run_command('dist_conda')
+    timings.update(command.timings)
+    return BuildResult(
+        project=str(project),
+        artifacts=[
+            os.path.abspath(os.path.join(project, path)) for path in command.artifacts
+        ],
+        build_requires=build_requires,
+        timings=timings,
+    )
+
+
+def build_multi(
+    projects,
+    options=None,
+    install_build_requires=True,
+    name='setuptools-conda-outputs',
+    version='0',
+    build_dir='conda_build_multi',
+    dist_dir='conda_packages',
+):
+    """Build conda packages for several projects with a single multi-output conda-build
+    recipe, so that the build environment is created once for all of them rather than
+    once per project. See multi_output_details() for how the recipe is structured.
+    options are dist_conda options applied to every project, as for build(). The
+    recipe, sdists and conda-build's croot are placed in build_dir, and the packages
+    built are copied to dist_dir, both relative to the current working directory. name
+    and version are those of the recipe itself, which does not produce a package of
+    its own. Returns a list of BuildResults, one per project, sharing the same
+    timings. Raises BuildError if the build fails, and ValueError if the projects
+    cannot be built together, for example if some are noarch and others are not. If
+    the 'shard' option is given, only the Python versions assigned to that shard are
+    built, as for dist_conda --shard, with the recipe's name used to assign them, and
+    the packages are copied to the shard's output directory alongside dist_dir
+    instead."""
+    options = _normalise_options(options)
+    timings = {}
+    build_requires = []
+    build_dir = os.path.abspath(build_dir)
+    shard = parse_shard(options['shard']) if options.get('shard') else None
+    dist_dir = os.path.abspath(shard_dist_dir(dist_dir, shard))
+    recipe_dir = os.path.join(build_dir, 'recipe')
+    croot = os.path.join(build_dir, 'conda-bld')
+    with _build_errors("Multi-output build"):
+        if install_build_requires:
+            with _timed(timings, 'build_requires'):
+                build_requires = install_build_requirements(projects, options)
+        shutil.rmtree(build_dir, ignore_errors=True)
+        os.makedirs(recipe_dir)
+
+        outputs = []
+        names = []
+        pythons = None
+        noarch = None
+        channels = []
+        with _timed(timings, 'sdist'):
+            for project in projects:
+                with _project_dir(project):
+                    _, command = _get_command(project, options)
+                    command.ensure_finalized()
+                    if (
+                        command.from_wheel
+                        or command.from_downloaded_wheel
+                        or command.universal_wheel
+                    ):
+                        msg = f"{project}: multi-output builds must build from sdists"
+                        raise ValueError(msg)
+                    if pythons is not None and command.pythons != pythons:
+                        msg = f"""{project}: all projects must be built for the same
+                            Python versions, got {command.pythons} and {pythons}"""
+                        raise ValueError(' '.join(msg.split()))
+                    pythons = command.pythons
+                    if noarch is not None and command.noarch != noarch:
+                        msg = f"""{project}: noarch and platform-specific projects can't
+                            be built together"""
+                        raise ValueError(' '.join(msg.split()))
+                    noarch = command.noarch
+                    channels += command.channels
+                    before = set(os.listdir(build_dir))
+                    with command.setup_py_lock():
+                        command.run_setup_command('sdist', build_dir, formats='gztar')
+                    sdist = [
+                        filename
+                        for filename in set(os.listdir(build_dir)) - before
+                        if filename.endswith('.tar.gz')
+                    ][0]
+                    with open(os.path.join(build_dir, sdist), 'rb') as f:
+                        sha256 = hashlib.sha256(f.read()).hexdigest()
+                    package_details = command.package_details(sdist, sha256)
+                    if command.license_file is not None:
+                        # Prefix with the project name, since each project's license
+                        # file likely has the same name:
+                        license_file = command.NAME + '-'
+                        license_file += os.path.basename(command.license_file)
+                        shutil.copy(
+                            command.license_file, os.path.join(build_dir, license_file)
+                        )
+                        package_details['about']['license_file'] = f'../{license_file}'
+                    outputs.append((package_details, command.installed_files()))
+                    names.append(command.NAME)
+
+        if shard is not None:
+            variants = ['noarch'] if noarch else pythons
+            if not shard_entries(variants, shard, name):
+                print(f"Nothing to build in shard {shard[0]}/{shard[1]}")
+                return [
+                    BuildResult(
+                        project=str(project),
+                        artifacts=[],
+                        build_requires=build_requires,
+                        timings=timings,
+                    )
+                    for project in projects
+                ]
+            if not noarch:
+                pythons = shard_entries(pythons, shard, name)
+
+        write_build_config(recipe_dir, pythons)
+        details = multi_output_details(name, version, outputs)
+        with open(os.path.join(recipe_dir, 'meta.yaml'), 'w') as f:
+            f.write('\n'.join(yaml_lines(details)))
+
+        channel_args = []
+        for chan in dict.fromkeys(channels):
+            channel_args += ['-c', chan]
+        print("\nBuilding...")
+        with _timed(timings, 'conda-build'):
+            run_conda_build(
+                ['--no-test', recipe_dir, '--croot', croot] + channel_args,
+                env=os.environ.copy(),
+            )
+
+        artifacts = {project_name: [] for project_name in names}
+        with _timed(timings, 'publish'):
+            for subdir in [current_subdir(), 'noarch']:
+                pkgs = [
+                    pkg
+                    for pkg in built_packages(croot, subdir)
+                    if split_package_filename(pkg)[0] in artifacts
+                ]
+                for path in publish_packages(pkgs, dist_dir, subdir):
+                    artifacts[split_package_filename(path)[0]].append(path)
+
+    return [
+        BuildResult(
+            project=str(project),
+            artifacts=artifacts[project_name],
+            build_requires=build_requires,
+            timings=timings,
+        )
+        for project, project_name in zip(projects, names)
+    ]
+
+
+def _project_option(proj, key):
+    # The value of a dist_conda option set in the project's configuration, or None
+    value = get_pyproject_toml_entry(proj, "tool", "setuptools_conda", key)
+    if value is None:
+        value = get_setup_cfg_entry(proj, "dist_conda", key, is_list=False)
+    return value
+
+
+def collect_garbage(projects, options=None, dry_run=False):
+    """Apply retention policies to the conda_packages output directories of the given
+    projects with collect_package_garbage(), remove the job directories of parallel
+    builds that are no longer running from their build directories with
+    collect_build_garbage(), and remove test environments not used recently with
+    collect_test_env_garbage(). options may contain 'keep_last' and 'max_size', as for
+    the dist_conda options of the same names, which otherwise are taken from each
+    project's configuration, with no packages removed if neither is set, and
+    'max_age', the age in days after which unused test environments, fast-mode croots
+    and cached wheels are removed, by default DEFAULT_MAX_AGE. Build directories,
+    croots and test environment directories are those in each project's
+    configuration, or the defaults. Compiler caches are not removed, being limited in
+    size by ccache or sccache themselves, and nor is the resource governor's record of
+    reservations, from which each build using it removes those of processes no longer
+    running. If dry_run is True, nothing is removed, and the result lists what would
+    be. Returns a GarbageCollectionResult. Raises ValueError if keep_last is less than
+    1 or max_age is negative."""
+    options = _normalise_options(options)
+    max_age = options.get('max_age')
+    max_age = DEFAULT_MAX_AGE if max_age is None else float(max_age)
+    if max_age < 0:
+        raise ValueError("`max_age` must not be negative")
+    packages = []
+    directories = []
+    test_env_dirs = []
+    for project in projects:
+        print(f"\nCollecting garbage for {project}...")
+        settings = {}
+        for key in ['keep_last', 'max_size', 'build_dir', 'croot', 'test_env_dir']:
+            value = options.get(key)
+            if value is None:
+                value = _project_option(project, key)
+            settings[key] = value
+        keep_last = settings['keep_last']
+        if keep_last is not None:
+            keep_last = int(keep_last)
+            if keep_last < 1:
+                raise ValueError("`keep_last` must be at least 1")
+        max_size = settings['max_size']
+        packages += collect_package_garbage(
+            os.path.join(project, dist_conda.DIST_DIR),
+            keep_last=keep_last,
+            max_size=parse_size(max_size) if max_size is not None else None,
+            dry_run=dry_run,
+        )
+        croot = settings['croot']
+        directories += collect_build_garbage(
+            os.path.join(project, settings['build_dir'] or 'conda_build'),
+            croot=os.path.join(project, croot) if croot is not None else None,
+            wheel_cache_dir=os.path.join(project, dist_conda.WHEEL_CACHE_DIR),
+            max_age=max_age,
+            dry_run=dry_run,
+        )
+        test_env_dir = settings['test_env_dir']
+        if test_env_dir is None:
+            test_env_dir = os.path.join(user_cache_dir(), 'test-envs')
+        test_env_dir = os.path.abspath(os.path.join(project, test_env_dir))
+        if test_env_dir not in test_env_dirs:
+            test_env_dirs.append(test_env_dir)
+    for test_env_dir in test_env_dirs:
+        print(f"\nCollecting garbage in {test_env_dir}...")
+        directories += collect_test_env_garbage(test_env_dir, max_age, dry_run=dry_run)
+    return GarbageCollectionResult(
+        projects=[str(project) for project in projects],
+        packages=packages,
+        directories=directories,
+    )
+
+
+def merge_shards(shard_dirs, dist_dir='conda_packages'):
+    """Combine the output directories of the shards of a build, as made by dist_conda
+    --shard or build_multi() with the 'shard' option, into the output directory
+    dist_dir, copying their packages and any manifests written by --manifest. Then
+    index each subdir of dist_dir that packages were copied to with index_subdir(), so
+    that it has a repodata.json consistent with the packages in it and can be used as a
+    channel. Raises ValueError if two shards, or a shard and dist_dir, contain
+    different packages with the same filename, which means they were not built from the
+    same source and configuration, before copying anything. Returns the paths of the
+    packages copied."""
+    # Paths of the packages to copy to each subdir, by filename:
+    by_subdir = {}
+    for shard_dir in shard_dirs:
+        if not os.path.isdir(shard_dir):
+            raise ValueError(f"{shard_dir}: no such directory")
+        for path in sorted(Path(shard_dir).glob('*/*')):
+            if not path.name.endswith(('.tar.bz2', '.conda')):
+                continue
+            if path.name.startswith('.'):
+                continue
+            pkgs = by_subdir.setdefault(path.parent.name, {})
+            other = pkgs.get(path.name)
+            if other is None:
+                # A package already in dist_dir, e.g. from a previous merge:
+                other = Path(dist_dir, path.parent.name, path.name)
+                if not other.exists():
+                    other = None
+            if other is not None and not filecmp.cmp(other, path, shallow=False):
+                raise ValueError(f"{other} and {path} have the same name but differ")
+            pkgs[path.name] = path
+    copied = []
+    for subdir, pkgs in sorted(by_subdir.items()):
+        paths = [str(path) for path in pkgs.values()]
+        copied += publish_packages(paths, dist_dir, subdir)
+        for path in pkgs.values():
+            manifest = Path(str(path) + '.manifest.json')
+            if manifest.exists():
+                shutil.copyfile(manifest, Path(dist_dir, subdir, manifest.name))
+        print(f"indexing {os.path.join(dist_dir, subdir)}")
+        index_subdir(dist_dir, subdir, refresh=pkgs)
+    return copied
@@ -0,0 +1,271 @@
+"""asyncio-based runner for subprocesses. All commands run by setuptools-conda go
+through here, so that several may run at once with their output streamed line by line,
+each line prefixed with the name of the job it came from, with optional timeouts, and
+with the remaining jobs in a group cancelled as soon as one of them fails.
+
+Instead of printing a command's output, it may be written to a gzip-compressed log
+file, with only a progress line shown on the console and the last few lines of output
+printed if the command fails. Memory use is bounded regardless of how much output there
+is.
+
+Failures raise subprocess.CalledProcessError, and timeouts subprocess.TimeoutExpired,
+rather than exiting the interpreter - it is up to callers to decide what a failure
+means."""
+
+import sys
+import os
+import asyncio
+import collections
+import gzip
+import shlex
+import shutil
+import subprocess
+import time
+
+# How long to give a process to exit after asking it to terminate, before killing it:
+TERMINATE_TIMEOUT = 5
+
+# Number of lines of output printed when a command whose output is being logged fails:
+DEFAULT_TAIL_LINES = 50
+
+# Minimum interval between updates of the progress line for logged commands, when
+# outputting to a terminal and otherwise:
+PROGRESS_INTERVAL_TTY = 0.1
+PROGRESS_INTERVAL = 30
+
+_CHUNK_SIZE = 65536
+
+# Lines longer than this are split, so that a child printing a huge amount of output
+# without newlines can't make us buffer all of it:
+_MAX_LINE_LENGTH = 65536
+
+# Lines kept for printing on failure are truncated to this length:
+_MAX_TAIL_LINE_LENGTH = 4096
+
+
+def _write(outfile, data):
+    # Write bytes to a text stream such as sys.stdout, via its underlying binary buffer
+    # if it has one so that child output is passed through unmodified.
+    outfile.flush()
+    buffer = getattr(outfile, 'buffer', None)
+    if buffer is not None:
+        buffer.write(data)
+        buffer.flush()
+    else:
+        outfile.write(data.decode('utf8', errors='replace'))
+        outfile.flush()
+
+
+async def _pump(stream, write_lines, captured):
+    # Pass a child's output stream to write_lines() a block of complete lines at a time.
+    # Read in chunks rather than with readline() so that arbitrarily long lines don't
+    # exceed the StreamReader's buffer limit. If captured is a list, append the output
+    # to it instead.
+    pending = b''
+    while True:
+        chunk = await stream.read(_CHUNK_SIZE)
+        if not chunk:
+            break
+        if captured is not None:
+            captured.append(chunk)
+            continue
+        *lines, pending = (pending + chunk).split(b'\n')
+        if len(pending) > _MAX_LINE_LENGTH:
+            lines.append(pending)
+            pending = b''
+        if lines:
+            write_lines(lines)
+    if pending:
+        write_lines([pending])
+
+
+class _Log:
+    """Destination for the output of a command that is being logged to file. Writes
+    all lines to a gzip-compressed file, keeps the last few in a ring buffer, and
+    displays a progress line on the console."""
+
+    def __init__(self, path, prefix, tail_lines):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.path = path
+        self.prefix = prefix
+        self.file = gzip.open(path, 'wb')
+        self.tail = collections.deque(maxlen=tail_lines)
+        self.n_lines = 0
+        self.isatty = sys.stdout.isatty()
+        self.interval = PROGRESS_INTERVAL_TTY if self.isatty else PROGRESS_INTERVAL
+        self.last_progress = time.monotonic()
+
+    def write_lines(self, lines):
+        self.file.write(b''.join(line + b'\n' for line in lines))
+        if self.tail.maxlen:
+            for line in lines[-self.tail.maxlen :]:
+                self.tail.append(line[:_MAX_TAIL_LINE_LENGTH])
+        self.n_lines += len(lines)
+        now = time.monotonic()
+        if now - self.last_progress > self.interval:
+            self.last_progress = now
+            self.progress()
+
+    def progress(self, final=False):
+        msg = f'{self.prefix}{self.n_lines} lines of output'
+        if self.isatty:
+            if self.tail and not final:
+                last = self.tail[-1].decode('utf8', errors='replace').strip()
+                msg += ': ' + last
+            width = shutil.get_terminal_size().columns - 1
+            _write(sys.stdout, b'\r' + msg[:width].ljust(width).encode('utf8'))
+            if final:
+                _write(sys.stdout, b'\n')
+        else:
+            print(msg, flush=True)
+
+    def close(self, failed):
+        self.file.close()
+        self.progress(final=True)
+        if failed:
+            msg = f'{self.prefix}command failed, last {len(self.tail)} lines of output'
+            msg += f' (full log in {self.path}):'
+            print(msg, file=sys.stderr, flush=True)
+            prefix = self.prefix.encode('utf8')
+            _write(sys.stderr, b''.join(prefix + line + b'\n' for line in self.tail))
+        else:
+            print(f'{self.prefix}output logged to {self.path}', flush=True)
+
+
+async def _terminate(proc):
+    if proc.returncode is not None:
+        return
+    try:
+        proc.terminate()
+        try:
+            await asyncio.wait_for(proc.wait(), TERMINATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+    except ProcessLookupError:
+        pass
+
+
+class Job:
+    """A command to be run as a subprocess. If name is given, each line of output and
+    the '[running]' message are prefixed with '[name] '. If capture is True, stdout is
+    collected and returned rather than printed (stderr is still printed). shell=True
+    runs the command via the shell, which is required on Windows for calls to conda.
+    If timeout is given and the command does not complete in that many seconds, it is
+    terminated and subprocess.TimeoutExpired raised. If log_file is given, all output
+    other than captured stdout is written to that path gzip-compressed instead of being
+    printed, and if the command fails the last tail_lines lines are printed."""
+
+    def __init__(
+        self,
+        cmd,
+        name=None,
+        cwd=None,
+        env=None,
+        shell=False,
+        timeout=None,
+        capture=False,
+        log_file=None,
+        tail_lines=DEFAULT_TAIL_LINES,
+    ):
+        self.cmd = [str(arg) for arg in cmd]
+        self.name = name
+        self.cwd = cwd
+        self.env = env
+        self.shell = shell
+        self.timeout = timeout
+        self.capture = capture
+        self.log_file = log_file
+        self.tail_lines = tail_lines
+        self.log = None
+
+    @property
+    def prefix(self):
+        return f'[{self.name}] ' if self.name is not None else ''
+
+    def _printer(self, outfile):
+        prefix = self.prefix.encode('utf8')
+
+        def write_lines(lines):
+            _write(outfile, b''.join(prefix + line + b'\n' for line in lines))
+
+        return write_lines
+
+    async def _execute(self, proc, captured):
+        if self.log is not None:
+            write_stdout = write_stderr = self.log.write_lines
+        else:
+            write_stdout = self._printer(sys.stdout)
+            write_stderr = self._printer(sys.stderr)
+        await asyncio.gather(
+            _pump(proc.stdout, write_stdout, captured),
+            _pump(proc.stderr, write_stderr, None),
+        )
+        return await proc.wait()
+
+    async def run(self):
+        """Run the command, returning its captured stdout as a string if capture=True,
+        or otherwise its return code, which will always be zero since failures raise
+        subprocess.CalledProcessError."""
+        print(self.prefix + '[running]:', *[shlex.quote(arg) for arg in self.cmd])
+        kwargs = dict(
+            cwd=self.cwd,
+            env=self.env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        if self.shell:
+            cmdline = subprocess.list2cmdline(self.cmd)
+            proc = await asyncio.create_subprocess_shell(cmdline, **kwargs)
+        else:
+            proc = await asyncio.create_subprocess_exec(*self.cmd, **kwargs)
+        captured = [] if self.capture else None
+        if self.log_file is not None:
+            self.log = _Log(self.log_file, self.prefix, self.tail_lines)
+        rc = None
+        try:
+            rc = await asyncio.wait_for(self._execute(proc, captured), self.timeout)
+        except asyncio.TimeoutError:
+            await _terminate(proc)
+            raise subprocess.TimeoutExpired(self.cmd, self.timeout) from None
+        except BaseException:
+            # Cancelled, or interrupted:
+            await _terminate(proc)
+            raise
+        finally:
+            if self.log is not None:
+                self.log.close(failed=rc != 0)
+        output = b''.join(captured).decode('utf8') if captured is not None else None
+        if rc:
+            raise subprocess.CalledProcessError(rc, self.cmd, output=output)
+        return output if self.capture else rc
+
+
+async def run_jobs_async(jobs, return_exceptions=False):
+    """Run the given Jobs concurrently and return a list of their results. If any job
+    fails, the others are cancelled (terminating their processes) and the exception is
+    raised. If return_exceptions is True, a job failing does not affect the others, and
+    the exception it raised is returned in place of its result."""
+    tasks = [asyncio.ensure_future(job.run()) for job in jobs]
+    try:
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def run_jobs(jobs, return_exceptions=False):
+    """Synchronous wrapper around run_jobs_async(). Must not be called from within a
+    running event loop."""
+    return asyncio.run(run_jobs_async(jobs, return_exceptions=return_exceptions))
+
+
+def run(cmd, **kwargs):
+    """Run a single command to completion. Keyword arguments are passed to Job. Returns
+    the return code (always zero), or the command's output if capture=True. Raises
+    subprocess.CalledProcessError on failure."""
+    return run_jobs([Job(cmd, **kwargs)])[0]
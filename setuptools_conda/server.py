@@ -0,0 +1,466 @@
+"""A long-lived server process that runs setuptools-conda commands on behalf of clients,
+so that the cost of starting Python and importing setuptools, conda and conda-build is
+paid once rather than for every build.
+
+Clients connect over a Unix socket and send their command line, working directory and
+the environment variables a build may need. The server forks a child process per job
+from its warmed-up state, and streams the job's output back to the client, followed by
+its exit code.
+
+The socket is kept in a directory only accessible to the current user. Clients refuse
+to use a socket, or a directory containing one, that is owned by another user or
+accessible to others, and where the platform supports it, each end checks that the
+process at the other end of the connection belongs to the same user."""
+
+import sys
+import os
+import json
+import socket
+import struct
+import stat
+import hashlib
+import tempfile
+import traceback
+import selectors
+import signal
+
+# Environment variable to override the path of the server's socket:
+SOCKET_ENV_VAR = 'SETUPTOOLS_CONDA_SOCKET'
+
+# Environment variable that, if set to a non-empty value, prevents the command line
+# interface from forwarding commands to a running server:
+NO_SERVER_ENV_VAR = 'SETUPTOOLS_CONDA_NO_SERVER'
+
+# Environment variable set in job processes run by the server:
+JOB_ENV_VAR = 'SETUPTOOLS_CONDA_SERVER_JOB'
+
+# Environment variable listing the names of additional environment variables, separated
+# by commas, to forward to the server along with those in FORWARDED_ENV_VARS:
+FORWARD_ENV_VAR = 'SETUPTOOLS_CONDA_SERVER_ENV'
+
+# Environment variables forwarded to the server to be set in job processes. No others
+# are sent, so that secrets in the client's environment are not passed on needlessly:
+FORWARDED_ENV_VARS = {
+    'PATH',
+    'HOME',
+    'USER',
+    'LOGNAME',
+    'SHELL',
+    'TERM',
+    'LANG',
+    'TMPDIR',
+    'PYTHONPATH',
+    'PYTHONHASHSEED',
+    'SOURCE_DATE_EPOCH',
+    'XDG_CACHE_HOME',
+    'XDG_CONFIG_HOME',
+    'HTTP_PROXY',
+    'HTTPS_PROXY',
+    'NO_PROXY',
+    'http_proxy',
+    'https_proxy',
+    'no_proxy',
+    'REQUESTS_CA_BUNDLE',
+    'SSL_CERT_FILE',
+    'CC',
+    'CXX',
+    'CFLAGS',
+    'CXXFLAGS',
+    'CPPFLAGS',
+    'LDFLAGS',
+    'LDSHARED',
+    'ARCHFLAGS',
+    'MAKEFLAGS',
+    'MACOSX_DEPLOYMENT_TARGET',
+    'SETUPTOOLS_SCM_PRETEND_VERSION',
+}
+
+# Prefixes of the names of further environment variables forwarded to the server:
+FORWARDED_ENV_PREFIXES = ('CONDA', 'SETUPTOOLS_CONDA_', 'LC_', 'PIP_', 'CMAKE_')
+
+# Commands that may be forwarded to the server:
+SERVER_COMMANDS = ['build', 'install-requirements']
+
+# Message types sent from the server to clients. Each message is a single byte type
+# followed by a four-byte big-endian payload length and then the payload:
+_OUTPUT = b'o'
+_EXIT = b'x'
+_REFUSED = b'r'
+
+_HEADER = struct.Struct('>cI')
+
+# struct ucred, as returned by getsockopt() with SO_PEERCRED: pid, uid and gid:
+_PEERCRED = struct.Struct('3i')
+
+
+def supported():
+    """Whether the server is supported on this platform"""
+    return hasattr(socket, 'AF_UNIX') and hasattr(os, 'fork')
+
+
+def in_job():
+    """Whether we are running as a job within the server"""
+    return bool(os.getenv(JOB_ENV_VAR))
+
+
+def socket_dir():
+    """Return the directory in which the server's socket is kept by default: a
+    'setuptools-conda' directory in $XDG_RUNTIME_DIR if set, otherwise a directory
+    unique to the current user in the temporary directory. The directory is not
+    created."""
+    runtime_dir = os.getenv('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'setuptools-conda')
+    return os.path.join(tempfile.gettempdir(), f'setuptools-conda-{os.getuid()}')
+
+
+def default_socket_path():
+    """Return the path to the socket for a server running in the current conda
+    environment, as overridden by the SETUPTOOLS_CONDA_SOCKET environment variable if
+    set. The default path is in socket_dir() and unique per environment, so that
+    clients only ever connect to a server that has the same packages available as they
+    do."""
+    path = os.getenv(SOCKET_ENV_VAR)
+    if path:
+        return path
+    env_hash = hashlib.sha256(sys.prefix.encode('utf8')).hexdigest()[:12]
+    return os.path.join(socket_dir(), f'{env_hash}.sock')
+
+
+def _private(path):
+    # Whether path is owned by the current user and, unless it is a socket, not
+    # accessible to anyone else. Symlinks are not followed, and are not private.
+    try:
+        st = os.lstat(path)
+    except FileNotFoundError:
+        return False
+    if st.st_uid != os.getuid():
+        return False
+    if stat.S_ISSOCK(st.st_mode):
+        return True
+    return stat.S_ISDIR(st.st_mode) and not st.st_mode & 0o077
+
+
+def _peer_uid(conn):
+    # The uid of the process at the other end of a connected Unix socket, or None if the
+    # platform provides no way to get it:
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _PEERCRED.size)
+    _, uid, _ = _PEERCRED.unpack(creds)
+    return uid
+
+
+def forwarded_environment(environ=None):
+    """Return the subset of environ, by default os.environ, to send to the server: the
+    variables in FORWARDED_ENV_VARS, those whose names start with one of
+    FORWARDED_ENV_PREFIXES, and any listed in the SETUPTOOLS_CONDA_SERVER_ENV
+    environment variable"""
+    if environ is None:
+        environ = os.environ
+    names = set(FORWARDED_ENV_VARS)
+    names.update(name.strip() for name in environ.get(FORWARD_ENV_VAR, '').split(','))
+    return {
+        name: value
+        for name, value in environ.items()
+        if name in names or name.startswith(FORWARDED_ENV_PREFIXES)
+    }
+
+
+def _environment_stamp():
+    # conda appends to conda-meta/history on every transaction, so its modification
+    # time tells us whether any packages have been installed, updated or removed:
+    history = os.path.join(sys.prefix, 'conda-meta', 'history')
+    try:
+        return os.stat(history).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+_startup_stamp = _environment_stamp()
+
+
+def environment_changed():
+    """Whether packages in the current conda environment have changed since this
+    process started"""
+    return _environment_stamp() != _startup_stamp
+
+
+def _send(conn, kind, payload):
+    conn.sendall(_HEADER.pack(kind, len(payload)) + payload)
+
+
+def _recv_exactly(conn, n):
+    data = b''
+    while len(data) < n:
+        chunk = conn.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError("connection closed by server")
+        data += chunk
+    return data
+
+
+def forward(args):
+    """Run the setuptools-conda command with the given command line arguments on a
+    running server, if there is one, writing its output to stdout. Return the command's
+    exit code, or None if no server is running or it declined to run the command, in
+    which case the caller should run it locally."""
+    if not supported() or in_job() or os.getenv(NO_SERVER_ENV_VAR):
+        return None
+    path = default_socket_path()
+    if not os.path.exists(path):
+        return None
+    if not (_private(os.path.dirname(os.path.abspath(path))) and _private(path)):
+        msg = f"WARNING: not using setuptools-conda server socket {path}, since it or "
+        msg += "its directory is owned by another user or accessible to others"
+        print(msg, file=sys.stderr)
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+        peer_uid = _peer_uid(conn)
+    except OSError:
+        conn.close()
+        return None
+    if peer_uid not in (None, os.getuid()):
+        conn.close()
+        msg = f"WARNING: not using setuptools-conda server on {path}, since it is "
+        msg += f"running as another user (uid {peer_uid})"
+        print(msg, file=sys.stderr)
+        return None
+    request = {'argv': list(args), 'cwd': os.getcwd(), 'env': forwarded_environment()}
+    with conn:
+        conn.sendall(json.dumps(request).encode('utf8') + b'\n')
+        while True:
+            try:
+                kind, length = _HEADER.unpack(_recv_exactly(conn, _HEADER.size))
+                payload = _recv_exactly(conn, length)
+            except ConnectionError:
+                print("setuptools-conda server closed the connection", file=sys.stderr)
+                return 1
+            if kind == _OUTPUT:
+                sys.stdout.buffer.write(payload)
+                sys.stdout.buffer.flush()
+            elif kind == _EXIT:
+                return json.loads(payload)
+            elif kind == _REFUSED:
+                print(
+                    "setuptools-conda server declined job:",
+                    payload.decode('utf8'),
+                    file=sys.stderr,
+                )
+                return None
+
+
+def _warm_up():
+    # Import everything a job is likely to need, and load conda-build's configuration,
+    # so that forked jobs start with all of it ready to go.
+    import setuptools
+    import setuptools.command.sdist
+    import setuptools_conda.setuptools_conda
+    import setuptools_conda.__main__
+
+    try:
+        import setuptools.command.bdist_wheel
+    except ImportError:
+        try:
+            import wheel.bdist_wheel
+        except ImportError:
+            pass
+    try:
+        import conda_build.cli.main_build
+        from conda_build.config import Config
+    except ImportError:
+        print("conda-build not importable, builds will run it as a subprocess")
+    else:
+        Config()
+
+
+def _run_job(request, output_fd):
+    # In the forked job process. Take on the client's working directory, environment
+    # and command line, send all output to the pipe, and run the command.
+    os.setpgid(0, 0)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(output_fd, 1)
+    os.dup2(output_fd, 2)
+    os.close(output_fd)
+    sys.stdout.reconfigure(line_buffering=True)
+    sys.stderr.reconfigure(line_buffering=True)
+    rc = 0
+    try:
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.environ[JOB_ENV_VAR] = '1'
+        try:
+            from conda.base.context import reset_context
+        except ImportError:
+            pass
+        else:
+            reset_context()
+        sys.argv = ['setuptools-conda'] + request['argv']
+        from setuptools_conda.__main__ import main
+
+        main()
+    except SystemExit as e:
+        if e.code is None:
+            rc = 0
+        elif isinstance(e.code, int):
+            rc = e.code
+        else:
+            print(e.code, file=sys.stderr)
+            rc = 1
+    except BaseException:
+        traceback.print_exc()
+        rc = 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(rc)
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _handle_connection(conn):
+    # In a forked worker process, one per connection. Run the job in a child process,
+    # relaying its output to the client and killing it if the client goes away.
+    if _peer_uid(conn) not in (None, os.getuid()):
+        # Can't happen with the socket in a private directory, but check anyway:
+        return
+    with conn.makefile('rb') as f:
+        line = f.readline()
+    try:
+        request = json.loads(line)
+    except ValueError:
+        request = None
+    if not (isinstance(request, dict) and {'cwd', 'env', 'argv'} <= request.keys()):
+        # Nothing or garbage, e.g. from serve() checking whether a server is already
+        # running, which connects and closes the connection without sending anything:
+        return
+    if request['env'].get('CONDA_PREFIX') != os.getenv('CONDA_PREFIX'):
+        msg = f"client is not in conda environment {os.getenv('CONDA_PREFIX')}"
+        _send(conn, _REFUSED, msg.encode('utf8'))
+        return
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        conn.close()
+        _run_job(request, write_fd)
+    os.close(write_fd)
+    selector = selectors.DefaultSelector()
+    selector.register(read_fd, selectors.EVENT_READ)
+    selector.register(conn, selectors.EVENT_READ)
+    job_finished = False
+    try:
+        while not job_finished:
+            for key, _ in selector.select():
+                if key.fileobj is conn:
+                    # The client sends nothing after its request, so this is EOF: it
+                    # has gone away.
+                    raise ConnectionError
+                data = os.read(read_fd, 65536)
+                if data:
+                    _send(conn, _OUTPUT, data)
+                else:
+                    job_finished = True
+        _, status = os.waitpid(pid, 0)
+        _send(conn, _EXIT, json.dumps(_exit_code(status)).encode('utf8'))
+    except OSError:
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+        os.waitpid(pid, 0)
+    finally:
+        os.close(read_fd)
+
+
+def _reap_children():
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            return
+        if pid == 0:
+            return
+
+
+def serve(socket_path=None):
+    """Run the server, listening on the given socket path or the default one, until
+    interrupted. If packages in the conda environment change, the server restarts
+    itself so that jobs do not run with stale modules."""
+    if not supported():
+        raise SystemExit("setuptools-conda serve is not supported on this platform")
+    if not os.getenv('CONDA_PREFIX'):
+        raise SystemExit("setuptools-conda serve must be run in a conda environment")
+    if socket_path is None:
+        socket_path = default_socket_path()
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    try:
+        os.mkdir(directory, 0o700)
+    except FileExistsError:
+        pass
+    if not _private(directory):
+        msg = f"{directory} must be a directory owned by the current user and not "
+        msg += "accessible to others, for the server's socket to be private"
+        raise SystemExit(msg)
+    print("Importing modules...")
+    _warm_up()
+
+    if os.path.exists(socket_path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(socket_path)
+        except OSError:
+            # Stale socket from a server that did not shut down cleanly:
+            os.unlink(socket_path)
+        else:
+            probe.close()
+            raise SystemExit(f"A server is already listening on {socket_path}")
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o077)
+    try:
+        sock.bind(socket_path)
+    finally:
+        os.umask(old_umask)
+    sock.listen()
+    print(f"setuptools-conda server listening on {socket_path}")
+    restart = False
+    try:
+        while True:
+            conn, _ = sock.accept()
+            _reap_children()
+            if environment_changed():
+                msg = "conda environment has changed, server is restarting"
+                with conn:
+                    _send(conn, _REFUSED, msg.encode('utf8'))
+                print(msg)
+                restart = True
+                break
+            if os.fork() == 0:
+                sock.close()
+                signal.signal(signal.SIGINT, signal.SIG_DFL)
+                try:
+                    _handle_connection(conn)
+                finally:
+                    os._exit(0)
+            conn.close()
+    except KeyboardInterrupt:
+        print("setuptools-conda server exiting")
+    finally:
+        sock.close()
+        os.unlink(socket_path)
+    if restart:
+        sys.stdout.flush()
+        args = [sys.executable, '-m', 'setuptools_conda', 'serve']
+        args += ['--socket', socket_path]
+        os.execv(sys.executable, args)
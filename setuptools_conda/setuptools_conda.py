@@ -12,9 +12,28 @@ import configparser
 import re
 import itertools
 import platform
+import runpy
+import traceback
+import time
+import contextlib
+import functools
+import tempfile
+import uuid
+import zipfile
+import tarfile
+import gzip
+from concurrent.futures import ThreadPoolExecutor
 
 import toml
 import distlib.markers
+from distlib.util import parse_marker
+from distlib.version import (
+    NormalizedVersion,
+    NormalizedMatcher,
+    UnsupportedVersionError,
+)
+
+from setuptools_conda import runner, server, verify
 
 
 WINDOWS = platform.system() == 'Windows'
@@ -41,6 +60,24 @@ PLATFORM_VAR_TRANSLATION = {
 }
 
 
+# Environment variables giving the total number of CPUs and memory in GB that builds
+# using the resource governor may reserve between them, defaulting to the CPUs and
+# memory available to this process:
+CPU_BUDGET_ENV_VAR = 'SETUPTOOLS_CONDA_CPU_BUDGET'
+MEMORY_BUDGET_ENV_VAR = 'SETUPTOOLS_CONDA_MEMORY_BUDGET'
+
+# The fraction of the CPU budget each build using the resource governor reserves if
+# not given a number of CPUs, so that several such builds can run at once:
+GOVERNOR_DEFAULT_CPU_SHARE = 4
+
+# Interval in seconds at which a build waiting for resources checks whether they have
+# become available:
+GOVERNOR_POLL_INTERVAL = 2
+
+# Environment variable giving the path of a PyPI:conda name database shared between
+# projects, used when a project doesn't configure one:
+NAME_DATABASE_ENV_VAR = 'SETUPTOOLS_CONDA_NAME_DATABASE'
+
 # Command line args that can be used in place of "setup.py" for projects that lack a
 # setup.py, runs a minimal setup.py similar to what pip does for projects with no
 # setup.py.
@@ -51,11 +88,892 @@ _SETUP_PY_STUB = [
 
 
 def run(cmd, **kwargs):
-    print('[running]:', *[shlex.quote(arg) for arg in cmd])
-    rc = subprocess.call(cmd, **kwargs)
-    if rc:
-        sys.exit(rc)
-    return rc
+    """Run a command with the runner, passing it any keyword arguments. Exit with the
+    command's return code if it fails."""
+    try:
+        return runner.run(cmd, **kwargs)
+    except subprocess.CalledProcessError as e:
+        sys.exit(e.returncode)
+
+
+def run_conda_build(args, env, **kwargs):
+    """Run conda-build with the given command line arguments and environment, passing
+    any keyword arguments to run(). In a job running within a setuptools-conda server,
+    which has conda-build already imported, run it in-process instead of as a
+    subprocess, unless its output is to be logged to file."""
+    in_process = server.in_job() and not server.environment_changed()
+    if in_process and kwargs.get('log_file') is None:
+        try:
+            from conda_build.cli.main_build import execute
+        except ImportError:
+            pass
+        else:
+            print('[running]:', 'conda-build', *[shlex.quote(arg) for arg in args])
+            # We are a job process that is going to exit when done, so there is no need
+            # to restore the environment afterwards:
+            os.environ.clear()
+            os.environ.update(env)
+            try:
+                execute(args)
+            except Exception:
+                traceback.print_exc()
+                sys.exit(1)
+            return 0
+    return run(['conda-build'] + args, env=env, **kwargs)
+
+
+def exec_setup_py(project_dir, args):
+    """Run setup.py, or a minimal stub in its place as per setup_py(), in project_dir in
+    the current process, with the given command line arguments. The working directory,
+    sys.argv and sys.path are modified and not restored, so this is only suitable for a
+    process that will exit afterwards."""
+    stub = setup_py(project_dir) == _SETUP_PY_STUB
+    print('[running in-process]:', 'setup.py', *[shlex.quote(arg) for arg in args])
+    os.chdir(project_dir)
+    sys.path.insert(0, os.getcwd())
+    sys.argv = ['setup.py'] + args
+    if stub:
+        exec(_SETUP_PY_STUB[1], {'__name__': '__main__'})
+    else:
+        runpy.run_path('setup.py', run_name='__main__')
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    """Context manager that holds an exclusive lock on the given lock file, creating it
+    if it doesn't exist, and blocking until the lock can be acquired"""
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'a+b') as f:
+        if WINDOWS:
+            import msvcrt
+
+            f.seek(0)
+            while True:
+                try:
+                    # Retries for 10 seconds, then raises:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def total_memory():
+    """Return the physical memory of the machine in GB, or None if it can't be
+    determined"""
+    if WINDOWS:
+        import ctypes
+
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [
+                ('dwLength', ctypes.c_ulong),
+                ('dwMemoryLoad', ctypes.c_ulong),
+                ('ullTotalPhys', ctypes.c_ulonglong),
+                ('ullAvailPhys', ctypes.c_ulonglong),
+                ('ullTotalPageFile', ctypes.c_ulonglong),
+                ('ullAvailPageFile', ctypes.c_ulonglong),
+                ('ullTotalVirtual', ctypes.c_ulonglong),
+                ('ullAvailVirtual', ctypes.c_ulonglong),
+                ('ullAvailExtendedVirtual', ctypes.c_ulonglong),
+            ]
+
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(status)
+        if not ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return None
+        return status.ullTotalPhys / 1024**3
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') / 1024**3
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def _read_cgroup_file(*paths):
+    # Return the stripped contents of the first of the given files that exists, or None
+    for path in paths:
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+
+def available_cpus():
+    """Return the number of CPUs this process may use: those in its CPU affinity mask
+    where supported, limited by any CPU quota of its cgroup, for example as set for a
+    container"""
+    if hasattr(os, 'sched_getaffinity'):
+        cpus = len(os.sched_getaffinity(0))
+    else:
+        cpus = os.cpu_count() or 1
+    # cgroup v2 cpu.max is '<quota> <period>' or 'max <period>', and cgroup v1 has them
+    # in separate files, with a quota of -1 if unlimited:
+    quota = _read_cgroup_file('/sys/fs/cgroup/cpu.max')
+    if quota is not None:
+        quota, _, period = quota.partition(' ')
+    else:
+        quota = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    try:
+        quota, period = int(quota), int(period)
+    except (TypeError, ValueError):
+        return cpus
+    if quota > 0 and period > 0:
+        cpus = min(cpus, max(1, -(-quota // period)))
+    return cpus
+
+
+def cgroup_memory_limit():
+    """Return the memory limit in GB of this process's cgroup, for example as set for a
+    container, or None if there is none or it can't be determined"""
+    limit = _read_cgroup_file(
+        '/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'
+    )
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        # Missing, or 'max' if unlimited
+        return None
+    # cgroup v1 reports no limit as a very large number:
+    if limit <= 0 or limit >= 2**60:
+        return None
+    return limit / 1024**3
+
+
+def resource_budget():
+    """Return the (cpus, memory) budget in CPUs and GB shared by all builds using the
+    resource governor on this machine: by default the CPUs available to this process
+    and the physical memory of the machine or the memory limit of the process's cgroup,
+    whichever is lower. memory is None if unlimited."""
+    cpus = float(os.getenv(CPU_BUDGET_ENV_VAR) or available_cpus())
+    memory = os.getenv(MEMORY_BUDGET_ENV_VAR)
+    if memory:
+        memory = float(memory)
+    else:
+        limits = [m for m in [total_memory(), cgroup_memory_limit()] if m is not None]
+        memory = min(limits) if limits else None
+    return cpus, memory
+
+
+def _process_alive(pid):
+    if WINDOWS:
+        import ctypes
+
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return False
+        kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+@contextlib.contextmanager
+def reserve_resources(cpus, memory, state_dir=None):
+    """Context manager reserving the given number of CPUs and GB of memory from the
+    budget returned by resource_budget(), which is shared by all processes on the
+    machine using this function. Blocks until enough of the budget is free, except that
+    a reservation is always granted if there are no others, so that one larger than the
+    whole budget doesn't wait forever. Reservations are recorded in a file in
+    state_dir, by default in the user's cache directory, along with the pid of the
+    process holding them, so that those held by processes that have died are ignored."""
+    if state_dir is None:
+        state_dir = os.path.join(user_cache_dir(), 'governor')
+    reservations_file = os.path.join(state_dir, 'reservations.json')
+    lock = os.path.join(state_dir, '.setuptools_conda.lock')
+    cpu_budget, memory_budget = resource_budget()
+    key = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+    start_time = time.monotonic()
+    waiting = False
+    while True:
+        with file_lock(lock):
+            try:
+                with open(reservations_file) as f:
+                    reservations = json.load(f)
+            except (OSError, ValueError):
+                reservations = {}
+            reservations = {
+                k: v for k, v in reservations.items() if _process_alive(v['pid'])
+            }
+            cpus_used = sum(v['cpus'] for v in reservations.values())
+            memory_used = sum(v['memory'] for v in reservations.values())
+            fits = cpus_used + cpus <= cpu_budget and (
+                memory_budget is None or memory_used + memory <= memory_budget
+            )
+            if fits or not reservations:
+                reservations[key] = {'pid': os.getpid(), 'cpus': cpus, 'memory': memory}
+            with open(reservations_file, 'w') as f:
+                json.dump(reservations, f, indent=4)
+        if key in reservations:
+            break
+        if not waiting:
+            waiting = True
+            msg = f"Waiting for {cpus:g} CPUs and {memory:g} GB of memory, "
+            msg += f"{cpus_used:g} CPUs and {memory_used:g} GB in use by "
+            msg += f"{len(reservations)} other builds"
+            print(msg, flush=True)
+        time.sleep(GOVERNOR_POLL_INTERVAL)
+    if waiting:
+        print(f"Resources acquired after {time.monotonic() - start_time:.1f}s")
+    try:
+        yield
+    finally:
+        with file_lock(lock):
+            try:
+                with open(reservations_file) as f:
+                    reservations = json.load(f)
+            except (OSError, ValueError):
+                reservations = {}
+            reservations.pop(key, None)
+            with open(reservations_file, 'w') as f:
+                json.dump(reservations, f, indent=4)
+
+
+def parallelism_environment(cpus, environ=None):
+    """Return a dict of environment variables limiting the number of parallel jobs used
+    by compilers and build tools to cpus: conda-build's CPU_COUNT, MAKEFLAGS, with any
+    existing -j flag in environ replaced, and CMAKE_BUILD_PARALLEL_LEVEL"""
+    if environ is None:
+        environ = os.environ
+    makeflags = environ.get('MAKEFLAGS', '')
+    makeflags = [flag for flag in makeflags.split() if not re.match(r'-j\d*$', flag)]
+    return {
+        'CPU_COUNT': str(cpus),
+        'MAKEFLAGS': ' '.join(makeflags + [f'-j{cpus}']),
+        'CMAKE_BUILD_PARALLEL_LEVEL': str(cpus),
+    }
+
+
+def parse_shard(shard):
+    """Parse a shard given as a string 'i/N', meaning the i'th of N shards counting
+    from 1, and return (i, N)"""
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', shard)
+    if not match:
+        raise ValueError(f"Invalid shard {shard!r}, expected e.g. '1/4'")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 1 <= index <= count:
+        msg = f"Invalid shard {shard!r}, must be between 1/{count} and {count}/{count}"
+        raise ValueError(msg)
+    return index, count
+
+
+def shard_entries(entries, shard, key):
+    """Return the entries of a build matrix, such as the Python versions a project is
+    built for, that are assigned to the given shard (i, N). Entries are sorted and dealt
+    out to shards in turn, starting at a shard chosen by a hash of key, such as the
+    project name, so that the first entries of different projects' matrices go to
+    different shards. The result depends only on the arguments, so separate machines
+    building different shards of the same matrix build every entry exactly once."""
+    index, count = shard
+    offset = int(hashlib.sha256(key.encode('utf8')).hexdigest(), 16) % count
+    return [
+        entry
+        for n, entry in enumerate(sorted(entries))
+        if (n + offset) % count == index - 1
+    ]
+
+
+def shard_dist_dir(dist_dir, shard):
+    """Return the output directory used in place of dist_dir by the given shard (i, N),
+    or dist_dir itself if shard is None"""
+    if shard is None:
+        return dist_dir
+    return f'{dist_dir}_shard_{shard[0]}_of_{shard[1]}'
+
+
+def publish_packages(pkgs, dist_dir, subdir):
+    """Copy package files into the subdir subdirectory of dist_dir, returning the paths
+    of the copies. Each file is copied to a temporary file in the destination directory
+    and then renamed into place, with a lock on dist_dir held throughout, so that builds
+    running concurrently never see or produce partially written packages."""
+    dest_dir = os.path.join(dist_dir, subdir)
+    os.makedirs(dest_dir, exist_ok=True)
+    published = []
+    with file_lock(os.path.join(dist_dir, '.setuptools_conda.lock')):
+        for pkg in pkgs:
+            name = os.path.basename(pkg)
+            print("copying %s to %s" % (name, dest_dir))
+            fd, tmp = tempfile.mkstemp(prefix=f'.{name}.', dir=dest_dir)
+            os.close(fd)
+            try:
+                shutil.copyfile(pkg, tmp)
+                shutil.copymode(pkg, tmp)
+                os.replace(tmp, os.path.join(dest_dir, name))
+            except BaseException:
+                os.unlink(tmp)
+                raise
+            published.append(os.path.join(dest_dir, name))
+    return published
+
+
+def package_record(path, index):
+    """Return the repodata.json record for the conda package file at path, given the
+    contents of its info/index.json"""
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+            sha256.update(chunk)
+    record = dict(index)
+    record.update(
+        md5=md5.hexdigest(), sha256=sha256.hexdigest(), size=os.path.getsize(path)
+    )
+    return record
+
+
+def update_repodata(channel_dir, subdir, records, removed=()):
+    """Add records for package files to the repodata.json of the given subdir of a local
+    channel, creating it if it does not exist. records is a dict mapping package
+    filenames to their records as returned by package_record(). Records for the package
+    filenames in removed are deleted, and existing records for other packages are kept.
+    The channel's noarch subdir is also created if necessary, since conda requires it to
+    exist."""
+    with file_lock(os.path.join(channel_dir, '.setuptools_conda.lock')):
+        for name in {subdir, 'noarch'}:
+            subdir_path = os.path.join(channel_dir, name)
+            os.makedirs(subdir_path, exist_ok=True)
+            repodata_json = os.path.join(subdir_path, 'repodata.json')
+            if os.path.exists(repodata_json):
+                with open(repodata_json) as f:
+                    repodata = json.load(f)
+            else:
+                repodata = {
+                    'info': {'subdir': name},
+                    'packages': {},
+                    'packages.conda': {},
+                    'removed': [],
+                    'repodata_version': 1,
+                }
+            if name == subdir:
+                for filename in removed:
+                    for key in ['packages', 'packages.conda']:
+                        repodata.get(key, {}).pop(filename, None)
+                for filename, record in records.items():
+                    if filename.endswith('.conda'):
+                        key = 'packages.conda'
+                    else:
+                        key = 'packages'
+                    repodata.setdefault(key, {})[filename] = record
+            fd, tmp = tempfile.mkstemp(prefix='.repodata.json.', dir=subdir_path)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(repodata, f, indent=2, sort_keys=True)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, repodata_json)
+
+
+def index_subdir(channel_dir, subdir, refresh=(), max_workers=None):
+    """Bring the repodata.json of the given subdir of a local channel up to date with
+    the package files in it, creating it if it does not exist, using
+    update_repodata(). Records are made for packages that have none, and for those
+    whose filenames are in refresh, reading the packages concurrently. Records of
+    packages no longer present are removed. Reading .conda packages requires the
+    `zstandard` module."""
+    subdir_path = os.path.join(channel_dir, subdir)
+    repodata_json = os.path.join(subdir_path, 'repodata.json')
+    indexed = set()
+    if os.path.exists(repodata_json):
+        with open(repodata_json) as f:
+            repodata = json.load(f)
+        indexed = set(repodata.get('packages', {}))
+        indexed.update(repodata.get('packages.conda', {}))
+    present = {
+        name
+        for name in os.listdir(subdir_path)
+        if name.endswith(('.tar.bz2', '.conda')) and not name.startswith('.')
+    }
+    to_read = sorted((present - indexed) | (present & set(refresh)))
+
+    def record(filename):
+        path = os.path.join(subdir_path, filename)
+        return package_record(path, verify.read_package_info(path)['index'])
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        records = dict(zip(to_read, executor.map(record, to_read)))
+    update_repodata(channel_dir, subdir, records, removed=sorted(indexed - present))
+
+
+def parse_size(size):
+    """Return the number of bytes in a size given as a number of bytes, or a string of a
+    number with an optional suffix K, M, G or T in powers of 1024, e.g. '500M' or
+    '20G'"""
+    if isinstance(size, (int, float)):
+        return int(size)
+    match = re.fullmatch(r'\s*(\d+(?:\.\d*)?)\s*([KMGT]?)B?\s*', size, re.IGNORECASE)
+    if not match:
+        raise ValueError(f"Invalid size {size!r}, expected e.g. '500M' or '20G'")
+    number, suffix = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(suffix.upper() or ' '))
+
+
+def expired_packages(pkgs, keep_last=None, max_size=None, protect=()):
+    """Given the paths of conda package files, return those that should be removed to
+    keep only the keep_last most recent builds of each package name, version and Python
+    version in each directory, and then to bring the total size of the remaining
+    packages down to max_size bytes by removing the oldest first. Packages are ordered
+    by modification time, which for published packages is when they were copied to the
+    output directory. Packages in protect, such as those just built, are never removed,
+    but count towards keep_last and max_size."""
+    protect = {os.path.abspath(pkg) for pkg in protect}
+    newest_first = sorted(pkgs, key=os.path.getmtime, reverse=True)
+    expired = []
+    if keep_last is not None:
+        kept = {}
+        for pkg in newest_first:
+            name, version, build_string = split_package_filename(pkg)
+            key = (os.path.dirname(pkg), name, version, python_tag(build_string))
+            kept[key] = kept.get(key, 0) + 1
+            if kept[key] > keep_last and os.path.abspath(pkg) not in protect:
+                expired.append(pkg)
+    if max_size is not None:
+        remaining = [pkg for pkg in newest_first if pkg not in expired]
+        total_size = sum(os.path.getsize(pkg) for pkg in remaining)
+        for pkg in reversed(remaining):
+            if total_size <= max_size:
+                break
+            if os.path.abspath(pkg) not in protect:
+                expired.append(pkg)
+                total_size -= os.path.getsize(pkg)
+    return expired
+
+
+# Temporary files left in an output directory by publish_packages() or
+# update_repodata() if they were interrupted:
+_PUBLISH_TEMPFILE = re.compile(r'\.(.+\.(tar\.bz2|conda)|repodata\.json)\.\w+$')
+
+
+def collect_package_garbage(
+    dist_dir, keep_last=None, max_size=None, protect=(), dry_run=False
+):
+    """Remove packages from the subdirs of the output directory or channel dist_dir
+    according to the retention policy of expired_packages(), with max_size applying to
+    all subdirs together. Manifests written alongside removed packages by --manifest
+    are removed with them, as are temporary files left by interrupted copies, and the
+    packages' records are removed from the repodata.json of any subdir that has one.
+    Holds the lock used by publish_packages() while removing files, so that concurrent
+    builds may publish to dist_dir safely. Returns the paths of the packages removed, or
+    if dry_run is True, of those that would be removed, without removing anything."""
+    if not os.path.isdir(dist_dir):
+        return []
+    action = 'would remove' if dry_run else 'removing'
+    with file_lock(os.path.join(dist_dir, '.setuptools_conda.lock')):
+        pkgs = []
+        for path in Path(dist_dir).glob('*/*'):
+            if _PUBLISH_TEMPFILE.match(path.name):
+                print(f"{action} {path}")
+                if not dry_run:
+                    path.unlink()
+            elif path.name.endswith(('.tar.bz2', '.conda')):
+                pkgs.append(str(path))
+        expired = expired_packages(pkgs, keep_last, max_size, protect)
+        for pkg in expired:
+            print(f"{action} {pkg}")
+            if not dry_run:
+                os.unlink(pkg)
+                if os.path.exists(pkg + '.manifest.json'):
+                    os.unlink(pkg + '.manifest.json')
+    if dry_run:
+        return expired
+    # Update the index once the lock is released, since update_repodata() acquires it:
+    removed = {}
+    for pkg in expired:
+        subdir = os.path.basename(os.path.dirname(pkg))
+        removed.setdefault(subdir, []).append(os.path.basename(pkg))
+    for subdir, filenames in removed.items():
+        if os.path.exists(os.path.join(dist_dir, subdir, 'repodata.json')):
+            update_repodata(dist_dir, subdir, {}, removed=filenames)
+    return expired
+
+
+def _last_modified(path):
+    # The latest modification time of the given directory and its direct children
+    mtimes = [os.path.getmtime(path)]
+    for entry in os.scandir(path):
+        try:
+            mtimes.append(entry.stat(follow_symlinks=False).st_mtime)
+        except OSError:
+            continue
+    return max(mtimes)
+
+
+def collect_build_garbage(
+    build_dir, croot=None, wheel_cache_dir=None, max_age=None, dry_run=False
+):
+    """Remove the job directories of parallel builds in <build_dir>/jobs, and in croot
+    if builds use one outside build_dir, whose processes are no longer running. Job
+    directories are identified by the pid in their name, so this must not be used on a
+    build directory shared with other machines. If max_age is given, also remove the
+    croot kept in build_dir for reuse by fast mode if croot is None, and the cache of
+    wheels built in from_wheel and universal_wheel modes in wheel_cache_dir, if they
+    have not been used in max_age days. Returns the paths of the directories removed,
+    or if dry_run is True, of those that would be removed, without removing
+    anything."""
+    action = 'would remove' if dry_run else 'removing'
+    removed = []
+    for parent in [os.path.join(build_dir, 'jobs'), croot]:
+        if parent is None or not os.path.isdir(parent):
+            continue
+        for entry in os.scandir(parent):
+            match = re.fullmatch(r'(\d+)-[0-9a-f]{8}', entry.name)
+            if entry.is_dir() and match and not _process_alive(int(match.group(1))):
+                print(f"{action} {entry.path}")
+                if not dry_run:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                removed.append(entry.path)
+    if max_age is None:
+        return removed
+    cutoff = time.time() - max_age * 24 * 60 * 60
+    stale = []
+    if croot is None:
+        stale.append(os.path.join(build_dir, 'conda-bld'))
+    if wheel_cache_dir is not None:
+        stale.append(wheel_cache_dir)
+    for path in stale:
+        if not os.path.isdir(path) or _last_modified(path) >= cutoff:
+            continue
+        if not dry_run:
+            # Builds hold this lock while using the wheel cache. Check again once we
+            # have it, in case a build used the directory in the meantime:
+            if os.path.isdir(build_dir):
+                lock = file_lock(os.path.join(build_dir, '.setuptools_conda.lock'))
+            else:
+                lock = contextlib.nullcontext()
+            with lock:
+                if _last_modified(path) >= cutoff:
+                    continue
+                shutil.rmtree(path, ignore_errors=True)
+        print(f"{action} {path}")
+        removed.append(path)
+    return removed
+
+
+def _test_env_last_used(path):
+    # The spec file is touched each time the environment is used. Environments without
+    # one were never successfully created:
+    spec_file = os.path.join(path, 'setuptools_conda_test_env.json')
+    if os.path.exists(spec_file):
+        return os.path.getmtime(spec_file)
+    return os.path.getmtime(path)
+
+
+def collect_test_env_garbage(test_env_dir, max_age, dry_run=False):
+    """Remove test environments created by --test in test_env_dir that have not been
+    used in max_age days, waiting for any build using one to finish with it first, and
+    the clones of test environments made by builds that are no longer running.
+    Returns the paths of the environments removed, or if dry_run is True, of those that
+    would be removed, without removing anything."""
+    if not os.path.isdir(test_env_dir):
+        return []
+    action = 'would remove' if dry_run else 'removing'
+    cutoff = time.time() - max_age * 24 * 60 * 60
+    removed = []
+    for entry in os.scandir(test_env_dir):
+        if not entry.is_dir():
+            continue
+        # Clones are removed by the build that made them, unless it was killed:
+        match = re.fullmatch(r'.+-test-(\d+)-[0-9a-f]{8}', entry.name)
+        if match:
+            if _process_alive(int(match.group(1))):
+                continue
+            print(f"{action} {entry.path}")
+            if not dry_run:
+                shutil.rmtree(entry.path, ignore_errors=True)
+            removed.append(entry.path)
+            continue
+        if _test_env_last_used(entry.path) >= cutoff:
+            continue
+        if not dry_run:
+            with file_lock(entry.path + '.lock'):
+                # A build may have used the environment while we waited for the lock:
+                if _test_env_last_used(entry.path) >= cutoff:
+                    continue
+                shutil.rmtree(entry.path, ignore_errors=True)
+        print(f"{action} {entry.path}")
+        removed.append(entry.path)
+    return removed
+
+
+# conda-build's default compiler for each language on each platform, which the
+# compiler() Jinja function in recipes turns into a package named <compiler>_<subdir>.
+# Used if conda-build is not importable:
+DEFAULT_COMPILERS = {
+    'linux': {'c': 'gcc', 'cxx': 'gxx'},
+    'osx': {'c': 'clang', 'cxx': 'clangxx'},
+    'win': {'c': 'vs2017', 'cxx': 'vs2017'},
+}
+
+
+def resolve_compiler(requirement, subdir):
+    """If requirement is a `compiler('<language>')` Jinja expression as used in recipes,
+    return the name of the package conda-build installs for it when building for the
+    given subdir, using the installed version of Visual Studio on Windows as
+    write_build_config() does. Otherwise return requirement unchanged."""
+    match = re.fullmatch(r"\{\{\s*compiler\(['\"](\w+)['\"]\)\s*\}\}", requirement)
+    if not match:
+        return requirement
+    language = match.group(1)
+    platform = subdir.split('-', 1)[0]
+    vsversion = get_visual_studio_version() if platform == 'win' else None
+    if vsversion is not None:
+        return f'vs{vsversion}_{subdir}'
+    try:
+        from conda_build.variants import DEFAULT_COMPILERS as compilers
+    except ImportError:
+        compilers = DEFAULT_COMPILERS
+    return f'{compilers[platform][language]}_{subdir}'
+
+
+def write_build_config(recipe_dir, pythons):
+    """Write conda_build_config.yaml to the recipe directory, for building for the given
+    Python versions with the installed version of Visual Studio, if any"""
+    build_config = {'python': pythons}
+    vsversion = get_visual_studio_version()
+    if vsversion is not None:
+        build_config['c_compiler'] = build_config['cxx_compiler'] = [f"vs{vsversion}"]
+    with open(os.path.join(recipe_dir, 'conda_build_config.yaml'), 'w') as f:
+        f.write('\n'.join(yaml_lines(build_config)))
+
+
+def croot_snapshot(croot):
+    """Return a dict mapping the paths of the package files in the subdirs of
+    conda-build's croot to their inode, size and modification time, for passing to
+    built_packages() after a build to find the packages it produced"""
+    snapshot = {}
+    for path in Path(croot).glob('*/*'):
+        if path.name.endswith(('.tar.bz2', '.conda')):
+            st = path.stat()
+            snapshot[str(path)] = (st.st_ino, st.st_size, st.st_mtime_ns)
+    return snapshot
+
+
+def built_packages(croot, subdir, before=None):
+    """Return the paths of the packages in the given subdir of conda-build's croot, as
+    listed in its index. If before is given, a snapshot of croot taken with
+    croot_snapshot() before the build, only packages that have been added or rewritten
+    since are returned, so that packages from previous builds in the same croot are
+    excluded."""
+    repodir = os.path.join(croot, subdir)
+    repodata_json = os.path.join(repodir, 'repodata.json')
+    if not os.path.exists(repodata_json):
+        return []
+    with open(repodata_json) as f:
+        repodata = json.load(f)
+    pkgs = [os.path.join(repodir, pkg) for pkg in repodata.get("packages", {})]
+    pkgs += [os.path.join(repodir, pkg) for pkg in repodata.get("packages.conda", {})]
+    if before is not None:
+        after = croot_snapshot(croot)
+        pkgs = [pkg for pkg in pkgs if pkg in after and after[pkg] != before.get(pkg)]
+    return pkgs
+
+
+def multi_output_details(name, version, outputs):
+    """Return the contents of the meta.yaml of a multi-output recipe, as a dict, for
+    building several projects in a single conda-build run. outputs is a list of
+    (package_details, files) for each project, where package_details is its recipe as
+    returned by dist_conda.package_details() and files is the list of glob patterns
+    matching the files it installs, as returned by dist_conda.installed_files().
+
+    Each project's source is unpacked into its own folder, and all projects are pip
+    installed by a single build script into one shared build and host environment
+    containing the union of their requirements. Each output then packages the files
+    belonging to its project, with the project's own run requirements and metadata.
+    Outputs declare only run requirements, so that conda-build does not create build
+    and host environments for each of them, with python pinned to the Python version
+    being built, unless the project is noarch, so that each output is a separate
+    variant per Python version with its own build string. Run requirements exported by
+    the shared environments' packages, such as compilers' runtime libraries, are
+    therefore not added to outputs. Entry points are not declared in outputs, since
+    pip has already installed their scripts."""
+    sources = []
+    folders = []
+    build_requires = []
+    host_requires = []
+    number = 0
+    outputs_details = []
+    for package_details, files in outputs:
+        package = package_details['package']
+        folder = package['name']
+        folders.append(folder)
+        source = dict(package_details['source'])
+        source['folder'] = folder
+        sources.append(source)
+        requirements = package_details['requirements']
+        build_requires += requirements.get('build', [])
+        host_requires += requirements['host']
+        number = max(number, package_details['build']['number'])
+        build = {
+            key: value
+            for key, value in package_details['build'].items()
+            if key not in ('script', 'entry_points')
+        }
+        run_requires = list(requirements['run'])
+        if 'noarch' not in package_details['build']:
+            # package_details() puts python first in the run requirements:
+            run_requires[0] = 'python {{ python }}.*'
+        outputs_details.append(
+            {
+                'name': package['name'],
+                'version': package['version'],
+                'files': files,
+                'build': build,
+                'requirements': {'run': run_requires},
+                'about': package_details['about'],
+            }
+        )
+    # Combine constraints on the same package, except for requirements with selectors,
+    # which can't be merged without knowing the platform:
+    plain = [req for req in host_requires if '#' not in req]
+    with_selectors = [req for req in host_requires if '#' in req]
+    host_requires = merge_requirements(plain) + list(dict.fromkeys(with_selectors))
+    script = "{{ PYTHON }} -m pip install --no-deps "
+    script += ' '.join(f'./{folder}' for folder in folders)
+    details = {
+        'package': {'name': name, 'version': version},
+        'source': sources,
+        'build': {'script': script, 'number': number},
+        'requirements': {
+            'build': list(dict.fromkeys(build_requires)),
+            'host': host_requires,
+        },
+        'outputs': outputs_details,
+    }
+    if not details['requirements']['build']:
+        del details['requirements']['build']
+    return details
+
+
+def user_cache_dir():
+    """Return the directory in which setuptools-conda keeps caches that persist between
+    builds of all projects for the current user"""
+    if WINDOWS:
+        base = os.getenv('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.getenv('XDG_CACHE_HOME') or os.path.join(
+            os.path.expanduser('~'), '.cache'
+        )
+    return os.path.join(base, 'setuptools-conda')
+
+
+def split_package_filename(path):
+    """Return the (name, version, build_string) of a conda package file"""
+    filename = os.path.basename(path)
+    for ext in ['.tar.bz2', '.conda']:
+        if filename.endswith(ext):
+            filename = filename[: -len(ext)]
+            break
+    else:
+        raise ValueError(f"Not a conda package: {path}")
+    name, version, build_string = filename.rsplit('-', 2)
+    return name, version, build_string
+
+
+def python_tag(build_string):
+    """Return the Python tag at the start of a conda package's build string, e.g.
+    'py311' for a package built for a particular Python version or 'py' for a noarch
+    package, or None if it has none"""
+    match = re.match(r'py\d*', build_string)
+    return match.group() if match else None
+
+
+def package_python_version(depends):
+    """Return the minor Python version, e.g. '3.11', that a conda package with the given
+    list of dependencies, as in its info/index.json, was built for, from its dependency
+    on python, or None if it is not pinned to one. Lower bounds alone, such as from
+    the project's own requirements, are not pins."""
+    for dependency in depends:
+        name, _, spec = dependency.partition(' ')
+        if name != 'python':
+            continue
+        # e.g. 'python >=3.11,<3.12.0a0' as added by python's run_exports, or
+        # 'python 3.11.*':
+        match = re.match(r'>=(\d+\.\d+)(?:\.\d+)*,<', spec.strip()) or re.match(
+            r'(?:==)?(\d+\.\d+)(?:\.\*|\.\d+|\s|$)', spec.strip()
+        )
+        if match:
+            return match.group(1)
+    return None
+
+
+def prefix_executable(prefix, name):
+    """Return the path to an executable installed in the bin directory of the conda
+    environment at the given prefix, e.g. python or a console script"""
+    if WINDOWS:
+        if name == 'python':
+            return os.path.join(prefix, 'python.exe')
+        return os.path.join(prefix, 'Scripts', f'{name}.exe')
+    return os.path.join(prefix, 'bin', name)
+
+
+def source_date_epoch(project_dir):
+    """Return the timestamp to use for files in reproducible source archives of the
+    project: the value of the SOURCE_DATE_EPOCH environment variable if set, otherwise
+    the commit time of the last git commit touching the project directory, so that
+    commits elsewhere in a repository containing several projects don't affect it, or
+    None if it is not in a git repository"""
+    if os.getenv('SOURCE_DATE_EPOCH'):
+        return int(os.environ['SOURCE_DATE_EPOCH'])
+    try:
+        output = runner.run(
+            ['git', 'log', '-1', '--format=%ct', '--', '.'],
+            cwd=project_dir,
+            capture=True,
+        )
+    except (subprocess.CalledProcessError, OSError):
+        # Not a git repository, or git not installed:
+        return None
+    if not output.strip():
+        return None
+    return int(output.strip())
+
+
+def normalise_tarball(path, mtime=None):
+    """Rewrite the gzipped tarball at path in a reproducible form: with members sorted
+    by name, all timestamps set to mtime, ownership set to root, permissions
+    normalised to 0o755 for directories and executable files and 0o644 for other files,
+    and a gzip header with no filename or timestamp. If mtime is None, the newest
+    timestamp of the archive's members is used."""
+    tmp = path + '.tmp'
+    with tarfile.open(path, 'r:gz') as src:
+        members = sorted(src.getmembers(), key=lambda member: member.name)
+        if mtime is None:
+            mtime = max((int(member.mtime) for member in members), default=0)
+        with open(tmp, 'wb') as f, gzip.GzipFile(
+            filename='', mode='wb', fileobj=f, mtime=0
+        ) as gz, tarfile.open(fileobj=gz, mode='w', format=tarfile.PAX_FORMAT) as dst:
+            for member in members:
+                member.mtime = mtime
+                member.uid = member.gid = 0
+                member.uname = member.gname = 'root'
+                member.pax_headers = {}
+                if member.isdir() or member.mode & 0o100:
+                    member.mode = 0o755
+                else:
+                    member.mode = 0o644
+                fileobj = src.extractfile(member) if member.isfile() else None
+                dst.addfile(member, fileobj)
+    os.replace(tmp, path)
 
 
 def get_visual_studio_version():
@@ -66,8 +984,7 @@ def get_visual_studio_version():
     vswhere = f"{os.getenv('ProgramFiles(x86)')}\\Microsoft Visual Studio\\Installer\\vswhere.exe"
     if not Path(vswhere).exists():
         return None
-    result = subprocess.run([vswhere, '-format', 'json'], check=True, capture_output=True)
-    info = json.loads(result.stdout.decode('utf8'))
+    info = json.loads(runner.run([vswhere, '-format', 'json'], capture=True))
     try:
         return info[0]['catalog']['productLineVersion']
     except (IndexError, KeyError):
@@ -105,6 +1022,16 @@ def yaml_lines(obj, indent=2):
                 lines.append(f'{key}: {value}')
     elif isinstance(obj, (list, tuple)):
         for item in obj:
+            if isinstance(item, dict):
+                # A mapping as a list item: prefix its first line with '- ' and
+                # indent the rest to match:
+                item_lines = yaml_lines(item, indent)
+                while item_lines and not item_lines[-1]:
+                    item_lines.pop()
+                for i, line in enumerate(item_lines):
+                    prefix = '- ' if i == 0 else '  '
+                    lines.append((prefix + line).rstrip())
+                continue
             for line in yaml_lines(item):
                 lines.append(line.rstrip())
         if lines and lines[-1]:
@@ -159,13 +1086,80 @@ def split_requirement(requirement):
     return name, version_specifiers, env_marker
 
 
+def normalise_name(name):
+    """Normalise a PyPI project name as per PEP 503, such that names PyPI considers
+    equivalent, e.g. 'PyQt5' and 'pyqt5', or 'ruamel.yaml' and 'ruamel_yaml', are
+    equal"""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+
 def condify_name(name, name_replacements=None):
     """Given a name, replace the package name with its entry, if any, in the dict
-    name_replacements, otherwise make the package name lowercase and replace,
-    underscores with hyphens."""
-    if name_replacements is None:
-        name_replacements = {}
-    return name_replacements.get(name, name.lower().replace("_", "-"))
+    name_replacements, looked up either as given or normalised with normalise_name(),
+    otherwise make the package name lowercase and replace underscores with hyphens."""
+    if name_replacements:
+        if name in name_replacements:
+            return name_replacements[name]
+        normalised_name = normalise_name(name)
+        if normalised_name in name_replacements:
+            return name_replacements[normalised_name]
+    return name.lower().replace("_", "-")
+
+
+def parse_name_differences(items):
+    """Return a dict of PyPI:conda name differences from a list of strings of
+    colon-separated names, e.g. ['PyQt5:pyqt', 'beautifulsoup4:beautiful-soup']"""
+    name_differences = {}
+    for item in items:
+        names = split(item, ':')
+        if len(names) != 2 or not all(names):
+            msg = f"invalid name difference {item!r}, expected 'pypi_name:conda_name'"
+            raise ValueError(msg)
+        name_differences[names[0]] = names[1]
+    return name_differences
+
+
+@functools.lru_cache(maxsize=None)
+def _load_name_database(path, mtime):
+    # Cached on the modification time as well as the path, so that a long-running
+    # process such as the build server sees changes to the file
+    with open(path) as f:
+        if path.endswith('.json'):
+            database = json.load(f)
+        else:
+            database = toml.load(f)
+    if not isinstance(database, dict) or not all(
+        isinstance(name, str) and isinstance(conda_name, str)
+        for name, conda_name in database.items()
+    ):
+        msg = f"{path}: name database must be a mapping of PyPI names to conda names"
+        raise ValueError(msg)
+    return {normalise_name(name): conda_name for name, conda_name in database.items()}
+
+
+def load_name_database(path):
+    """Load a PyPI:conda name database from the given JSON (if its name ends in '.json')
+    or TOML file, containing a mapping of PyPI project names to conda package names,
+    e.g. {"PyQt5": "pyqt", "beautifulsoup4": "beautiful-soup"}. Return a dict mapping
+    normalised PyPI names to conda names. Each file is only read once unless it
+    changes, and the returned dict is shared between callers, and must not be
+    modified."""
+    path = os.path.abspath(path)
+    return _load_name_database(path, os.path.getmtime(path))
+
+
+def name_mapping(name_differences=None, name_database=None):
+    """Return a dict mapping normalised PyPI names to conda names, for passing to
+    condify_name() and condify_requirements(), comprising the entries in the name
+    database at the path name_database - or if None, at the path in the environment
+    variable SETUPTOOLS_CONDA_NAME_DATABASE, if set - overridden by any in the dict
+    name_differences"""
+    if name_database is None:
+        name_database = os.getenv(NAME_DATABASE_ENV_VAR) or None
+    mapping = dict(load_name_database(name_database)) if name_database else {}
+    for name, conda_name in (name_differences or {}).items():
+        mapping[normalise_name(name)] = conda_name
+    return mapping
 
 
 def _version_split(version):
@@ -198,7 +1192,9 @@ def _get_compatible_prefix(version):
 
 
 def condify_version_specifier(specifier):
+    # Longer operators first, so that e.g. '===' isn't mistaken for '==':
     OPERATORS = [
+        "===",
         "~=",
         "==",
         "!=",
@@ -206,7 +1202,6 @@ def condify_version_specifier(specifier):
         ">=",
         "<",
         ">",
-        "===",
     ]
     # Remove all whitespace:
     specifier = specifier.replace(' ', '').replace('\t', '')
@@ -218,9 +1213,11 @@ def condify_version_specifier(specifier):
         raise ValueError(f"invalid specifier {specifier}")
 
     _, version = specifier.split(operator, 1)
+    if not version:
+        raise ValueError(f"invalid specifier {specifier}")
 
     if operator == '===':
-        msg = """The '====' (arbitrary) version operator has no conda equivalent and is
+        msg = """The '===' (arbitrary) version operator has no conda equivalent and is
             not supported"""
         raise ValueError(' '.join(msg.split()))
     elif operator == '~=':
@@ -283,19 +1280,185 @@ def condify_requirement(requirement, name_replacements=None):
     return result
 
 
+# Words that may appear in the conda selectors produced by condify_env_marker():
+_SELECTOR_WORDS = {'py', 'not', 'and', 'or'} | {
+    conda_bool
+    for mapping in PLATFORM_VAR_TRANSLATION.values()
+    for conda_bool in mapping.values()
+}
+
+
+def requirement_errors(requirement, name_replacements=None):
+    """Return a list of reasons the given requirement line can't be converted to a conda
+    requirement by condify_requirement(), which is empty if it can be. Does not run any
+    subprocesses."""
+    errors = []
+    name, version_specifiers, env_marker = split_requirement(requirement)
+    # Extras, e.g. 'foo[bar]', are ignored by conda:
+    if not re.match(r'^[A-Za-z0-9]([A-Za-z0-9._-]*[A-Za-z0-9])?(\[[^\]]*\])?$', name):
+        errors.append(f"invalid project name {name!r}")
+    else:
+        conda_name = condify_name(name.split('[', 1)[0], name_replacements)
+        if not re.match(r'^[a-z0-9_][a-z0-9_.-]*$', conda_name):
+            errors.append(f"invalid conda package name {conda_name!r}")
+    if version_specifiers is not None:
+        try:
+            condify_version_specifiers(version_specifiers)
+        except ValueError as e:
+            errors.append(str(e))
+    if env_marker is not None:
+        try:
+            _, rest = parse_marker(env_marker.strip())
+        except SyntaxError as e:
+            errors.append(f"invalid environment marker: {e}")
+        else:
+            if rest.strip():
+                msg = f"invalid environment marker: unexpected {rest.strip()!r}"
+                errors.append(msg)
+            else:
+                selector = condify_env_marker(env_marker)
+                words = re.findall(r'[A-Za-z_][A-Za-z0-9_]*', selector)
+                if any(word not in _SELECTOR_WORDS for word in words):
+                    msg = f"""environment marker {env_marker.strip()!r} has no conda
+                        selector equivalent"""
+                    errors.append(' '.join(msg.split()))
+    return errors
+
+
+def check_requirements(requires, name_replacements=None):
+    """Raise ValueError listing every requirement in requires that can't be converted by
+    condify_requirement(), and why"""
+    errors = [
+        f"{requirement!r}: {error}"
+        for requirement in requires
+        for error in requirement_errors(requirement, name_replacements)
+    ]
+    if errors:
+        raise ValueError("Invalid requirements:\n    " + "\n    ".join(errors))
+
+
 def condify_requirements(requires, name_replacements):
     """Convert requirements in the format of `setuptools.Distribution.install_requires`
     and `setuptools.Distribution.extras_require` to the format required by conda"""
     return [condify_requirement(line, name_replacements) for line in requires]
 
 
+def _pin_range(version):
+    # The range of versions matched by a "==" constraint, which as produced by
+    # condify_version_specifier() matches all versions with the given prefix. Return
+    # (lower, upper), with lower inclusive and upper exclusive, or None if the version
+    # has no numeric release segment to increment.
+    match = re.match(r'v?([0-9]+(?:\.[0-9]+)*)', version)
+    if not match:
+        return None
+    release = [int(n) for n in match.group(1).split('.')]
+    release[-1] += 1
+    return NormalizedVersion(version), NormalizedVersion('.'.join(map(str, release)))
+
+
+def _merge_constraints(constraints):
+    # Combine a list of (operator, version) pairs on a single package, returning a list
+    # of merged constraints and a list of conflicts found.
+    try:
+        versions = {version: NormalizedVersion(version) for _, version in constraints}
+    except UnsupportedVersionError:
+        # Not PEP 440 versions, so we can't reason about them. Leave them for conda to
+        # sort out:
+        return list(dict.fromkeys(constraints)), []
+
+    lower = upper = None
+    pins = []
+    exclusions = []
+    for op, version in constraints:
+        v = versions[version]
+        if op in ('>', '>=') and (
+            lower is None or v > lower[1] or (v == lower[1] and op == '>')
+        ):
+            lower = (op, v, version)
+        elif op in ('<', '<=') and (
+            upper is None or v < upper[1] or (v == upper[1] and op == '<')
+        ):
+            upper = (op, v, version)
+        elif op == '==' and version not in pins:
+            pins.append(version)
+        elif op == '!=' and version not in exclusions:
+            exclusions.append(version)
+
+    conflicts = []
+    if lower is not None and upper is not None:
+        if lower[1] > upper[1] or (
+            lower[1] == upper[1] and (lower[0] == '>' or upper[0] == '<')
+        ):
+            conflicts.append(f"{lower[0]}{lower[2]} and {upper[0]}{upper[2]}")
+    for i, pin in enumerate(pins):
+        pin_range = _pin_range(pin)
+        if pin_range is None:
+            continue
+        pin_lower, pin_upper = pin_range
+        for other in pins[i + 1 :]:
+            other_range = _pin_range(other)
+            if other_range is None:
+                continue
+            if pin_lower >= other_range[1] or other_range[0] >= pin_upper:
+                conflicts.append(f"=={pin} and =={other}")
+        if lower is not None and (
+            pin_upper <= lower[1] or (pin_upper == lower[1] and lower[0] == '>')
+        ):
+            conflicts.append(f"=={pin} and {lower[0]}{lower[2]}")
+        if upper is not None and (
+            pin_lower > upper[1] or (pin_lower == upper[1] and upper[0] == '<')
+        ):
+            conflicts.append(f"=={pin} and {upper[0]}{upper[2]}")
+
+    merged = [('==', pin) for pin in pins]
+    for bound in [lower, upper]:
+        if bound is not None:
+            merged.append((bound[0], bound[2]))
+    merged += [('!=', version) for version in exclusions]
+    return merged, conflicts
+
+
+def merge_requirements(requirements):
+    """Merge a list of requirements in conda format, as returned by
+    condify_requirement() but without selectors, such that there is one requirement
+    per package. Package names are normalised with condify_name(), and version
+    constraints on the same package are combined, keeping only the tightest lower and
+    upper bounds. Raises ValueError listing every package with conflicting constraints,
+    if any."""
+    grouped = {}
+    for requirement in requirements:
+        name, _, specifiers = requirement.strip().partition(' ')
+        constraints = grouped.setdefault(condify_name(name), [])
+        for specifier in split(specifiers):
+            for operator in ['==', '!=', '<=', '>=', '<', '>']:
+                if specifier.startswith(operator):
+                    constraints.append((operator, specifier[len(operator) :]))
+                    break
+            else:
+                raise ValueError(f"invalid specifier {specifier} for {name}")
+
+    merged = []
+    errors = []
+    for name, constraints in grouped.items():
+        constraints, conflicts = _merge_constraints(constraints)
+        for conflict in conflicts:
+            errors.append(f"{name}: {conflict}")
+        if constraints:
+            name += ' ' + ','.join(op + version for op, version in constraints)
+        merged.append(name)
+    if errors:
+        msg = "Conflicting requirements:\n    " + "\n    ".join(errors)
+        raise ValueError(msg)
+    return merged
+
+
 def get_setup_cfg_entry(proj, section, key, is_list=True):
     """Return setup_requires as read from proj/setup.cfg, if any"""
     setup_cfg = Path(proj, 'setup.cfg')
     if not setup_cfg.exists():
         return None
     config = configparser.ConfigParser()
-    config.read("setup.cfg")
+    config.read(setup_cfg)
     try:
         value = config.get(section, key)
     except (configparser.NoOptionError, configparser.NoSectionError):
@@ -319,21 +1482,326 @@ def get_pyproject_toml_entry(proj, *keys):
         return None
 
 
-def evaluate_requirements(entries):
-    """Evaluate env markers and return a list of the requirements that are needed in the
-    current environment required"""
+# Directories never considered part of a project's source when fingerprinting it, at
+# any depth:
+_FINGERPRINT_EXCLUDE_DIRS = {
+    '.git',
+    '.hg',
+    '.svn',
+    '__pycache__',
+    '.eggs',
+    '.tox',
+    '.nox',
+    '.venv',
+    '.pytest_cache',
+    '.mypy_cache',
+}
+
+# Default output directories of setuptools-conda's commands other than dist_conda,
+# relative to the directory they are run in, typically a project directory:
+GENERATED_DIRS = ['conda_build_multi', 'conda_mirror', 'conda_envs']
+
+# Environment variables that can affect the result of compiling a project's extensions,
+# and so are included in build input fingerprints:
+_FINGERPRINT_ENV_VARS = [
+    'CC',
+    'CXX',
+    'CFLAGS',
+    'CXXFLAGS',
+    'CPPFLAGS',
+    'LDFLAGS',
+    'LDSHARED',
+    'ARCHFLAGS',
+    'MACOSX_DEPLOYMENT_TARGET',
+    'SETUPTOOLS_SCM_PRETEND_VERSION',
+]
+
+
+def _vcs_files(project_dir):
+    # The paths, relative to project_dir, of the files in it that git tracks or would
+    # track, that is, that are not ignored, or None if it is not in a git repository
+    try:
+        output = runner.run(
+            ['git', 'ls-files', '-z', '--cached', '--others', '--exclude-standard'],
+            cwd=project_dir,
+            capture=True,
+        )
+    except (subprocess.CalledProcessError, OSError):
+        return None
+    return [Path(name) for name in output.split('\0') if name]
+
+
+def _walk_files(project_dir):
+    # The paths, relative to project_dir, of all files in it other than those in
+    # directories never considered source
+    for dirpath, dirnames, filenames in os.walk(project_dir):
+        dirnames[:] = [d for d in dirnames if d not in _FINGERPRINT_EXCLUDE_DIRS]
+        for filename in filenames:
+            yield Path(dirpath, filename).relative_to(project_dir)
+
+
+def source_fingerprint(project_dir, exclude=(), inputs=None):
+    """Return a sha256 hex digest of the paths and contents of the source files in
+    project_dir, combined with any additional build inputs given as a dict. If
+    project_dir is in a git repository, its source files are those git tracks or would
+    track, excluding ignored files, otherwise they are all the files in it other than
+    VCS metadata and caches. Either way, compiled Python files, *.egg-info directories,
+    the top-level 'build' and 'dist' directories and any further paths in exclude,
+    relative to project_dir, are ignored, along with everything inside them."""
+    project_dir = Path(project_dir).resolve()
+    excluded = []
+    for path in ['build', 'dist', *exclude]:
+        path = Path(project_dir, path).resolve()
+        if path != project_dir and project_dir in path.parents:
+            excluded.append(path.relative_to(project_dir).parts)
+    files = _vcs_files(project_dir)
+    if files is None:
+        files = _walk_files(project_dir)
+    h = hashlib.sha256()
+    for key, value in sorted((inputs or {}).items()):
+        h.update(f'{key}={value}\0'.encode('utf8'))
+    for relpath in sorted(files):
+        parts = relpath.parts
+        if relpath.suffix in ('.pyc', '.pyo'):
+            continue
+        if any(part in _FINGERPRINT_EXCLUDE_DIRS for part in parts[:-1]):
+            continue
+        if any(part.endswith('.egg-info') for part in parts[:-1]):
+            continue
+        if any(parts[: len(prefix)] == prefix for prefix in excluded):
+            continue
+        path = project_dir / relpath
+        if path.is_symlink():
+            h.update(relpath.as_posix().encode('utf8') + b'\0')
+            h.update(os.readlink(path).encode('utf8'))
+            continue
+        if not path.is_file():
+            # Deleted but still tracked, or a git submodule:
+            continue
+        h.update(relpath.as_posix().encode('utf8') + b'\0')
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+# Values of environment marker variables on each conda platform, for evaluating
+# requirements for platforms other than the current one:
+SUBDIR_MARKER_ENVIRONMENTS = {
+    'linux-64': {
+        'sys_platform': 'linux',
+        'platform_system': 'Linux',
+        'os_name': 'posix',
+        'platform_machine': 'x86_64',
+    },
+    'linux-aarch64': {
+        'sys_platform': 'linux',
+        'platform_system': 'Linux',
+        'os_name': 'posix',
+        'platform_machine': 'aarch64',
+    },
+    'linux-ppc64le': {
+        'sys_platform': 'linux',
+        'platform_system': 'Linux',
+        'os_name': 'posix',
+        'platform_machine': 'ppc64le',
+    },
+    'osx-64': {
+        'sys_platform': 'darwin',
+        'platform_system': 'Darwin',
+        'os_name': 'posix',
+        'platform_machine': 'x86_64',
+    },
+    'osx-arm64': {
+        'sys_platform': 'darwin',
+        'platform_system': 'Darwin',
+        'os_name': 'posix',
+        'platform_machine': 'arm64',
+    },
+    'win-64': {
+        'sys_platform': 'win32',
+        'platform_system': 'Windows',
+        'os_name': 'nt',
+        'platform_machine': 'AMD64',
+    },
+    'win-arm64': {
+        'sys_platform': 'win32',
+        'platform_system': 'Windows',
+        'os_name': 'nt',
+        'platform_machine': 'ARM64',
+    },
+}
+
+
+def current_subdir():
+    """Return the conda platform subdir, e.g. 'linux-64', of the running interpreter"""
+    for subdir, environment in SUBDIR_MARKER_ENVIRONMENTS.items():
+        if all(
+            distlib.markers.DEFAULT_CONTEXT[key] == value
+            for key, value in environment.items()
+        ):
+            return subdir
+    raise ValueError(f"Unknown platform {sys.platform} {platform.machine()}")
+
+
+def target_environment(subdir, python_version):
+    """Return a dict of environment marker variables for a CPython interpreter of the
+    given minor version, e.g. '3.12', on the given conda platform subdir"""
+    if subdir not in SUBDIR_MARKER_ENVIRONMENTS:
+        msg = f"""Unknown platform {subdir}, expected one of
+            {', '.join(SUBDIR_MARKER_ENVIRONMENTS)}"""
+        raise ValueError(' '.join(msg.split()))
+    environment = dict(SUBDIR_MARKER_ENVIRONMENTS[subdir])
+    environment.update(
+        python_version=python_version,
+        python_full_version=f'{python_version}.0',
+        implementation_name='cpython',
+        implementation_version=f'{python_version}.0',
+        platform_python_implementation='CPython',
+        platform_release='',
+        platform_version='',
+    )
+    return environment
+
+
+def _parse_requirement_markers(entries):
+    # Return a list of (requirement, marker) pairs for the given requirements, where
+    # marker is the parsed environment marker, if any, else None. Each distinct marker
+    # is parsed only once.
+    parsed_markers = {}
     requirements = []
     for entry in entries or []:
-        entry = entry.replace(" ", "")
-        if not entry:
+        requirement, _, marker = entry.partition(';')
+        requirement = requirement.replace(" ", "")
+        marker = marker.strip()
+        if not requirement:
             continue
-        if ';' not in entry:
-            requirements.append(entry)
-            continue
-        requirement, marker = entry.split(';', 1)
-        if distlib.markers.interpret(marker):
-            requirements.append(requirement)
-    return requirements
+        if marker and marker not in parsed_markers:
+            try:
+                expr, rest = parse_marker(marker)
+            except Exception as e:
+                msg = f'Unable to interpret marker syntax: {marker}: {e}'
+                raise SyntaxError(msg) from None
+            if rest and rest[0] != '#':
+                msg = f'unexpected trailing data in marker: {marker}: {rest}'
+                raise SyntaxError(msg)
+            parsed_markers[marker] = expr
+        requirements.append((requirement, marker or None))
+    return requirements, parsed_markers
+
+
+def evaluate_requirements_matrix(entries, environments):
+    """Evaluate env markers against each of the given target environments, which are
+    dicts of environment marker variables, as returned by target_environment(), to
+    override those of the current interpreter. Return a list containing, for each
+    environment, a list of the requirements needed in that environment. Each marker is
+    parsed once, regardless of the number of environments."""
+    requirements, parsed_markers = _parse_requirement_markers(entries)
+    evaluator = distlib.markers.Evaluator()
+    results = []
+    for environment in environments:
+        context = dict(distlib.markers.DEFAULT_CONTEXT)
+        context.update(environment)
+        values = {
+            marker: evaluator.evaluate(expr, context)
+            for marker, expr in parsed_markers.items()
+        }
+        results.append(
+            [
+                requirement
+                for requirement, marker in requirements
+                if marker is None or values[marker]
+            ]
+        )
+    return results
+
+
+def evaluate_requirements(entries):
+    """Evaluate env markers and return a list of the requirements that are needed in the
+    current environment required"""
+    return evaluate_requirements_matrix(entries, [{}])[0]
+
+
+# Python versions for which a project's requirements are checked to be the same, when
+# deciding whether it can be built noarch, unless specific versions are given:
+NOARCH_CHECK_PYTHONS = ['3.8', '3.9', '3.10', '3.11', '3.12', '3.13']
+
+# Package data files with these extensions are compiled code or other platform-specific
+# binaries:
+_BINARY_EXTENSIONS = {
+    '.so', '.pyd', '.dll', '.dylib', '.exe', '.lib', '.a', '.o', '.obj',
+}
+
+# Magic numbers of ELF, Windows PE and Mach-O files:
+_BINARY_MAGIC = (
+    b'\x7fELF',
+    b'MZ',
+    b'\xfe\xed\xfa\xce',
+    b'\xfe\xed\xfa\xcf',
+    b'\xce\xfa\xed\xfe',
+    b'\xcf\xfa\xed\xfe',
+    b'\xca\xfe\xba\xbe',
+)
+
+
+def is_binary_file(path):
+    """Whether the given file is a compiled binary such as a shared library or
+    executable, judging by its extension and its first few bytes"""
+    if os.path.splitext(path)[1].lower() in _BINARY_EXTENSIONS:
+        return True
+    with open(path, 'rb') as f:
+        header = f.read(4)
+    return header.startswith(_BINARY_MAGIC)
+
+
+def noarch_blockers(distribution, requirements, pythons=None, data_files=()):
+    """Return a list of reasons the given setuptools Distribution cannot be built as a
+    noarch conda package, which is empty if it can be. requirements is a dict mapping a
+    description of each set of requirements (e.g. 'run') to a list of them in setuptools
+    format. These must evaluate the same on all platforms and on each of the given
+    Python versions, which default to those in NOARCH_CHECK_PYTHONS allowed by the
+    project's python_requires. data_files is a list of paths of package data files,
+    which must not include compiled binaries."""
+    blockers = []
+    if distribution.ext_modules:
+        names = ', '.join(ext.name for ext in distribution.ext_modules)
+        blockers.append(f"has extension modules: {names}")
+    if distribution.has_c_libraries():
+        blockers.append("has C libraries")
+    if distribution.scripts:
+        names = ', '.join(os.path.basename(script) for script in distribution.scripts)
+        msg = f"has scripts, which are not portable across platforms: {names}"
+        blockers.append(msg)
+    entry_points = distribution.entry_points or {}
+    if isinstance(entry_points, dict) and entry_points.get('gui_scripts'):
+        msg = "has gui_scripts entry points, which noarch packages can't create"
+        blockers.append(msg)
+
+    if pythons is None:
+        pythons = NOARCH_CHECK_PYTHONS
+        if distribution.python_requires:
+            matcher = NormalizedMatcher(f'python ({distribution.python_requires})')
+            pythons = [python for python in pythons if matcher.match(python)]
+    environments = [
+        target_environment(subdir, python)
+        for subdir in SUBDIR_MARKER_ENVIRONMENTS
+        for python in pythons
+    ]
+    for description, entries in requirements.items():
+        results = evaluate_requirements_matrix(entries, environments)
+        varying = set()
+        for result in results:
+            varying.update(set(results[0]).symmetric_difference(result))
+        if varying:
+            msg = f"{description} requirements differ between platforms or Python "
+            msg += f"versions: {', '.join(sorted(varying))}"
+            blockers.append(msg)
+
+    binaries = [path for path in data_files if is_binary_file(path)]
+    if binaries:
+        blockers.append(f"has binary package data: {', '.join(binaries)}")
+    return blockers
 
 
 class dist_conda(Command):
@@ -444,6 +1912,21 @@ class dist_conda(Command):
                 automatically."""
             ),
         ),
+        (
+            'conda-name-database=',
+            None,
+            dedent(
+                """\
+                Path to a file of PyPI:conda name differences shared between projects,
+                as a JSON (if its name ends in '.json') or TOML file mapping PyPI names
+                to conda names, e.g. `{"PyQt5": "pyqt", "beautifulsoup4":
+                "beautiful-soup"}`. Names are matched after normalisation, ignoring case
+                and treating runs of '-', '_' and '.' as equivalent. Entries in
+                --conda-name-differences take precedence over those in the database.
+                Defaults to the value of the environment variable
+                SETUPTOOLS_CONDA_NAME_DATABASE, if set."""
+            ),
+        ),
         (
             'link-scripts=',
             None,
@@ -478,7 +1961,25 @@ class dist_conda(Command):
                 compiler configuration, you might set this option to pass conda-build a
                 wheel that has been pre-compiled with the system configuration. In this
                 case, setuptools-conda will only produce a conda package for the current
-                Python version."""
+                Python version. The `build` directory is not cleaned in this mode so
+                that extensions may be compiled incrementally, and if neither the
+                project's source nor the build environment has changed since the last
+                wheel was built, that wheel is reused."""
+            ),
+        ),
+        (
+            'universal-wheel',
+            None,
+            dedent(
+                """\
+                For pure-Python projects built for several Python versions, build a
+                `py3-none-any` wheel once, with the current Python, and have conda-build
+                install that same wheel for every Python version, with `pip install
+                --no-deps --no-build-isolation --no-index`, instead of building it from
+                the sdist separately for each. As with --from-wheel, the wheel is reused
+                if neither the project's source nor the build environment has changed
+                since it was last built. Can't be used with projects that have compiled
+                extensions."""
             ),
         ),
         (
@@ -517,10 +2018,314 @@ class dist_conda(Command):
 
             ),
         ),
+        (
+            'fast',
+            None,
+            dedent(
+                """\
+                Fast-iterate mode for the edit-build-test loop. Runs conda-build with
+                --dirty so that its work directory and host environment are kept after
+                the build, and reuses them on the next build with --fast, provided the
+                build requirements, channels, compilers and Python version are unchanged
+                - skipping the creation of the host environment, which is often the
+                slowest part of a build. If they have changed, a full build is done
+                instead. The project is re-unpacked into a fresh work directory and
+                uninstalled from the reused host environment before each build. Only
+                a single Python version may be built in this mode."""
+            ),
+        ),
+        (
+            'parallel',
+            None,
+            dedent(
+                """\
+                Make the build safe to run concurrently with other builds of the same
+                project, for example for different Python versions. The recipe,
+                temporary files and conda-build's croot are placed in a unique
+                subdirectory <build-dir>/jobs/<job-id> (and <croot>/<job-id> if --croot
+                is given), logs in <log-dir>/<job-id>, the setuptools `build` directory
+                is not cleaned, and running sdist or bdist_wheel is serialised with
+                other builds. Cannot be used with --fast."""
+            ),
+        ),
+        (
+            'compiler-cache=',
+            None,
+            dedent(
+                """\
+                Compiler cache to use when building extensions, either 'ccache' or
+                'sccache', so that unchanged source files are not recompiled in
+                subsequent builds or for other Python versions. The tool is added to the
+                build requirements and the C and C++ compilers are invoked through it,
+                with its cache kept in --compiler-cache-dir. Only applies to projects
+                with extensions, and not with --from-wheel. Not supported on Windows."""
+            ),
+        ),
+        (
+            'compiler-cache-dir=',
+            None,
+            dedent(
+                """\
+                Directory in which to keep the compiler cache used with
+                --compiler-cache. Defaults to a directory named after the tool in the
+                user's cache directory, e.g. ~/.cache/setuptools-conda/ccache."""
+            ),
+        ),
+        (
+            'cpus=',
+            None,
+            dedent(
+                """\
+                Number of CPUs the build may use for compiling. Sets the CPU_COUNT,
+                MAKEFLAGS (-j<cpus>) and CMAKE_BUILD_PARALLEL_LEVEL environment
+                variables for conda-build and the build script. Defaults to
+                conda-build's default of all CPUs, or with --governor, a quarter of the
+                CPU budget (at least one)."""
+            ),
+        ),
+        (
+            'memory=',
+            None,
+            dedent(
+                """\
+                Memory in GB the build is expected to need, reserved from the memory
+                budget with --governor. Default: 0."""
+            ),
+        ),
+        (
+            'governor',
+            None,
+            dedent(
+                """\
+                Schedule conda-build against a CPU and memory budget shared by all
+                builds on this machine that use this option, for running many builds
+                concurrently, e.g. with --parallel, without oversubscribing the machine.
+                Each build reserves --cpus CPUs and --memory GB for the duration of
+                conda-build, waiting until enough of the budget is free. The budget
+                defaults to the CPUs available to the process (its CPU affinity and any
+                cgroup CPU quota) and the lower of the physical memory of the machine
+                and any cgroup memory limit, and can be set with the
+                SETUPTOOLS_CONDA_CPU_BUDGET and SETUPTOOLS_CONDA_MEMORY_BUDGET
+                environment variables (memory in GB). Reservations are recorded in the
+                user's cache directory, e.g.
+                ~/.cache/setuptools-conda/governor."""
+            ),
+        ),
+        (
+            'log-dir=',
+            None,
+            dedent(
+                """\
+                Directory in which to save the output of each phase of the build
+                (sdist, bdist_wheel, pip-download and conda-build) as gzip-compressed
+                log files, instead of printing it. Only a progress line is printed while
+                each phase runs, and if a phase fails, the last lines of its output are
+                printed. Useful for keeping CI logs small, since conda-build is very
+                verbose. By default, all output is printed."""
+            ),
+        ),
+        (
+            'log-tail=',
+            None,
+            dedent(
+                """\
+                Number of lines of output to print when a phase of the build fails, if
+                --log-dir is set. Defaults to 50."""
+            ),
+        ),
+        (
+            'check-noarch',
+            None,
+            dedent(
+                """\
+                Check whether the project can be built as a noarch package and print
+                the result, without building anything. A project can be built noarch if
+                it has no extension modules, C libraries, scripts, gui_scripts entry
+                points or binary package data, and if its build and run requirements are
+                the same on all platforms and Python versions - that is, any environment
+                markers evaluate the same everywhere. Requirements are checked for the
+                Python versions given by `pythons` if set, otherwise for all recent
+                Python versions allowed by the project's `python_requires`."""
+            ),
+        ),
+        (
+            'auto-noarch',
+            None,
+            dedent(
+                """\
+                Run the check done by --check-noarch, and if the project can be built
+                noarch, build a single noarch package instead of one per Python version.
+                Otherwise, build as normal. Has no effect if `noarch` is set."""
+            ),
+        ),
+        (
+            'test',
+            None,
+            dedent(
+                """\
+                Smoke-test the built packages before copying them to the output
+                directory. For each Python version, a test environment containing the
+                package's run requirements is created, all in parallel, and the newly
+                built package is installed into a temporary clone of it from
+                conda-build's local channel. Then the package's top-level modules are
+                imported, and each of its console_scripts entry points is run with
+                `--help`. Test environments are kept in `test-env-dir`, unmodified by
+                the tests, and reused by later builds with the same Python version, run
+                requirements and channels. Results are reported for each
+                Python version, and if any fail, no packages are copied to the output
+                directory."""
+            ),
+        ),
+        (
+            'test-imports=',
+            None,
+            dedent(
+                """\
+                Comma-separated list of modules to import when testing the package with
+                --test, or a list of strings if specified in
+                `pyproject.toml/[tool.setuptools_conda]` or passed into `setup()` via
+                `command_options`. Defaults to the project's top-level packages and
+                modules."""
+            ),
+        ),
+        (
+            'test-env-dir=',
+            None,
+            dedent(
+                """\
+                Directory in which to keep test environments created by --test. Defaults
+                to a 'test-envs' directory in the user's cache directory, e.g.
+                ~/.cache/setuptools-conda/test-envs."""
+            ),
+        ),
+        (
+            'verify',
+            None,
+            dedent(
+                """\
+                Verify the packages after copying them to the output directory, by
+                reading their metadata as a stream without extracting them. Checks that
+                each package has the expected name, version, noarch setting and
+                dependencies, provides the project's console_scripts entry points,
+                includes the license file if there is one, and contains every Python
+                module and package data file from the sdist (or wheel). Packages are
+                verified concurrently. Verifying .conda packages requires the
+                `zstandard` module."""
+            ),
+        ),
+        (
+            'setup-py-subprocess',
+            None,
+            dedent(
+                """\
+                Run the `sdist` or `bdist_wheel` command used to produce the source for
+                the conda package by running setup.py in a subprocess. By default these
+                commands are run in the same process as `dist_conda`, on the already
+                loaded project, unless --log-dir is given, in which case a subprocess is
+                always used so that its output can be logged."""
+            ),
+        ),
+        (
+            'reproducible-sdist',
+            None,
+            dedent(
+                """\
+                Make the sdist built as the source of the conda package reproducible, so
+                that building the same source twice gives an identical archive with the
+                same sha256. Archive members are sorted by name and have their
+                timestamps set to the value of the SOURCE_DATE_EPOCH environment
+                variable, or if not set, the time of the last git commit touching the
+                project directory, or if not in a git repository, the newest timestamp
+                of any file in the sdist.
+                File ownership and permissions and the gzip header are also normalised.
+                Has no effect with --from-wheel or --from-downloaded-wheel."""
+            ),
+        ),
+        (
+            'manifest',
+            None,
+            dedent(
+                """\
+                Write a manifest of the contents of each package to the output
+                directory alongside it, as `<package filename>.manifest.json`, listing
+                the size of every file in the package and the compressed size of the
+                package. The manifest is compared to that of the most recent previous
+                build of the same package for the same Python version, if any, and a
+                summary of the differences printed, with a warning if the package size
+                or number of files has grown by more than the thresholds set by
+                --manifest-size-warning and --manifest-files-warning. Packages
+                are read as a stream without extracting them. Reading .conda packages
+                requires the `zstandard` module."""
+            ),
+        ),
+        (
+            'manifest-size-warning=',
+            None,
+            dedent(
+                """\
+                Percentage increase in package size relative to the previous build above
+                which --manifest prints a warning. Default: 10."""
+            ),
+        ),
+        (
+            'manifest-files-warning=',
+            None,
+            dedent(
+                """\
+                Percentage increase in the number of files in a package relative to the
+                previous build above which --manifest prints a warning. Default: 10."""
+            ),
+        ),
+        (
+            'keep-last=',
+            None,
+            dedent(
+                """\
+                After copying packages to the output directory, remove older packages
+                from it, keeping only this many of the most recent builds of each
+                package name, version and Python version. Manifests written by
+                --manifest are removed along with their packages, and packages' records
+                are removed from the repodata.json of any subdir of the output directory
+                that has one. The packages just built are never removed. See also
+                `setuptools-conda gc`."""
+            ),
+        ),
+        (
+            'max-size=',
+            None,
+            dedent(
+                """\
+                After copying packages to the output directory, remove the oldest
+                packages from it until the total size of all packages in it is at most
+                this size, e.g. '500M' or '20G'. Applied after --keep-last if both are
+                given, and in the same way."""
+            ),
+        ),
+        (
+            'shard=',
+            None,
+            dedent(
+                """\
+                Build only this machine's share of the build matrix, when spreading
+                builds over several machines, given as 'i/N' for the i'th of N shards,
+                e.g. '2/4'. The Python versions being built for are divided between the
+                shards deterministically, and with noarch a single shard builds the
+                package, so that running every shard on the same project builds each
+                package exactly once. `pythons` must therefore be given explicitly.
+                Packages are copied to the output directory
+                `conda_packages_shard_<i>_of_<N>` instead of `conda_packages`, and the
+                shards' output directories can then be combined with `setuptools-conda
+                merge`. A shard with nothing to build does nothing."""
+            ),
+        ),
     ]
 
     DIST_DIR = 'conda_packages'
 
+    # Where wheels built in from_wheel and universal_wheel modes are kept for reuse,
+    # along with a fingerprint of the source and build inputs that produced them:
+    WHEEL_CACHE_DIR = os.path.join('build', 'dist_conda_wheel')
+
     def initialize_options(self):
 
         # Initialise options from any present in pyproject.toml [tool.setuptools_conda]
@@ -553,13 +2358,48 @@ class dist_conda(Command):
         self.pythons = pyproject_toml_options.get('pythons', [])
         self.build_number = pyproject_toml_options.get('build_number', 0)
         self.conda_name_differences = pyproject_toml_options.get('conda_name_differences', {})
+        self.conda_name_database = pyproject_toml_options.get('conda_name_database')
         self.build_string = pyproject_toml_options.get('build_string')
         self.link_scripts = pyproject_toml_options.get('link_scripts', {})
         self.noarch = pyproject_toml_options.get('noarch', False)
         self.from_wheel = pyproject_toml_options.get('from_wheel', False)
         self.from_downloaded_wheel = pyproject_toml_options.get('from_downloaded_wheel', False)
+        self.universal_wheel = pyproject_toml_options.get('universal_wheel', False)
         self.build_dir = pyproject_toml_options.get('build_dir', 'conda_build')
         self.croot = pyproject_toml_options.get('croot')
+        self.fast = pyproject_toml_options.get('fast', False)
+        self.parallel = pyproject_toml_options.get('parallel', False)
+        self.cpus = pyproject_toml_options.get('cpus')
+        self.memory = pyproject_toml_options.get('memory', 0)
+        self.governor = pyproject_toml_options.get('governor', False)
+        self.compiler_cache = pyproject_toml_options.get('compiler_cache')
+        self.compiler_cache_dir = pyproject_toml_options.get('compiler_cache_dir')
+        self.log_dir = pyproject_toml_options.get('log_dir')
+        self.log_tail = pyproject_toml_options.get(
+            'log_tail', runner.DEFAULT_TAIL_LINES
+        )
+        self.check_noarch = pyproject_toml_options.get('check_noarch', False)
+        self.auto_noarch = pyproject_toml_options.get('auto_noarch', False)
+        self.test = pyproject_toml_options.get('test', False)
+        self.test_imports = pyproject_toml_options.get('test_imports')
+        self.test_env_dir = pyproject_toml_options.get('test_env_dir')
+        self.verify = pyproject_toml_options.get('verify', False)
+        self.setup_py_subprocess = pyproject_toml_options.get(
+            'setup_py_subprocess', False
+        )
+        self.reproducible_sdist = pyproject_toml_options.get(
+            'reproducible_sdist', False
+        )
+        self.manifest = pyproject_toml_options.get('manifest', False)
+        self.manifest_size_warning = pyproject_toml_options.get(
+            'manifest_size_warning', 10
+        )
+        self.manifest_files_warning = pyproject_toml_options.get(
+            'manifest_files_warning', 10
+        )
+        self.keep_last = pyproject_toml_options.get('keep_last')
+        self.max_size = pyproject_toml_options.get('max_size')
+        self.shard = pyproject_toml_options.get('shard')
 
     def finalize_options(self):
         if self.license is not None:
@@ -578,38 +2418,29 @@ class dist_conda(Command):
             raise ValueError("License file %s 'doesn't exist'" % self.license_file)
 
         if isinstance(self.conda_name_differences, str):
-            self.conda_name_differences = dict(
-                split(item, ':') for item in split(self.conda_name_differences)
+            self.conda_name_differences = parse_name_differences(
+                split(self.conda_name_differences)
             )
+        self.conda_name_differences = name_mapping(
+            self.conda_name_differences, self.conda_name_database
+        )
 
-        if self.setup_requires is None:
-            setup_requires = get_pyproject_toml_entry('.', 'build-system', 'requires')
-            if setup_requires is None:
-                setup_requires = self.distribution.setup_requires
-            self.SETUP_REQUIRES = condify_requirements(
-                setup_requires, self.conda_name_differences
-            )
-        else:
-            if isinstance(self.setup_requires, str):
-                self.setup_requires = split(self.setup_requires)
-            self.SETUP_REQUIRES = condify_requirements(
-                self.setup_requires, self.conda_name_differences
-            )
+        if isinstance(self.setup_requires, str):
+            self.setup_requires = split(self.setup_requires)
+        if isinstance(self.install_requires, str):
+            self.install_requires = split(self.install_requires)
 
-        if self.install_requires is None:
-            self.RUN_REQUIRES = condify_requirements(
-                get_all_requires(
-                    self.distribution.install_requires,
-                    self.distribution.extras_require,
-                ),
-                self.conda_name_differences,
-            )
-        else:
-            if isinstance(self.install_requires, str):
-                self.install_requires = split(self.install_requires)
-            self.RUN_REQUIRES = condify_requirements(
-                self.install_requires, self.conda_name_differences
-            )
+        # Report all invalid requirements at once, before anything is built:
+        check_requirements(
+            self.get_setup_requires() + self.get_install_requires(),
+            self.conda_name_differences,
+        )
+        self.SETUP_REQUIRES = condify_requirements(
+            self.get_setup_requires(), self.conda_name_differences
+        )
+        self.RUN_REQUIRES = condify_requirements(
+            self.get_install_requires(), self.conda_name_differences
+        )
 
         if isinstance(self.ignore_run_exports, str):
             self.ignore_run_exports = split(self.ignore_run_exports)
@@ -631,6 +2462,10 @@ class dist_conda(Command):
             self.link_scripts = link_scripts
 
         self.noarch = bool(self.noarch)
+        self.check_noarch = bool(self.check_noarch)
+        self.auto_noarch = bool(self.auto_noarch) and not self.noarch
+        # Python versions given explicitly, if any, for checking noarch eligibility:
+        self.noarch_check_pythons = list(self.pythons) or None
 
         if self.pythons and self.noarch:
             msg = """Can't specify `pythons` and `noarch` simultaneously"""
@@ -646,66 +2481,293 @@ class dist_conda(Command):
             msg = """Can't specify `pythons` if `from_wheel` is set"""
             raise ValueError(msg)
 
+        self.universal_wheel = bool(self.universal_wheel)
+
+        if self.universal_wheel and (self.from_wheel or self.from_downloaded_wheel):
+            msg = """Can't specify `universal_wheel` with `from_wheel` or
+                `from_downloaded_wheel`"""
+            raise ValueError(' '.join(msg.split()))
+
+        if self.universal_wheel and self.distribution.ext_modules:
+            msg = """Can't specify `universal_wheel` for a project with compiled
+                extensions"""
+            raise ValueError(' '.join(msg.split()))
+
+        self.fast = bool(self.fast)
+
+        if len(self.pythons) > 1 and self.fast:
+            msg = """Can't specify multiple `pythons` if `fast` is set"""
+            raise ValueError(msg)
+
+        self.parallel = bool(self.parallel)
+
+        if self.parallel and self.fast:
+            msg = """Can't specify `parallel` and `fast` simultaneously"""
+            raise ValueError(msg)
+
+        if self.compiler_cache is not None:
+            if self.compiler_cache not in ('ccache', 'sccache'):
+                msg = "`compiler_cache` must be 'ccache' or 'sccache', "
+                msg += f"not {self.compiler_cache!r}"
+                raise ValueError(msg)
+            if WINDOWS:
+                raise ValueError("`compiler_cache` is not supported on Windows")
+            if self.compiler_cache_dir is None:
+                self.compiler_cache_dir = os.path.join(
+                    user_cache_dir(), self.compiler_cache
+                )
+            self.compiler_cache_dir = os.path.abspath(self.compiler_cache_dir)
+
+        self.governor = bool(self.governor)
+        self.memory = float(self.memory)
+        if self.cpus is not None:
+            self.cpus = int(self.cpus)
+            if self.cpus < 1:
+                raise ValueError("`cpus` must be at least 1")
+        elif self.governor:
+            cpu_budget, _ = resource_budget()
+            self.cpus = max(1, int(cpu_budget // GOVERNOR_DEFAULT_CPU_SHARE))
+
+        # The build directory as configured, which in parallel mode is shared between
+        # jobs, each of which uses a subdirectory of it as its build_dir:
+        self.build_root = self.build_dir
+        if self.parallel:
+            self.job_id = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+            self.build_dir = os.path.join(self.build_root, 'jobs', self.job_id)
+            if self.croot is not None:
+                self.croot = os.path.join(self.croot, self.job_id)
+            if self.log_dir is not None:
+                self.log_dir = os.path.join(self.log_dir, self.job_id)
+
+        if self.shard is not None:
+            self.shard = parse_shard(self.shard)
+            if not (self.pythons or self.noarch):
+                msg = """Can't specify `shard` without `pythons`, unless `noarch` is
+                    set"""
+                raise ValueError(' '.join(msg.split()))
+        # Where packages are copied to:
+        self.dist_dir = shard_dist_dir(self.DIST_DIR, self.shard)
+
         if not self.pythons:
             self.pythons = [f'{sys.version_info.major}.{sys.version_info.minor}']
 
         if self.croot is None:
             self.croot = os.path.join(self.build_dir, 'conda-bld')
 
-    def run(self):
-        # Clean
-        shutil.rmtree(self.build_dir, ignore_errors=True)
-        self.recipe_dir = os.path.join(self.build_dir, 'recipe')
-        shutil.rmtree('build', ignore_errors=True)
-        os.makedirs(self.recipe_dir)
+        self.log_tail = int(self.log_tail)
+
+        # Paths of the packages produced, and time taken by each phase of the build in
+        # seconds, for callers running the command programmatically:
+        self.artifacts = []
+        self.timings = {}
+
+        self.test = bool(self.test)
+        if self.test_imports is None:
+            packages = self.distribution.packages or []
+            modules = self.distribution.py_modules or []
+            self.test_imports = [name for name in packages + modules if '.' not in name]
+        elif isinstance(self.test_imports, str):
+            self.test_imports = split(self.test_imports)
+        if self.test_env_dir is None:
+            self.test_env_dir = os.path.join(user_cache_dir(), 'test-envs')
+
+        self.verify = bool(self.verify)
+        self.setup_py_subprocess = bool(self.setup_py_subprocess)
+        self.reproducible_sdist = bool(self.reproducible_sdist)
+        self.manifest = bool(self.manifest)
+        self.manifest_size_warning = float(self.manifest_size_warning)
+        self.manifest_files_warning = float(self.manifest_files_warning)
+        if self.keep_last is not None:
+            self.keep_last = int(self.keep_last)
+            if self.keep_last < 1:
+                raise ValueError("`keep_last` must be at least 1")
+        if self.max_size is not None:
+            self.max_size = parse_size(self.max_size)
+
+    def get_setup_requires(self):
+        """Return the build requirements in setuptools format, with any environment
+        markers not yet evaluated"""
+        if self.setup_requires is not None:
+            return self.setup_requires
+        setup_requires = get_pyproject_toml_entry('.', 'build-system', 'requires')
+        if setup_requires is None:
+            setup_requires = self.distribution.setup_requires
+        return setup_requires or []
+
+    def get_install_requires(self):
+        """Return the run requirements in setuptools format, with any environment
+        markers not yet evaluated"""
+        if self.install_requires is not None:
+            return self.install_requires
+        return get_all_requires(
+            self.distribution.install_requires, self.distribution.extras_require
+        )
 
-        if self.from_downloaded_wheel:
-            # Download a wheel:
-            cmd = [
-                'pip',
-                'download',
-                '--only-binary=:all:',
-                '--python-version',
-                self.pythons[0],
-                '--no-deps',
-                '--dest',
-                self.build_dir,
-                f'{self.NAME}=={self.VERSION}',
-            ]
-            run(cmd)
+    def get_noarch_blockers(self):
+        """Return a list of reasons the project cannot be built noarch, empty if it
+        can be."""
+        build_py = self.get_finalized_command('build_py')
+        data_files = [
+            os.path.join(src_dir, filename)
+            for _, src_dir, _, filenames in build_py.data_files
+            for filename in filenames
+        ]
+        return noarch_blockers(
+            self.distribution,
+            {'build': self.get_setup_requires(), 'run': self.get_install_requires()},
+            pythons=self.noarch_check_pythons,
+            data_files=data_files,
+        )
 
-        else:
-            # Run sdist or bdist_wheel to make a source tarball or wheel in the recipe
-            # dir:
-            cmd = [sys.executable, *setup_py('.')]
-            if self.from_wheel:
-                cmd += ['bdist_wheel']
+    def test_packages(self, pkgs):
+        """Smoke-test the given built packages in a test environment per Python
+        version, raising RuntimeError if any tests fail"""
+        subdir = current_subdir()
+        channel = os.path.abspath(self.croot)
+        # Python version each package depends on, from its metadata, since its
+        # filename need not say (e.g. with build_string set):
+        pkg_pythons = {}
+        if not self.noarch:
+            for pkg in pkgs:
+                index = verify.read_package_info(pkg)['index']
+                pkg_pythons[pkg] = package_python_version(index.get('depends', []))
+        # Environment for each Python version, and the package to test in it:
+        variants = {}
+        for python in self.pythons:
+            if self.noarch:
+                matching = pkgs
             else:
-                cmd += ['sdist', '--formats=gztar']
-            cmd += ['--dist-dir=' + self.build_dir]
-
-        run(cmd)
+                matching = [pkg for pkg in pkgs if pkg_pythons[pkg] == python]
+            if not matching:
+                raise RuntimeError(f"No built package found for Python {python}")
+            run_requires = [
+                condify_requirement(requirement, self.conda_name_differences)
+                for requirement in evaluate_requirements_matrix(
+                    self.get_install_requires(), [target_environment(subdir, python)]
+                )[0]
+            ]
+            spec = {
+                'subdir': subdir,
+                'python': python,
+                'run_requires': run_requires,
+                'channels': self.channels,
+            }
+            spec_hash = hashlib.sha256(json.dumps(spec, sort_keys=True).encode())
+            prefix = os.path.join(self.test_env_dir, spec_hash.hexdigest()[:16])
+            variants[python] = (prefix, spec, matching[0])
 
-        if self.from_wheel or self.from_downloaded_wheel:
-            dist = [p for p in os.listdir(self.build_dir) if p.endswith('.whl')][0]
+        channel_args = []
+        for chan in self.channels:
+            channel_args += ['-c', chan]
+        # Reason each variant failed, if it did:
+        failures = {}
+
+        def run_variants(phase, commands):
+            # Run a command for each variant still passing, in parallel, recording any
+            # that fail. commands is a dict mapping each variant to a list of commands,
+            # which are run in parallel with each other as well.
+            jobs = []
+            for python, variant_commands in commands.items():
+                for cmd in variant_commands:
+                    kwargs = self.log_options(f'{phase}-py{python}')
+                    kwargs.setdefault('name', f'{phase}-py{python}')
+                    jobs.append((python, runner.Job(cmd, shell=WINDOWS, **kwargs)))
+            results = runner.run_jobs([job for _, job in jobs], return_exceptions=True)
+            for (python, job), result in zip(jobs, results):
+                if isinstance(result, BaseException) and python not in failures:
+                    if not isinstance(result, (subprocess.SubprocessError, OSError)):
+                        raise result
+                    failures[python] = f"{phase} failed: {shlex.join(job.cmd)}"
+
+        os.makedirs(self.test_env_dir, exist_ok=True)
+        with contextlib.ExitStack() as stack:
+            # Hold a lock on each environment while we use it, so that concurrent builds
+            # don't modify it under us. Lock in sorted order to avoid deadlocks:
+            for prefix in sorted({prefix for prefix, _, _ in variants.values()}):
+                stack.enter_context(file_lock(prefix + '.lock'))
+
+            to_create = {}
+            for python, (prefix, spec, _) in variants.items():
+                spec_file = os.path.join(prefix, 'setuptools_conda_test_env.json')
+                if os.path.exists(spec_file):
+                    print(f"Reusing test environment for Python {python}: {prefix}")
+                    # Record the use, for garbage collection of unused environments:
+                    os.utime(spec_file)
+                    continue
+                shutil.rmtree(prefix, ignore_errors=True)
+                cmd = ['conda', 'create', '-y', '-p', prefix] + channel_args
+                cmd += [f'python={python}'] + spec['run_requires']
+                to_create[python] = [cmd]
+            run_variants('test-env', to_create)
+            for python in to_create:
+                prefix, spec, _ = variants[python]
+                if python in failures:
+                    shutil.rmtree(prefix, ignore_errors=True)
+                    continue
+                spec_file = os.path.join(prefix, 'setuptools_conda_test_env.json')
+                with open(spec_file, 'w') as f:
+                    json.dump(spec, f, indent=4)
+
+            # The package is installed into a throwaway clone of each environment, so
+            # that the environments themselves keep matching their specs:
+            clones = {
+                python: f'{prefix}-test-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+                for python, (prefix, _, _) in variants.items()
+            }
+            for clone in clones.values():
+                stack.callback(shutil.rmtree, clone, ignore_errors=True)
+            to_clone = {}
+            for python, (prefix, _, _) in variants.items():
+                if python not in failures:
+                    cmd = ['conda', 'create', '-y', '--offline', '-p', clones[python]]
+                    cmd += ['--clone', prefix]
+                    to_clone[python] = [cmd]
+            run_variants('test-clone', to_clone)
+
+            to_install = {}
+            for python, (_, _, pkg) in variants.items():
+                if python not in failures:
+                    name, version, build_string = split_package_filename(pkg)
+                    cmd = ['conda', 'install', '-y', '-p', clones[python], '--no-deps']
+                    cmd += ['-c', channel, f'{name}={version}={build_string}']
+                    to_install[python] = [cmd]
+            run_variants('test-install', to_install)
+
+            to_test = {}
+            for python in variants:
+                if python in failures:
+                    continue
+                prefix = clones[python]
+                to_test[python] = []
+                if self.test_imports:
+                    imports = '; '.join(f'import {name}' for name in self.test_imports)
+                    python_exe = prefix_executable(prefix, 'python')
+                    to_test[python].append([python_exe, '-c', imports])
+                entry_points = self.distribution.entry_points or {}
+                for entry_point in entry_points.get('console_scripts', []):
+                    script = entry_point.split('=', 1)[0].strip()
+                    executable = prefix_executable(prefix, script)
+                    to_test[python].append([executable, '--help'])
+            run_variants('test', to_test)
+
+        print("Test results:")
+        for python in self.pythons:
+            print(f"    Python {python}: {failures.get(python, 'passed')}")
+        if failures:
+            failed = [python for python in self.pythons if python in failures]
+            raise RuntimeError(f"Tests failed for Python {', '.join(failed)}")
+
+    def package_details(self, dist, sha256):
+        """Return the contents of the recipe's meta.yaml, as a dict, for building from
+        the given sdist or wheel filename in the build directory, with the given
+        sha256 hash"""
+        if self.universal_wheel:
+            pip_target = f'--no-deps --no-build-isolation --no-index {dist}'
+        elif self.from_wheel or self.from_downloaded_wheel:
+            pip_target = dist
         else:
-            dist = f'{self.distribution.get_fullname()}.tar.gz'
-
-        with open(os.path.join(self.build_dir, dist), 'rb') as f:
-            sha256 = hashlib.sha256(f.read()).hexdigest()
-
-        # Build config:
-        build_config_yaml = os.path.join(self.recipe_dir, 'conda_build_config.yaml')
-        build_config = {'python': self.pythons}
-        vsversion = get_visual_studio_version()
-        if vsversion is not None:
-            build_config['c_compiler'] = build_config['cxx_compiler'] = [f"vs{vsversion}"]
-        with open(build_config_yaml, 'w') as f:
-            f.write('\n'.join(yaml_lines(build_config)))
+            pip_target = '.'
 
-        pip_target = dist if (self.from_wheel or self.from_downloaded_wheel) else '.'
-
-        # Recipe:
         package_details = {
             'package': {'name': self.NAME, 'version': self.VERSION,},
             'source': {'url': f'../{dist}', 'sha256': sha256},
@@ -731,23 +2793,541 @@ class dist_conda(Command):
             package_details['build']['string'] = self.build_string
         if self.ignore_run_exports:
             package_details['build']['ignore_run_exports'] = self.ignore_run_exports
+        if self.cpus is not None:
+            # conda-build passes CPU_COUNT to the build script already:
+            package_details['build']['script_env'] = [
+                'MAKEFLAGS',
+                'CMAKE_BUILD_PARALLEL_LEVEL',
+            ]
         if self.distribution.entry_points is not None:
             console_scripts = self.distribution.entry_points.get('console_scripts', [])
             gui_scripts = self.distribution.entry_points.get('gui_scripts', [])
             package_details['build']['entry_points'] = console_scripts + gui_scripts
         if self.license_file is not None:
-            shutil.copy(self.license_file, self.build_dir)
-            package_details['about']['license_file'] = f'../{self.license_file}'
-
-        if self.distribution.ext_modules is not None and not self.from_wheel:
-            compilers = ["{{ compiler('c') }}", "{{ compiler('cxx') }}"]
-            package_details['requirements']['build'].extend(compilers)
+            license_file = os.path.basename(self.license_file)
+            package_details['about']['license_file'] = f'../{license_file}'
+
+        build_requires = self.build_environment_requires()
+        if build_requires:
+            package_details['requirements']['build'] = build_requires
+            if self.compiler_cache is not None:
+                tool = self.compiler_cache
+                # $CC and $CXX are set by the compilers' activation scripts, so can only
+                # be wrapped within the build script:
+                package_details['build']['script'] = (
+                    f'export CC="{tool} $CC" CXX="{tool} $CXX" && '
+                    + package_details['build']['script']
+                )
+                package_details['build'].setdefault('script_env', []).extend(
+                    self.compiler_cache_environment()
+                )
         else:
             # No need for this section then:
             del package_details['requirements']['build']
+        return package_details
+
+    def build_environment_requires(self):
+        """Return the requirements of conda-build's build environment, as opposed to its
+        host environment, as given in the recipe: the C and C++ compilers as
+        `compiler()` Jinja expressions if the project has extension modules to compile,
+        and the compiler cache tool if there is one"""
+        if self.distribution.ext_modules is None or self.from_wheel:
+            return []
+        requires = ["{{ compiler('c') }}", "{{ compiler('cxx') }}"]
+        if self.compiler_cache is not None:
+            requires.append(self.compiler_cache)
+        return requires
+
+    def installed_files(self):
+        """Return glob patterns, relative to the installation prefix, matching the files
+        installed by pip installing the project: its top-level packages and modules,
+        its dist-info directory, and its entry point scripts"""
+        names = [
+            name for name in self.distribution.packages or [] if '.' not in name
+        ]
+        names += [f'{name}.py' for name in self.distribution.py_modules or []]
+        # pip and setuptools have normalised dist-info names in different ways over
+        # time:
+        project_name = self.distribution.get_name()
+        for dist_info_name in dict.fromkeys(
+            [
+                re.sub(r'[^\w.]+', '_', project_name),
+                re.sub(r'[-_.]+', '_', project_name).lower(),
+            ]
+        ):
+            names.append(f'{dist_info_name}-*.dist-info')
+        files = [
+            f'{site_packages}/{name}'
+            for site_packages in ['lib/python*/site-packages', 'Lib/site-packages']
+            for name in names
+        ]
+        entry_points = self.distribution.entry_points or {}
+        for group in ['console_scripts', 'gui_scripts']:
+            for entry_point in entry_points.get(group, []):
+                script = entry_point.split('=', 1)[0].strip()
+                files += [
+                    f'bin/{script}',
+                    f'Scripts/{script}.exe',
+                    f'Scripts/{script}-script.py',
+                ]
+        return files
+
+    def site_packages_files(self):
+        """Return the paths, relative to site-packages, of the Python modules and
+        package data files in the sdist or wheel that was built, which the conda package
+        should contain"""
+        if self.dist_file.endswith('.whl'):
+            with zipfile.ZipFile(self.dist_file) as whl:
+                return [
+                    name
+                    for name in whl.namelist()
+                    if not name.endswith('/')
+                    and not name.split('/', 1)[0].endswith(('.dist-info', '.data'))
+                ]
+        members = verify.sdist_members(self.dist_file)
+        build_py = self.get_finalized_command('build_py')
+        files = []
+        for package, module, filename in build_py.find_all_modules():
+            if Path(filename).as_posix() in members:
+                path = '/'.join(package.split('.') + [f'{module}.py'])
+                files.append(path.lstrip('/'))
+        for package, src_dir, _, filenames in build_py.data_files:
+            for filename in filenames:
+                if Path(src_dir, filename).as_posix() in members:
+                    files.append('/'.join(package.split('.') + [filename]).lstrip('/'))
+        return files
+
+    def verify_artifacts(self):
+        """Verify the packages built, raising RuntimeError if any have problems"""
+        site_packages_files = self.site_packages_files()
+        entry_points = self.distribution.entry_points or {}
+        scripts = [
+            entry_point.split('=', 1)[0].strip()
+            for entry_point in entry_points.get('console_scripts', [])
+        ]
+        expected_by_path = {}
+        # Problems with packages that prevent them being verified at all:
+        unverifiable = {}
+        for pkg in self.artifacts:
+            if self.noarch:
+                # Not specific to a Python version, only check unconditional
+                # requirements:
+                install_requires = [
+                    req for req in self.get_install_requires() if ';' not in req
+                ]
+            else:
+                # The Python version the package was built for, from its dependency on
+                # python rather than its build string, which may be customised:
+                try:
+                    index = verify.read_package_info(pkg)['index']
+                except (
+                    OSError,
+                    ValueError,
+                    RuntimeError,
+                    tarfile.TarError,
+                    zipfile.BadZipFile,
+                ) as e:
+                    unverifiable[pkg] = [f"could not read package: {e}"]
+                    continue
+                python = package_python_version(index.get('depends', []))
+                if python is None:
+                    msg = """no python version pin in the dependencies in
+                        info/index.json, can't evaluate requirements' environment
+                        markers"""
+                    unverifiable[pkg] = [' '.join(msg.split())]
+                    continue
+                install_requires = evaluate_requirements_matrix(
+                    self.get_install_requires(),
+                    [target_environment(current_subdir(), python)],
+                )[0]
+            depends = ['python'] + [
+                condify_name(split_requirement(req)[0], self.conda_name_differences)
+                for req in install_requires
+            ]
+            expected_by_path[pkg] = {
+                'name': self.NAME,
+                'version': self.VERSION,
+                'noarch': self.noarch,
+                'depends': depends,
+                'entry_points': scripts,
+                'license': self.license_file is not None,
+                'site_packages_files': site_packages_files,
+            }
+        results = verify.verify_packages(expected_by_path)
+        results.update(unverifiable)
+        failed = False
+        for pkg, problems in results.items():
+            if problems:
+                failed = True
+                print(f"{os.path.basename(pkg)} failed verification:")
+                for problem in problems:
+                    print(f"    {problem}")
+            else:
+                print(f"{os.path.basename(pkg)} verified")
+        if failed:
+            raise RuntimeError("Package verification failed")
+
+    def write_manifests(self):
+        """Write a manifest of each package built, and compare it to the manifest of the
+        previous build of the same package for the same Python version, if any,
+        printing a summary of the differences and any warnings"""
+        for pkg in self.artifacts:
+            name, _, build_string = split_package_filename(pkg)
+            tag = python_tag(build_string)
+            manifest_path = pkg + '.manifest.json'
+            previous_path = None
+            for path in Path(pkg).parent.glob('*.manifest.json'):
+                filename = path.name[: -len('.manifest.json')]
+                if not filename.endswith(('.tar.bz2', '.conda')):
+                    continue
+                other_name, _, other_build_string = split_package_filename(filename)
+                if (other_name, python_tag(other_build_string)) != (name, tag):
+                    continue
+                if previous_path is None or (
+                    os.path.getmtime(path) > os.path.getmtime(previous_path)
+                ):
+                    previous_path = path
+            previous = None
+            if previous_path is not None:
+                with open(previous_path) as f:
+                    previous = json.load(f)
+            manifest = verify.package_manifest(pkg)
+            with open(manifest_path, 'w') as f:
+                json.dump(manifest, f, indent=1)
+            print(f"Wrote {manifest_path}")
+            if previous is None:
+                print(f"{manifest['filename']}: no previous manifest to compare to")
+                continue
+            report, warnings = verify.diff_manifests(
+                previous,
+                manifest,
+                self.manifest_size_warning,
+                self.manifest_files_warning,
+            )
+            print(f"{manifest['filename']} compared to {previous['filename']}:")
+            for line in report:
+                print(f"    {line}")
+            for warning in warnings:
+                print(f"WARNING: {manifest['filename']}: {warning}")
+
+    @contextlib.contextmanager
+    def timed(self, phase):
+        """Context manager recording the time taken by the given phase of the build in
+        self.timings"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.timings[phase] = time.monotonic() - start
+
+    def log_options(self, phase):
+        """Keyword arguments for run() for the given phase of the build, which log its
+        output to file if log_dir is set."""
+        if self.log_dir is None:
+            return {}
+        return {
+            'name': phase,
+            'log_file': os.path.join(self.log_dir, f'{phase}.log.gz'),
+            'tail_lines': self.log_tail,
+        }
+
+    def setup_py_lock(self):
+        """Context manager to be held while running setup.py commands that write to the
+        project directory. In parallel mode this is a lock shared by all jobs, otherwise
+        it does nothing."""
+        if not self.parallel:
+            return contextlib.nullcontext()
+        return file_lock(os.path.join(self.build_root, '.setuptools_conda.lock'))
+
+    def run_setup_command(self, command, dist_dir, **options):
+        """Run the given setuptools command, such as 'sdist' or 'bdist_wheel', with its
+        output in dist_dir and any other options given as keyword arguments. The
+        command is run on this command's distribution in the current process, unless
+        setup_py_subprocess is set or output is being logged, in which case setup.py is
+        run in a subprocess."""
+        if self.setup_py_subprocess or self.log_dir is not None:
+            cmd = [sys.executable, *setup_py('.'), command, '--dist-dir=' + dist_dir]
+            for name, value in options.items():
+                cmd.append(f"--{name.replace('_', '-')}={value}")
+            run(cmd, **self.log_options(command))
+            return
+        print(f'[running]: {command} --dist-dir={dist_dir} (in-process)')
+        cmd_obj = self.reinitialize_command(command, reinit_subcommands=True)
+        cmd_obj.dist_dir = dist_dir
+        for name, value in options.items():
+            setattr(cmd_obj, name, value)
+        self.run_command(command)
+
+    def compiler_cache_environment(self):
+        """Return a dict of environment variables configuring the compiler cache for
+        conda-build and the build script, empty if no compiler cache is in use"""
+        if self.compiler_cache is None or self.distribution.ext_modules is None:
+            return {}
+        if self.from_wheel:
+            return {}
+        if self.compiler_cache == 'sccache':
+            return {'SCCACHE_DIR': self.compiler_cache_dir}
+        return {
+            'CCACHE_DIR': self.compiler_cache_dir,
+            # Cache entries for sources in different builds' work directories in croot
+            # are shared by hashing paths relative to croot and ignoring the working
+            # directory, and compilers installed to different build environments are
+            # compared by content rather than by path:
+            'CCACHE_BASEDIR': os.path.abspath(self.croot),
+            'CCACHE_NOHASHDIR': '1',
+            'CCACHE_COMPILERCHECK': 'content',
+        }
+
+    def resource_reservation(self):
+        """Context manager to be held while running conda-build. With the governor
+        enabled, reserves this build's CPUs and memory from the budget shared with other
+        builds, waiting for them to be available, otherwise does nothing."""
+        if not self.governor:
+            return contextlib.nullcontext()
+        return reserve_resources(self.cpus, self.memory)
+
+    def wheel_build_inputs(self):
+        """Return a dict of the build inputs other than the project source that can
+        affect the contents of a wheel built by bdist_wheel"""
+        import setuptools
+
+        inputs = {
+            'name': self.NAME,
+            'version': self.VERSION,
+            'python': sys.version,
+            'executable': sys.executable,
+            'platform': platform.platform(),
+            'setuptools': setuptools.__version__,
+        }
+        for name in _FINGERPRINT_ENV_VARS:
+            inputs[f'env:{name}'] = os.getenv(name)
+        return inputs
+
+    def generated_paths(self):
+        """Return the paths of directories that builds and setuptools-conda's commands
+        write to, which if inside the project are not part of its source"""
+        paths = [self.build_root, self.DIST_DIR, self.dist_dir, self.test_env_dir]
+        # The output directories of any other shards:
+        paths += Path('.').glob(shard_dist_dir(self.DIST_DIR, ('*', '*')))
+        # In parallel mode, croot and log_dir are subdirectories, for this job, of those
+        # configured, which are shared with other jobs:
+        for path in [self.croot, self.log_dir]:
+            if path is not None:
+                paths.append(os.path.dirname(path) if self.parallel else path)
+        paths += GENERATED_DIRS
+        return paths
+
+    def build_wheel(self):
+        """Build a wheel with bdist_wheel and copy it to the build directory. If a wheel
+        has previously been built from identical source and build inputs, copy that
+        wheel instead of building a new one."""
+        with self.setup_py_lock():
+            self._build_wheel()
+
+    def _build_wheel(self):
+        fingerprint = source_fingerprint(
+            '.', exclude=self.generated_paths(), inputs=self.wheel_build_inputs()
+        )
+        fingerprint_file = os.path.join(self.WHEEL_CACHE_DIR, 'fingerprint')
+        wheels = []
+        if os.path.exists(fingerprint_file):
+            with open(fingerprint_file) as f:
+                if f.read().strip() == fingerprint:
+                    wheels = [
+                        p
+                        for p in os.listdir(self.WHEEL_CACHE_DIR)
+                        if p.endswith('.whl')
+                    ]
+        if len(wheels) == 1:
+            print(f"Source and build inputs unchanged, reusing wheel {wheels[0]}")
+        else:
+            shutil.rmtree(self.WHEEL_CACHE_DIR, ignore_errors=True)
+            self.run_setup_command('bdist_wheel', self.WHEEL_CACHE_DIR)
+            wheels = [p for p in os.listdir(self.WHEEL_CACHE_DIR) if p.endswith('.whl')]
+            with open(fingerprint_file, 'w') as f:
+                f.write(fingerprint)
+        shutil.copy(os.path.join(self.WHEEL_CACHE_DIR, wheels[0]), self.build_dir)
+
+    def host_environment_hash(self):
+        """Return a hash of everything that determines the contents of conda-build's
+        build and host environments, for deciding whether they can be reused in fast
+        mode"""
+        inputs = {
+            'name': self.NAME,
+            'pythons': self.pythons,
+            'setup_requires': self.SETUP_REQUIRES,
+            'channels': self.channels,
+            'noarch': self.noarch,
+            'compilers': self.distribution.ext_modules is not None,
+            'compiler_cache': self.compiler_cache,
+            'from_wheel': (
+                self.from_wheel or self.from_downloaded_wheel or self.universal_wheel
+            ),
+        }
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def build_folders(self):
+        """Return the paths of the build folders of previous builds of this project in
+        croot, which conda-build names after the project and the time of the build"""
+        if not os.path.isdir(self.croot):
+            return []
+        pattern = re.compile(re.escape(self.NAME) + r'_[0-9]+$')
+        return [
+            build_folder
+            for build_folder in Path(self.croot).iterdir()
+            if build_folder.is_dir() and pattern.match(build_folder.name)
+        ]
+
+    def prepare_dirty_build(self):
+        """Prepare the build folders of previous builds in croot for reuse by a
+        conda-build --dirty build. Removes their work directories, so that conda-build
+        unpacks the new source, and uninstalls the project from their host environments,
+        so that conda-build sees the project's files as new when it is installed
+        again."""
+        for build_folder in self.build_folders():
+            shutil.rmtree(build_folder / 'work', ignore_errors=True)
+            for host_prefix in build_folder.glob('_h_env*'):
+                if WINDOWS:
+                    python = host_prefix / 'python.exe'
+                else:
+                    python = host_prefix / 'bin' / 'python'
+                if python.exists():
+                    run(
+                        [str(python), '-m', 'pip', 'uninstall', '-y', self.NAME],
+                        **self.log_options('pip-uninstall'),
+                    )
+
+    def clean(self):
+        """Remove the build directory and, unless in from_wheel mode, the setuptools
+        build directory, other than the wheel cache in universal_wheel mode. In fast
+        mode, if the previous build's environments can be reused, keep croot and return
+        True."""
+        self.recipe_dir = os.path.join(self.build_dir, 'recipe')
+        # In from_wheel mode keep the setuptools build directory, so that extensions can
+        # be compiled incrementally, and in parallel mode other jobs may be using it:
+        if self.universal_wheel and not self.parallel:
+            # Keep the cached wheel for reuse if the source has not changed:
+            if os.path.isdir('build'):
+                for entry in Path('build').iterdir():
+                    if entry != Path(self.WHEEL_CACHE_DIR):
+                        if entry.is_dir():
+                            shutil.rmtree(entry)
+                        else:
+                            entry.unlink()
+        elif not (self.from_wheel or self.parallel):
+            shutil.rmtree('build', ignore_errors=True)
+        hash_file = os.path.join(self.croot, 'setuptools_conda_environment_hash')
+        if self.fast and os.path.exists(hash_file):
+            with open(hash_file) as f:
+                if f.read().strip() == self.host_environment_hash():
+                    print("Build environment unchanged, reusing it")
+                    os.makedirs(self.build_dir, exist_ok=True)
+                    for entry in Path(self.build_dir).iterdir():
+                        if entry.resolve() == Path(self.croot).resolve():
+                            continue
+                        if entry.is_dir():
+                            shutil.rmtree(entry)
+                        else:
+                            entry.unlink()
+                    self.prepare_dirty_build()
+                    return True
+            print("Build environment has changed, doing a full build")
+        shutil.rmtree(self.build_dir, ignore_errors=True)
+        if self.fast:
+            # croot is in the build directory unless given explicitly, in which case it
+            # may be shared with other builds or contain other packages, so only remove
+            # this project's build folders from it:
+            for build_folder in self.build_folders():
+                shutil.rmtree(build_folder, ignore_errors=True)
+            os.makedirs(self.croot, exist_ok=True)
+            with open(hash_file, 'w') as f:
+                f.write(self.host_environment_hash())
+        return False
+
+    def run(self):
+        if self.check_noarch or self.auto_noarch:
+            blockers = self.get_noarch_blockers()
+            if blockers:
+                print(f"{self.NAME} cannot be built noarch:")
+                for blocker in blockers:
+                    print(f"    {blocker}")
+            else:
+                print(f"{self.NAME} can be built noarch")
+            if self.check_noarch:
+                return
+            if not blockers:
+                print("Building noarch package")
+                self.noarch = True
+                self.pythons = [f'{sys.version_info.major}.{sys.version_info.minor}']
+
+        if self.shard is not None:
+            # With noarch, the matrix is a single build, of the same package whichever
+            # Python version it is built with:
+            variants = ['noarch'] if self.noarch else self.pythons
+            variants = shard_entries(variants, self.shard, self.NAME)
+            index, count = self.shard
+            if not variants:
+                print(f"Nothing to build for {self.NAME} in shard {index}/{count}")
+                return
+            if not self.noarch:
+                self.pythons = variants
+            print(f"Building for {', '.join(variants)} in shard {index}/{count}")
+
+        self.clean()
+        os.makedirs(self.recipe_dir)
+
+        if self.from_wheel or self.universal_wheel:
+            with self.timed('bdist_wheel'):
+                self.build_wheel()
+
+        elif self.from_downloaded_wheel:
+            # Download a wheel:
+            cmd = [
+                'pip',
+                'download',
+                '--only-binary=:all:',
+                '--python-version',
+                self.pythons[0],
+                '--no-deps',
+                '--dest',
+                self.build_dir,
+                f'{self.NAME}=={self.VERSION}',
+            ]
+            with self.timed('pip-download'):
+                run(cmd, **self.log_options('pip-download'))
+
+        else:
+            # Run sdist to make a source tarball in the recipe dir:
+            with self.timed('sdist'), self.setup_py_lock():
+                self.run_setup_command('sdist', self.build_dir, formats='gztar')
+            if self.reproducible_sdist:
+                normalise_tarball(
+                    os.path.join(
+                        self.build_dir, f'{self.distribution.get_fullname()}.tar.gz'
+                    ),
+                    source_date_epoch('.'),
+                )
+
+        if self.from_wheel or self.from_downloaded_wheel or self.universal_wheel:
+            dist = [p for p in os.listdir(self.build_dir) if p.endswith('.whl')][0]
+            if self.universal_wheel and not dist.endswith('-none-any.whl'):
+                msg = f"""universal_wheel is set, but bdist_wheel built {dist}, which is
+                    not a pure-Python wheel"""
+                raise RuntimeError(' '.join(msg.split()))
+        else:
+            dist = f'{self.distribution.get_fullname()}.tar.gz'
+
+        self.dist_file = os.path.join(self.build_dir, dist)
+        with open(self.dist_file, 'rb') as f:
+            sha256 = hashlib.sha256(f.read()).hexdigest()
+
+        write_build_config(self.recipe_dir, self.pythons)
+
+        if self.license_file is not None:
+            shutil.copy(self.license_file, self.build_dir)
 
         with open(os.path.join(self.recipe_dir, 'meta.yaml'), 'w') as f:
-            f.write('\n'.join(yaml_lines(package_details)))
+            f.write('\n'.join(yaml_lines(self.package_details(dist, sha256))))
 
         # Link scripts:
         for name, contents in self.link_scripts.items():
@@ -759,12 +3339,22 @@ class dist_conda(Command):
         for chan in self.channels:
             channel_args += ['-c', chan]
 
+        conda_build_args = ['--no-test', self.recipe_dir, '--croot', self.croot]
+        if self.fast:
+            conda_build_args += ['--dirty']
+
         environ = os.environ.copy()
-        run(
-            ['conda-build', '--no-test', self.recipe_dir, '--croot', self.croot]
-            + channel_args,
-            env=environ,
-        )
+        if self.cpus is not None:
+            environ.update(parallelism_environment(self.cpus, environ))
+        environ.update(self.compiler_cache_environment())
+        # Packages already in croot, from previous builds:
+        croot_before = croot_snapshot(self.croot)
+        with self.resource_reservation(), self.timed('conda-build'):
+            run_conda_build(
+                conda_build_args + channel_args,
+                env=environ,
+                **self.log_options('conda-build'),
+            )
 
         if self.noarch:
             platform = 'noarch'
@@ -774,18 +3364,25 @@ class dist_conda(Command):
             config = Config()
             platform = config.host_subdir
 
-        repodir = os.path.join(self.croot, platform)
-        with open(os.path.join(repodir, 'repodata.json')) as f:
-            repodata = json.load(f)
-            pkgs = [os.path.join(repodir, pkg) for pkg in repodata.get("packages", {})]
-            pkgs += [os.path.join(repodir, pkg) for pkg in repodata.get("packages.conda", {})]
+        pkgs = built_packages(self.croot, platform, before=croot_before)
 
-        if not os.path.exists(self.DIST_DIR):
-            os.mkdir(self.DIST_DIR)
-        dist_subdir = os.path.join(self.DIST_DIR, platform)
-        if not os.path.exists(dist_subdir):
-            os.mkdir(dist_subdir)
+        if self.test:
+            with self.timed('test'):
+                self.test_packages(pkgs)
 
-        for pkg in pkgs:
-            print("copying %s to %s" % (os.path.basename(pkg), dist_subdir))
-            shutil.copy(pkg, dist_subdir)
+        with self.timed('publish'):
+            self.artifacts = publish_packages(pkgs, self.dist_dir, platform)
+
+        if self.verify:
+            with self.timed('verify'):
+                self.verify_artifacts()
+
+        if self.manifest:
+            with self.timed('manifest'):
+                self.write_manifests()
+
+        if self.keep_last is not None or self.max_size is not None:
+            with self.timed('gc'):
+                collect_package_garbage(
+                    self.dist_dir, self.keep_last, self.max_size, protect=self.artifacts
+                )
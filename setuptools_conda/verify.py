@@ -0,0 +1,242 @@
+"""Verification and content manifests of built conda packages, by reading them as
+streams without extracting them. Supports both .tar.bz2 packages and .conda packages,
+the latter requiring the zstandard module. Both are read with tarfile in streaming mode,
+reading the contents of metadata files in info/ and only the names and sizes of all
+other files, so package payloads are never written to disk or held in memory."""
+
+import os
+import re
+import json
+import functools
+import contextlib
+import tarfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+# Metadata files read from packages:
+_INFO_FILES = {
+    'info/index.json',
+    'info/files',
+    'info/link.json',
+}
+
+
+@contextlib.contextmanager
+def _open_components(path):
+    # Yield a list of (component, compressed_size, opener) for each tar archive making
+    # up the conda package at path, where opener() is a context manager returning the
+    # archive opened with tarfile in streaming mode. .tar.bz2 packages have a single
+    # component '', and .conda packages have components 'info' and 'pkg'.
+    if path.endswith('.tar.bz2'):
+        yield [('', os.path.getsize(path), lambda: tarfile.open(path, 'r|bz2'))]
+    elif path.endswith('.conda'):
+        try:
+            import zstandard
+        except ImportError:
+            msg = "The zstandard module is required to read .conda packages"
+            raise RuntimeError(msg) from None
+
+        @contextlib.contextmanager
+        def opener(zf, name):
+            with zf.open(name) as f:
+                reader = zstandard.ZstdDecompressor().stream_reader(f)
+                with tarfile.open(fileobj=reader, mode='r|') as tar:
+                    yield tar
+
+        with zipfile.ZipFile(path) as zf:
+            components = []
+            for zinfo in zf.infolist():
+                match = re.match(r'(info|pkg)-.*\.tar\.zst$', zinfo.filename)
+                if match:
+                    components.append(
+                        (
+                            match.group(1),
+                            zinfo.compress_size,
+                            functools.partial(opener, zf, zinfo.filename),
+                        )
+                    )
+            if not any(component == 'info' for component, _, _ in components):
+                raise ValueError(f"{path}: no info archive")
+            yield components
+    else:
+        raise ValueError(f"Not a conda package: {path}")
+
+
+def read_package_info(path):
+    """Return a dict of the metadata of the conda package at path, with keys 'index'
+    (the contents of info/index.json), 'files' (the list of paths in info/files),
+    'link' (the contents of info/link.json, or None) and 'licenses' (the names of the
+    files in info/licenses)"""
+    info = {}
+    licenses = []
+    # In .conda packages, all of info/, including info/licenses, is in the info
+    # archive, so the payload archive need not be decompressed:
+    with _open_components(path) as components:
+        for component, _, opener in components:
+            if component == 'pkg':
+                continue
+            with opener() as tar:
+                for member in tar:
+                    if member.name in _INFO_FILES and member.isfile():
+                        data = tar.extractfile(member).read()
+                        info[member.name] = data.decode('utf8')
+                    elif member.name.startswith('info/licenses/'):
+                        licenses.append(member.name[len('info/licenses/') :])
+    if 'info/index.json' not in info:
+        raise ValueError(f"{path}: no info/index.json")
+    return {
+        'index': json.loads(info['info/index.json']),
+        'files': info.get('info/files', '').splitlines(),
+        'link': (
+            json.loads(info['info/link.json']) if 'info/link.json' in info else None
+        ),
+        'licenses': licenses,
+    }
+
+
+def package_manifest(path):
+    """Return a manifest of the contents of the conda package at path: a dict with the
+    package's 'filename', its total 'size' on disk, the 'compressed_sizes' of each of
+    its component archives, and 'files', a dict mapping the path of every file in the
+    package, including metadata files in info/, to its uncompressed size. Reads the
+    package as a stream without extracting it."""
+    files = {}
+    compressed_sizes = {}
+    with _open_components(path) as components:
+        for component, compressed_size, opener in components:
+            compressed_sizes[component or 'all'] = compressed_size
+            with opener() as tar:
+                for member in tar:
+                    if not member.isdir():
+                        files[member.name] = member.size
+    return {
+        'filename': os.path.basename(path),
+        'size': os.path.getsize(path),
+        'compressed_sizes': compressed_sizes,
+        'files': dict(sorted(files.items())),
+    }
+
+
+def diff_manifests(old, new, size_threshold, file_count_threshold, n_largest=10):
+    """Compare two manifests as returned by package_manifest(), and return a tuple
+    (report, warnings) of lists of lines describing the changes, where warnings
+    describes any increase in package size or number of files by more than the given
+    thresholds, as percentages. The report lists the totals, the files added and
+    removed, and the n_largest largest changes in file size."""
+    report = []
+    warnings = []
+    for description, old_value, new_value, threshold in [
+        ('package size', old['size'], new['size'], size_threshold),
+        ('number of files', len(old['files']), len(new['files']), file_count_threshold),
+    ]:
+        change = 100 * (new_value - old_value) / old_value if old_value else 0
+        line = f"{description}: {old_value} -> {new_value} ({change:+.1f}%)"
+        report.append(line)
+        if change > threshold:
+            warnings.append(f"{line}, more than {threshold:g}%")
+    added = sorted(set(new['files']) - set(old['files']))
+    removed = sorted(set(old['files']) - set(new['files']))
+    report.append(f"{len(added)} files added, {len(removed)} files removed")
+    changes = {
+        name: new['files'].get(name, 0) - old['files'].get(name, 0)
+        for name in set(old['files']) | set(new['files'])
+    }
+    largest = sorted(
+        (name for name in changes if changes[name]),
+        key=lambda name: abs(changes[name]),
+        reverse=True,
+    )[:n_largest]
+    if largest:
+        report.append("largest changes in file size:")
+        report += [f"    {changes[name]:+} {name}" for name in largest]
+    return report, warnings
+
+
+def sdist_members(path):
+    """Return the set of paths of files in an sdist tarball, relative to its top-level
+    directory, reading it as a stream"""
+    members = set()
+    with tarfile.open(path, 'r|*') as tar:
+        for member in tar:
+            if member.isfile() and '/' in member.name:
+                members.add(member.name.split('/', 1)[1])
+    return members
+
+
+def verify_package(path, expected):
+    """Check the conda package at path against the expected dict, and return a list of
+    problems found, which is empty if there are none. Keys of expected are:
+
+    name, version: expected package name and version
+    noarch: whether the package should be noarch: python
+    depends: names of packages that must be among its dependencies
+    entry_points: names of console scripts the package must provide
+    license: whether the package must include a license file
+    site_packages_files: paths, relative to site-packages, of files that must be
+        installed by the package"""
+    try:
+        info = read_package_info(path)
+    except (
+        OSError,
+        ValueError,
+        RuntimeError,
+        tarfile.TarError,
+        zipfile.BadZipFile,
+    ) as e:
+        return [f"could not read package: {e}"]
+    problems = []
+    index = info['index']
+    for key in ['name', 'version']:
+        if index.get(key) != expected[key]:
+            problems.append(f"{key} is {index.get(key)!r}, expected {expected[key]!r}")
+    noarch = index.get('noarch')
+    if expected['noarch'] and noarch != 'python':
+        problems.append(f"noarch is {noarch!r}, expected 'python'")
+    elif not expected['noarch'] and noarch:
+        problems.append(f"noarch is {noarch!r}, expected a platform-specific package")
+    depends = {dep.split(' ', 1)[0] for dep in index.get('depends', [])}
+    for name in expected['depends']:
+        if name not in depends:
+            problems.append(f"missing dependency {name}")
+
+    files = set(info['files'])
+    if expected['noarch']:
+        link = info['link'] or {}
+        entry_points = link.get('noarch', {}).get('entry_points', [])
+        scripts = {entry_point.split('=', 1)[0].strip() for entry_point in entry_points}
+    else:
+        scripts = set()
+        for file in files:
+            dirname, filename = os.path.split(file)
+            if dirname == 'bin':
+                scripts.add(filename)
+            elif dirname == 'Scripts' and filename.endswith('.exe'):
+                scripts.add(filename[: -len('.exe')])
+    for script in expected['entry_points']:
+        if script not in scripts:
+            problems.append(f"missing entry point {script}")
+
+    if expected['license'] and not info['licenses']:
+        problems.append("missing license file")
+
+    # Files in site-packages, relative to it, whichever layout the package has:
+    installed = set()
+    for file in files:
+        _, sep, relpath = file.partition('site-packages/')
+        if sep:
+            installed.add(relpath)
+    for file in expected['site_packages_files']:
+        if file not in installed:
+            problems.append(f"missing file {file}")
+    return problems
+
+
+def verify_packages(expected_by_path, max_workers=None):
+    """Verify each package, given as a dict mapping package paths to the expected dict
+    for verify_package(), concurrently. Return a dict mapping each path to its list of
+    problems."""
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(
+            lambda item: verify_package(*item), expected_by_path.items()
+        )
+        return dict(zip(expected_by_path, results))
@@ -0,0 +1,88 @@
+import os
+
+import pytest
+
+from setuptools_conda import setuptools_conda
+from setuptools_conda.setuptools_conda import (
+    CPU_BUDGET_ENV_VAR,
+    MEMORY_BUDGET_ENV_VAR,
+    available_cpus,
+    cgroup_memory_limit,
+    resource_budget,
+)
+
+GB = 1024**3
+
+
+@pytest.fixture
+def machine(monkeypatch):
+    """Fake an 8 CPU machine with 16 GB of memory and no cgroup limits. Returns the dict
+    of cgroup files, which tests may add to"""
+    cgroup_files = {}
+    monkeypatch.setattr(
+        os, 'sched_getaffinity', lambda pid: set(range(8)), raising=False
+    )
+    monkeypatch.setattr(setuptools_conda, 'total_memory', lambda: 16.0)
+
+    def read_cgroup_file(*paths):
+        for path in paths:
+            if path in cgroup_files:
+                return cgroup_files[path]
+        return None
+
+    monkeypatch.setattr(setuptools_conda, '_read_cgroup_file', read_cgroup_file)
+    monkeypatch.delenv(CPU_BUDGET_ENV_VAR, raising=False)
+    monkeypatch.delenv(MEMORY_BUDGET_ENV_VAR, raising=False)
+    return cgroup_files
+
+
+def test_no_limits(machine):
+    assert available_cpus() == 8
+    assert cgroup_memory_limit() is None
+    assert resource_budget() == (8.0, 16.0)
+
+
+def test_cgroup_v2_limits(machine):
+    machine['/sys/fs/cgroup/cpu.max'] = '150000 100000'
+    machine['/sys/fs/cgroup/memory.max'] = str(2 * GB)
+    assert available_cpus() == 2
+    assert resource_budget() == (2.0, 2.0)
+
+
+def test_cgroup_v2_unlimited(machine):
+    machine['/sys/fs/cgroup/cpu.max'] = 'max 100000'
+    machine['/sys/fs/cgroup/memory.max'] = 'max'
+    assert resource_budget() == (8.0, 16.0)
+
+
+def test_cgroup_v1_limits(machine):
+    machine['/sys/fs/cgroup/cpu/cpu.cfs_quota_us'] = '400000'
+    machine['/sys/fs/cgroup/cpu/cpu.cfs_period_us'] = '100000'
+    machine['/sys/fs/cgroup/memory/memory.limit_in_bytes'] = str(4 * GB)
+    assert resource_budget() == (4.0, 4.0)
+
+
+def test_cgroup_v1_unlimited(machine):
+    machine['/sys/fs/cgroup/cpu/cpu.cfs_quota_us'] = '-1'
+    machine['/sys/fs/cgroup/cpu/cpu.cfs_period_us'] = '100000'
+    machine['/sys/fs/cgroup/memory/memory.limit_in_bytes'] = str(2**63 - 4096)
+    assert resource_budget() == (8.0, 16.0)
+
+
+def test_cgroup_limit_above_affinity(machine, monkeypatch):
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: {0}, raising=False)
+    machine['/sys/fs/cgroup/cpu.max'] = '400000 100000'
+    machine['/sys/fs/cgroup/memory.max'] = str(32 * GB)
+    assert resource_budget() == (1.0, 16.0)
+
+
+def test_environment_overrides(machine, monkeypatch):
+    machine['/sys/fs/cgroup/cpu.max'] = '150000 100000'
+    monkeypatch.setenv(CPU_BUDGET_ENV_VAR, '3.5')
+    monkeypatch.setenv(MEMORY_BUDGET_ENV_VAR, '6')
+    assert resource_budget() == (3.5, 6.0)
+
+
+def test_unknown_memory(machine, monkeypatch):
+    monkeypatch.setattr(setuptools_conda, 'total_memory', lambda: None)
+    assert resource_budget() == (8.0, None)
@@ -0,0 +1,169 @@
+import io
+import os
+import tarfile
+
+import pytest
+
+from setuptools_conda.setuptools_conda import (
+    expired_packages,
+    normalise_tarball,
+    package_python_version,
+    parse_size,
+    python_tag,
+    split_package_filename,
+)
+
+
+@pytest.mark.parametrize(
+    'size, expected',
+    [
+        (1024, 1024),
+        ('12', 12),
+        ('500M', 500 * 1024**2),
+        ('1.5G', 1536 * 1024**2),
+        ('20gb', 20 * 1024**3),
+        (' 2 T ', 2 * 1024**4),
+    ],
+)
+def test_parse_size(size, expected):
+    assert parse_size(size) == expected
+
+
+@pytest.mark.parametrize('size', ['', 'M', '1.5X', '-1G', 'lots'])
+def test_parse_size_invalid(size):
+    with pytest.raises(ValueError):
+        parse_size(size)
+
+
+def test_split_package_filename():
+    assert split_package_filename('/x/foo-bar-1.0-py311_0.conda') == (
+        'foo-bar',
+        '1.0',
+        'py311_0',
+    )
+    assert split_package_filename('a-1-0.tar.bz2') == ('a', '1', '0')
+    with pytest.raises(ValueError, match='Not a conda package'):
+        split_package_filename('foo-1.0-py311_0.whl')
+
+
+def test_python_tag():
+    assert python_tag('py311h123_0') == 'py311'
+    assert python_tag('pyh_0') == 'py'
+    assert python_tag('h1_0') is None
+
+
+def test_package_python_version():
+    assert package_python_version(['numpy', 'python >=3.11,<3.12.0a0']) == '3.11'
+    assert package_python_version(['python 3.10.*']) == '3.10'
+    assert package_python_version(['python >=3.8']) is None
+    assert package_python_version(['numpy >=1.2']) is None
+
+
+def make_packages(directory, names_and_sizes):
+    """Create package files of the given sizes in directory, each one second newer than
+    the last, and return their paths"""
+    paths = []
+    for i, (name, size) in enumerate(names_and_sizes):
+        path = os.path.join(directory, name)
+        with open(path, 'wb') as f:
+            f.write(b'\0' * size)
+        os.utime(path, (1_000_000 + i, 1_000_000 + i))
+        paths.append(path)
+    return paths
+
+
+def test_expired_packages_keep_last(tmp_path):
+    old, mid, new, other_py, other_version = make_packages(
+        tmp_path,
+        [
+            ('foo-1.0-py311_0.conda', 1),
+            ('foo-1.0-py311_1.conda', 1),
+            ('foo-1.0-py311_2.conda', 1),
+            ('foo-1.0-py310_0.conda', 1),
+            ('foo-2.0-py311_0.conda', 1),
+        ],
+    )
+    pkgs = [old, mid, new, other_py, other_version]
+    assert expired_packages(pkgs, keep_last=1) == [mid, old]
+    assert expired_packages(pkgs, keep_last=2) == [old]
+    assert expired_packages(pkgs, keep_last=1, protect=[old]) == [mid]
+
+
+def test_expired_packages_max_size(tmp_path):
+    first, second, third = make_packages(
+        tmp_path,
+        [
+            ('a-1-py_0.conda', 100),
+            ('b-1-py_0.conda', 100),
+            ('c-1-py_0.conda', 100),
+        ],
+    )
+    pkgs = [first, second, third]
+    assert expired_packages(pkgs, max_size=300) == []
+    assert expired_packages(pkgs, max_size=150) == [first, second]
+    # Protected packages are kept but still count towards the size:
+    assert expired_packages(pkgs, max_size=150, protect=[first]) == [second, third]
+
+
+def test_expired_packages_keep_last_then_max_size(tmp_path):
+    old, new, other = make_packages(
+        tmp_path,
+        [
+            ('a-1-py_0.conda', 100),
+            ('a-1-py_1.conda', 100),
+            ('b-1-py_0.conda', 100),
+        ],
+    )
+    pkgs = [old, new, other]
+    assert expired_packages(pkgs, keep_last=1, max_size=100) == [old, new]
+
+
+def make_tarball(path, files, mtime):
+    """Write a gzipped tarball containing the given (name, data, mode) files, in the
+    order given, with the given timestamp and a non-root owner"""
+    with tarfile.open(path, 'w:gz') as tar:
+        for name, data, mode in files:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = mtime
+            info.uid = info.gid = 1000
+            info.uname = info.gname = 'user'
+            tar.addfile(info, io.BytesIO(data))
+
+
+def test_normalise_tarball_reproducible(tmp_path):
+    files = [
+        ('proj/setup.py', b'setup()', 0o664),
+        ('proj/run.sh', b'#!/bin/sh', 0o775),
+        ('proj/README', b'readme', 0o600),
+    ]
+    a, b = str(tmp_path / 'a.tar.gz'), str(tmp_path / 'b.tar.gz')
+    make_tarball(a, files, mtime=1_000_000)
+    make_tarball(b, files[::-1], mtime=2_000_000)
+    assert open(a, 'rb').read() != open(b, 'rb').read()
+    normalise_tarball(a, mtime=12345)
+    normalise_tarball(b, mtime=12345)
+    assert open(a, 'rb').read() == open(b, 'rb').read()
+
+    with tarfile.open(a, 'r:gz') as tar:
+        members = tar.getmembers()
+        assert [m.name for m in members] == sorted(name for name, _, _ in files)
+        assert {(m.mtime, m.uid, m.gid, m.uname) for m in members} == {
+            (12345, 0, 0, 'root')
+        }
+        modes = {m.name: m.mode for m in members}
+        assert modes == {
+            'proj/README': 0o644,
+            'proj/run.sh': 0o755,
+            'proj/setup.py': 0o644,
+        }
+        assert tar.extractfile('proj/setup.py').read() == b'setup()'
+
+
+def test_normalise_tarball_default_mtime(tmp_path):
+    path = str(tmp_path / 'a.tar.gz')
+    make_tarball(path, [('proj/setup.py', b'', 0o644)], mtime=1_000_000)
+    normalise_tarball(path)
+    with tarfile.open(path, 'r:gz') as tar:
+        assert tar.getmember('proj/setup.py').mtime == 1_000_000
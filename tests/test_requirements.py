@@ -0,0 +1,127 @@
+import pytest
+
+from setuptools_conda.setuptools_conda import (
+    _merge_constraints,
+    condify_name,
+    evaluate_requirements_matrix,
+    merge_requirements,
+    normalise_name,
+    requirement_errors,
+    target_environment,
+)
+
+
+def test_merge_requirements_keeps_tightest_bounds():
+    merged = merge_requirements(['numpy >=1.2', 'numpy >=1.5,<2', 'numpy <3'])
+    assert merged == ['numpy >=1.5,<2']
+
+
+def test_merge_requirements_normalises_names():
+    merged = merge_requirements(['Foo_Bar', 'foo-bar ==1.*'])
+    assert merged == ['foo-bar ==1.*']
+
+
+def test_merge_requirements_reports_every_conflict():
+    with pytest.raises(ValueError) as excinfo:
+        merge_requirements(['a >=2', 'a <1', 'b ==1.0', 'b ==2.0', 'c'])
+    message = str(excinfo.value)
+    assert 'a: >=2 and <1' in message
+    assert 'b: ==1.0 and ==2.0' in message
+    assert 'c' not in message.split(':', 1)[1]
+
+
+def test_merge_constraints():
+    constraints = [('>=', '1.0'), ('>', '1.0'), ('<', '3'), ('<=', '2')]
+    constraints += [('!=', '1.5'), ('!=', '1.5')]
+    merged, conflicts = _merge_constraints(constraints)
+    assert merged == [('>', '1.0'), ('<=', '2'), ('!=', '1.5')]
+    assert conflicts == []
+
+
+def test_merge_constraints_touching_bounds_conflict():
+    _, conflicts = _merge_constraints([('>', '2'), ('<=', '2')])
+    assert conflicts == ['>2 and <=2']
+    _, conflicts = _merge_constraints([('>=', '2'), ('<=', '2')])
+    assert conflicts == []
+
+
+def test_merge_constraints_pin_outside_bounds():
+    _, conflicts = _merge_constraints([('==', '1.4'), ('>=', '2')])
+    assert conflicts == ['==1.4 and >=2']
+    _, conflicts = _merge_constraints([('==', '1.4'), ('>=', '1.2'), ('<', '2')])
+    assert conflicts == []
+
+
+def test_merge_constraints_non_pep440_versions_left_alone():
+    constraints = [('>=', 'abc'), ('<', 'def'), ('>=', 'abc')]
+    assert _merge_constraints(constraints) == ([('>=', 'abc'), ('<', 'def')], [])
+
+
+@pytest.mark.parametrize(
+    'requirement',
+    [
+        'numpy>=1.2',
+        'foo~=1.2',
+        'foo[bar]>=1',
+        "foo; python_version >= '3.8'",
+        "pywin32; sys_platform == 'win32'",
+    ],
+)
+def test_requirement_errors_valid(requirement):
+    assert requirement_errors(requirement) == []
+
+
+@pytest.mark.parametrize(
+    'requirement, error',
+    [
+        ('foo===1.0', "The '===' (arbitrary) version operator"),
+        ('foo>=', 'invalid specifier >='),
+        ("foo; os_name == 'posix' and", 'invalid environment marker'),
+        ("foo>=1.0; extra == 'x'", 'has no conda selector equivalent'),
+    ],
+)
+def test_requirement_errors_invalid(requirement, error):
+    errors = requirement_errors(requirement)
+    assert len(errors) == 1
+    assert error in errors[0]
+
+
+def test_requirement_errors_invalid_conda_name():
+    errors = requirement_errors('foo', name_replacements={'foo': 'Not Valid'})
+    assert errors == ["invalid conda package name 'Not Valid'"]
+
+
+def test_normalise_name():
+    assert normalise_name('Ruamel__.Yaml') == 'ruamel-yaml'
+    assert normalise_name('PyQt5') == normalise_name('pyqt5')
+
+
+def test_condify_name():
+    assert condify_name('Foo_Bar') == 'foo-bar'
+    assert condify_name('PyQt5', {'pyqt5': 'pyqt'}) == 'pyqt'
+    assert condify_name('ruamel_yaml', {'ruamel-yaml': 'ruamel.yaml'}) == 'ruamel.yaml'
+    # An exact match takes precedence over a normalised one:
+    assert condify_name('PyQt5', {'PyQt5': 'a', 'pyqt5': 'b'}) == 'a'
+
+
+def test_evaluate_requirements_matrix():
+    requirements = [
+        "tomli; python_version < '3.11'",
+        "pywin32; sys_platform == 'win32'",
+        'numpy',
+    ]
+    environments = [
+        target_environment('linux-64', '3.9'),
+        target_environment('linux-64', '3.12'),
+        target_environment('win-64', '3.12'),
+    ]
+    assert evaluate_requirements_matrix(requirements, environments) == [
+        ['tomli', 'numpy'],
+        ['numpy'],
+        ['pywin32', 'numpy'],
+    ]
+
+
+def test_target_environment_unknown_platform():
+    with pytest.raises(ValueError):
+        target_environment('plan9-64', '3.12')
@@ -0,0 +1,35 @@
+import pytest
+
+from setuptools_conda.setuptools_conda import parse_shard, shard_entries
+
+
+def test_parse_shard():
+    assert parse_shard('1/4') == (1, 4)
+    assert parse_shard(' 2 / 3 ') == (2, 3)
+
+
+@pytest.mark.parametrize('shard', ['0/2', '3/2'])
+def test_parse_shard_out_of_range(shard):
+    with pytest.raises(ValueError, match='must be between 1/2 and 2/2'):
+        parse_shard(shard)
+
+
+@pytest.mark.parametrize('shard', ['x', '1', '1/2/3', '-1/2'])
+def test_parse_shard_invalid(shard):
+    with pytest.raises(ValueError, match='expected e.g.'):
+        parse_shard(shard)
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 5])
+def test_shard_entries_cover_matrix_exactly_once(count):
+    entries = ['3.9', '3.10', '3.11', '3.12']
+    shards = [shard_entries(entries, (i, count), 'proj') for i in range(1, count + 1)]
+    assert sorted(entry for shard in shards for entry in shard) == sorted(entries)
+
+
+def test_shard_entries_deterministic():
+    entries = ['3.9', '3.10', '3.11', '3.12']
+    assert shard_entries(entries, (1, 2), 'x') == ['3.11', '3.9']
+    assert shard_entries(entries, (2, 2), 'x') == ['3.10', '3.12']
+    # Independent of the order entries are given in:
+    assert shard_entries(entries[::-1], (1, 2), 'x') == ['3.11', '3.9']
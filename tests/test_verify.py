@@ -0,0 +1,50 @@
+import io
+import tarfile
+
+from setuptools_conda.verify import diff_manifests, sdist_members
+
+
+def test_diff_manifests():
+    old = {'size': 1000, 'files': {'a.py': 100, 'b.py': 200, 'c.py': 300}}
+    new = {'size': 1200, 'files': {'a.py': 100, 'b.py': 150, 'd.py': 500}}
+    report, warnings = diff_manifests(old, new, 10, 50)
+    assert report == [
+        'package size: 1000 -> 1200 (+20.0%)',
+        'number of files: 3 -> 3 (+0.0%)',
+        '1 files added, 1 files removed',
+        'largest changes in file size:',
+        '    +500 d.py',
+        '    -300 c.py',
+        '    -50 b.py',
+    ]
+    assert warnings == ['package size: 1000 -> 1200 (+20.0%), more than 10%']
+
+
+def test_diff_manifests_n_largest():
+    old = {'size': 100, 'files': {'a': 1, 'b': 1, 'c': 1}}
+    new = {'size': 50, 'files': {'a': 2, 'b': 11, 'c': 101, 'd': 1, 'e': 1}}
+    report, warnings = diff_manifests(old, new, 10, 50, n_largest=2)
+    assert report[-3:] == ['largest changes in file size:', '    +100 c', '    +10 b']
+    assert warnings == ['number of files: 3 -> 5 (+66.7%), more than 50%']
+
+
+def test_diff_manifests_unchanged():
+    manifest = {'size': 10, 'files': {'a': 10}}
+    report, warnings = diff_manifests(manifest, manifest, 0, 0)
+    assert report == [
+        'package size: 10 -> 10 (+0.0%)',
+        'number of files: 1 -> 1 (+0.0%)',
+        '0 files added, 0 files removed',
+    ]
+    assert warnings == []
+
+
+def test_sdist_members(tmp_path):
+    path = str(tmp_path / 'proj-1.0.tar.gz')
+    with tarfile.open(path, 'w:gz') as tar:
+        top = tarfile.TarInfo('proj-1.0')
+        top.type = tarfile.DIRTYPE
+        tar.addfile(top)
+        for name in ['proj-1.0/PKG-INFO', 'proj-1.0/proj/__init__.py']:
+            tar.addfile(tarfile.TarInfo(name), io.BytesIO(b''))
+    assert sdist_members(path) == {'PKG-INFO', 'proj/__init__.py'}